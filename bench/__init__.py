@@ -0,0 +1,2 @@
+# reproducible benchmarks: a synthetic journal corpus (corpus.py), a stand-in for the ollama server (fake_ollama.py)
+# and the benchmarks themselves (run.py). run from the repo root: python -m bench.run --help
@@ -0,0 +1,65 @@
+import argparse
+import datetime
+import os
+import random
+
+# makes a folder of dated journal files that look enough like the real thing for chunking, tfidf and the extraction prompts:
+# one file per day or so, a few recurring people and cities, and mostly ordinary words
+
+PEOPLE = ["Anna", "Jamie", "Mom", "Dad", "Priya", "Marcus", "Lena", "Tom", "Sofia", "Omar", "Grace", "Leo"]
+CITIES = ["Boston", "New York", "Chicago", "Seattle", "Austin", "Denver", "Paris", "London", "Tokyo", "Cape Cod"]
+PLACES = ["the office", "the gym", "a coffee shop", "the park", "home", "the library", "a bar", "the beach"]
+VERBS = ["met", "called", "had dinner with", "went running with", "argued with", "worked with", "visited", "texted"]
+WORDS = (
+    "today work project meeting tired happy morning evening weekend coffee lunch dinner walk run book movie "
+    "idea plan week month year rain sun cold warm late early sleep dream talk long short good bad great "
+    "friend family trip train flight car bus city street music song game code bug deadline email call"
+).split()
+
+def sentence(rng):
+    kind = rng.random()
+    if kind < 0.3:
+        return f"I {rng.choice(VERBS)} {rng.choice(PEOPLE)} at {rng.choice(PLACES)}."
+    if kind < 0.4:
+        return f"Spent the day in {rng.choice(CITIES)} with {rng.choice(PEOPLE)}."
+    words = [rng.choice(WORDS) for _ in range(rng.randint(6, 16))]
+    return " ".join(words).capitalize() + "."
+
+def entry(rng, size_bytes):
+    parts = []
+    total = 0
+    while total < size_bytes:
+        paragraph = " ".join(sentence(rng) for _ in range(rng.randint(3, 8)))
+        parts.append(paragraph)
+        total += len(paragraph) + 2
+    return "\n\n".join(parts)
+
+# returns the paths it wrote. same seed, same corpus
+def generate_corpus(out_dir, files=365, bytes_per_file=4096, start="2015-01-01", seed=0):
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    date = datetime.date.fromisoformat(start)
+    paths = []
+    for _ in range(files):
+        # sizes vary a lot in real journals
+        size = max(200, int(rng.lognormvariate(0, 0.6) * bytes_per_file))
+        path = os.path.join(out_dir, f"{date.isoformat()}.txt")
+        with open(path, "w") as f:
+            f.write(entry(rng, size))
+        paths.append(path)
+        date += datetime.timedelta(days=rng.choice([1, 1, 1, 2, 3]))
+    return paths
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Write a synthetic journal corpus")
+    arg_parser.add_argument("out_dir")
+    arg_parser.add_argument("--files", type=int, default=365)
+    arg_parser.add_argument("--bytes-per-file", type=int, default=4096)
+    arg_parser.add_argument("--start", default="2015-01-01")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    args = arg_parser.parse_args()
+    paths = generate_corpus(args.out_dir, args.files, args.bytes_per_file, args.start, args.seed)
+    print(f"Wrote {len(paths)} files, {sum(os.path.getsize(x) for x in paths)} bytes to {args.out_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+import argparse
+import datetime
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bench.corpus import CITIES, PEOPLE, VERBS
+
+# stands in for ollama so benchmarks don't need a model or a gpu, and give the same answers every time.
+# handles /api/generate (streaming or not), /api/embed and /api/embeddings, which is all common.py uses.
+# point the scripts at it with OLLAMA_HOST=http://127.0.0.1:11435
+#
+# embeddings are hashed bags of words, so texts sharing words still come out similar and vector search has something to find.
+# generations answer the extraction prompts in the shape the scripts parse (a number, a location json, a list of triples),
+# anything else gets filler. latency is a fixed delay per request plus one per generated token.
+
+EMBED_DIMENSIONS = 768
+
+def hashed(text):
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little")
+
+def fake_embedding(text, dimensions=EMBED_DIMENSIONS):
+    vector = [0.0] * dimensions
+    for word in re.findall(r"\w+", text.lower()):
+        h = hashed(word)
+        vector[h % dimensions] += 1.0 if (h >> 32) & 1 else -1.0
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+def fake_tokens(text):
+    return max(1, int(len(text.encode()) / 3.5))
+
+# the chunk the extraction prompts put after "Text:"
+def prompt_text(prompt):
+    match = re.search(r"Text:\n(.*?)\n\n", prompt, re.S)
+    return match.group(1) if match else prompt
+
+def fake_response(prompt, format, tokens):
+    if "rating of the happiness" in prompt:
+        return str(hashed(prompt) % 100 + 1)
+    if "Extract the location" in prompt:
+        text = prompt_text(prompt)
+        found = [city for city in CITIES if city in text]
+        return json.dumps({"location": found[0] if found else "none"})
+    if "Extract all relationships" in prompt:
+        text = prompt_text(prompt)
+        relationships = []
+        for verb in VERBS:
+            for person in PEOPLE:
+                if f"{verb} {person}" in text:
+                    relationships.append({"subject": "I", "predicate": verb, "object": person})
+        return json.dumps(relationships[:20])
+    if "Expand the following query" in prompt:
+        query = prompt.rsplit("Query:", 1)[-1].strip()
+        return f"{query}, {query} related, {query} synonyms"
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+    filler = " ".join(words[i % len(words)] for i in range(tokens))
+    if format == "json":
+        return json.dumps({"response": filler})
+    return filler
+
+# json answers get split in the middle of strings too, like a real tokenizer would
+def split_pieces(response, tokens):
+    size = max(1, math.ceil(len(response) / max(1, tokens)))
+    return [response[i:i+size] for i in range(0, len(response), size)]
+
+class FakeOllama(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out as separate writes, with nagle on each keep-alive request waits ~40ms for an ack
+    disable_nagle_algorithm = True
+    latency = 0.0
+    token_latency = 0.0
+    response_tokens = 32
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/api/version":
+            self.send_json({"version": "0.0.0-fake"})
+        elif self.path == "/api/tags":
+            self.send_json({"models": []})
+        else:
+            self.send_error(404)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(self.latency)
+        if self.path == "/api/embeddings":
+            self.send_json({"embedding": fake_embedding(request.get("prompt", ""))})
+        elif self.path == "/api/embed":
+            texts = request.get("input", [])
+            if isinstance(texts, str):
+                texts = [texts]
+            self.send_json({"model": request.get("model"), "embeddings": [fake_embedding(x) for x in texts]})
+        elif self.path == "/api/generate":
+            self.generate(request)
+        else:
+            self.send_error(404)
+
+    def generate(self, request):
+        started = time.perf_counter_ns()
+        prompt = request.get("prompt", "")
+        options = request.get("options") or {}
+        tokens = min(self.response_tokens, options.get("num_predict") or self.response_tokens)
+        if tokens < 0:
+            tokens = self.response_tokens
+        response = fake_response(prompt, request.get("format", ""), tokens)
+        pieces = split_pieces(response, tokens)
+        context = request.get("context") or []
+        # the context it's sent counts as cached, like ollama's prefix cache
+        prompt_tokens = fake_tokens(prompt)
+        created = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+        def final(prefill_ns):
+            return {
+                "model": request.get("model"), "created_at": created, "response": "", "done": True, "done_reason": "stop",
+                "context": list(range(len(context) + prompt_tokens + len(pieces))),
+                "total_duration": time.perf_counter_ns() - started, "load_duration": 0,
+                "prompt_eval_count": prompt_tokens, "prompt_eval_duration": prefill_ns,
+                "eval_count": len(pieces), "eval_duration": int(len(pieces) * self.token_latency * 1e9),
+            }
+
+        prefill_ns = time.perf_counter_ns() - started
+        if not request.get("stream", True):
+            time.sleep(self.token_latency * len(pieces))
+            obj = final(prefill_ns)
+            obj["response"] = response
+            self.send_json(obj)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for piece in pieces:
+                time.sleep(self.token_latency)
+                self.write_chunk({"model": request.get("model"), "created_at": created, "response": piece, "done": False})
+            self.write_chunk(final(prefill_ns))
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped reading, like llm_stream does once the json closes
+            self.close_connection = True
+
+    def write_chunk(self, obj):
+        line = json.dumps(obj).encode() + b"\n"
+        self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+        self.wfile.flush()
+
+def make_server(host="127.0.0.1", port=11435, latency=0.0, token_latency=0.0, response_tokens=32):
+    handler = type("ConfiguredFakeOllama", (FakeOllama,), {"latency": latency, "token_latency": token_latency, "response_tokens": response_tokens})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+# for benchmarks, port 0 picks a free one. returns the server and the url to put in OLLAMA_HOST
+def start_in_thread(latency=0.0, token_latency=0.0, response_tokens=32, host="127.0.0.1", port=0):
+    server = make_server(host, port, latency, token_latency, response_tokens)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Answer like ollama would, without a model")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=11435)
+    arg_parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    arg_parser.add_argument("--token-latency", type=float, default=0.0, help="seconds per generated token")
+    arg_parser.add_argument("--tokens", type=int, default=32, help="tokens per generic answer")
+    args = arg_parser.parse_args()
+    server = make_server(args.host, args.port, args.latency, args.token_latency, args.tokens)
+    print(f"fake ollama on http://{args.host}:{server.server_address[1]}, use OLLAMA_HOST=http://{args.host}:{server.server_address[1]}")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
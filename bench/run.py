@@ -0,0 +1,170 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+from bench.corpus import generate_corpus
+from bench.fake_ollama import start_in_thread
+
+# python -m bench.run [--files 365] [--json results.json]
+# makes a synthetic corpus, starts the fake ollama, and times the preprocessing and query paths of the scripts.
+# everything the scripts print goes to a buffer, we're timing the work not the terminal.
+
+QUERIES = ["dinner with anna", "running in the park", "coffee shop idea", "trip to tokyo", "deadline at the office", "what did jamie say"]
+
+def quiet():
+    return contextlib.redirect_stdout(io.StringIO())
+
+# runs fn repeat times, returns the median seconds and whatever the last run returned
+def measure(fn, repeat=1):
+    times = []
+    result = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        with quiet():
+            result = fn()
+        times.append(time.perf_counter() - start_time)
+    return statistics.median(times), result
+
+def row(name, seconds, corpus_bytes=None, items=None, unit="item"):
+    result = {"name": name, "seconds": seconds}
+    if corpus_bytes:
+        result["mb_per_second"] = corpus_bytes / 1024 / 1024 / seconds if seconds else None
+    if items:
+        result[f"ms_per_{unit}"] = seconds * 1000 / items
+        result["count"] = items
+    return result
+
+def run_benchmarks(args, workdir):
+    # OLLAMA_HOST has to be set before the ollama client gets imported, common imports it lazily so this is early enough
+    server, url = start_in_thread(args.latency, args.token_latency, args.tokens)
+    os.environ["OLLAMA_HOST"] = url
+
+    import common
+    import tfidf
+    import vectorchunk
+    import sentiment
+    import location
+    import graph
+    from store import ArtifactStore
+
+    journal_dir = os.path.join(workdir, "journals")
+    generate_corpus(journal_dir, args.files, args.bytes_per_file, seed=args.seed)
+
+    results = []
+
+    seconds, loaded_files = measure(lambda: common.loadfiles(journal_dir), args.repeat)
+    corpus_bytes = sum(len(x["content"]) for x in loaded_files)
+    results.append(row("loadfiles", seconds, corpus_bytes, len(loaded_files), "file"))
+
+    for chunker in common.CHUNKERS:
+        chunk_count = 0
+        def chunk_all():
+            nonlocal chunk_count
+            chunk_count = sum(len(common.CHUNKERS[chunker](x["content"])) for x in loaded_files)
+        seconds, _ = measure(chunk_all, args.repeat)
+        results.append(row(f"chunk {chunker}", seconds, corpus_bytes, chunk_count, "chunk"))
+
+    chunks = [chunk for info in loaded_files for chunk in common.chunks_for(info, common.CHUNKS_1024)]
+    # the stopwords load on the first call, keep that out of the timing
+    common.tokenize("warm up")
+    seconds, _ = measure(lambda: [common.tokenize(x) for x in chunks], args.repeat)
+    results.append(row("tokenize", seconds, corpus_bytes, len(chunks), "chunk"))
+
+    seconds, (index, chunk_store, _) = measure(lambda: tfidf.build_index(loaded_files), args.repeat)
+    results.append(row("tfidf build", seconds, corpus_bytes, len(chunks), "chunk"))
+
+    tokenized_queries = [common.tokenize(x) for x in QUERIES]
+    seconds, _ = measure(lambda: [tfidf.search(index, x) for x in tokenized_queries], args.repeat)
+    results.append(row("tfidf query", seconds, items=len(QUERIES), unit="query"))
+
+    store = ArtifactStore(os.path.join(workdir, "bench.db"))
+    seconds, (document_vectors, _, _) = measure(lambda: vectorchunk.load_vectors(loaded_files, store))
+    results.append(row("embed ingest", seconds, corpus_bytes, len(chunks), "chunk"))
+
+    embedded_queries = [common.embed(x) for x in QUERIES]
+    seconds, _ = measure(lambda: [vectorchunk.search(document_vectors, x) for x in embedded_queries], args.repeat)
+    results.append(row("vector query python", seconds, items=len(QUERIES), unit="query"))
+
+    if vectorchunk.np is not None:
+        # with rerank >= rows the prefilter keeps everything and binary is just exact search.
+        # the default corpus is smaller than vectorchunk's rerank, so keep a tenth of it unless told otherwise
+        rows = len(document_vectors)
+        rerank = args.rerank or min(vectorchunk.BINARY_RERANK, max(10, rows // 10))
+        seconds, vector_index = measure(lambda: vectorchunk.VectorIndex(document_vectors, rerank=rerank))
+        results.append(row("vector index build", seconds, items=rows, unit="chunk"))
+        for binary in [False, True]:
+            seconds, _ = measure(lambda: [vector_index.search(x, binary=binary) for x in embedded_queries], args.repeat)
+            results.append(row("vector query " + ("binary" if binary else "exact"), seconds, items=len(QUERIES), unit="query"))
+        # a date range only scans its slice of the date sorted matrix, a quarter of the corpus here
+        dates = sorted(x["date"] for x in loaded_files)
+        start, end = dates[len(dates) * 3 // 8], dates[len(dates) * 5 // 8]
+        seconds, _ = measure(lambda: [vector_index.search(x, start=start, end=end) for x in embedded_queries], args.repeat)
+        results.append(row("vector query date range", seconds, items=len(QUERIES), unit="query"))
+        # what the prefilter costs in results, the chunk text makes realistic queries
+        if rerank < rows:
+            recall_queries = embedded_queries + common.embed_batch(chunks[::max(1, len(chunks) // 50)][:50])
+            results.append({"name": "binary recall@10", "recall": vector_index.recall(recall_queries, k=10), "rerank": rerank, "rows": rows, "count": len(recall_queries)})
+        else:
+            # nothing got pruned, a recall of 1.0 here would say nothing about the prefilter
+            results.append({"name": "binary recall@10", "recall": None, "rerank": rerank, "rows": rows, "skipped": "rerank >= rows"})
+
+    # one llm call per chunk, so only on the first few files
+    subset = loaded_files[:args.extract_files]
+    subset_bytes = sum(len(x["content"]) for x in subset)
+    subset_chunks = sum(len(common.chunks_for(x, common.SMALLOVERLAP_8192)) for x in subset)
+    for name, extract in [
+        ("extract sentiment", sentiment.extract_sentiments),
+        ("extract location", location.extract_locations),
+        ("extract relationships", graph.extract_all_relationships),
+    ]:
+        # a fresh store each time, otherwise the second repeat finds everything done
+        seconds, _ = measure(lambda: extract(subset, ArtifactStore(os.path.join(workdir, f"{name}-{time.time_ns()}.db"))))
+        results.append(row(name, seconds, subset_bytes, subset_chunks, "chunk"))
+
+    server.shutdown()
+    store.close()
+    return results, corpus_bytes
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark ingestion and queries on a synthetic corpus, no model needed")
+    arg_parser.add_argument("--files", type=int, default=365)
+    arg_parser.add_argument("--bytes-per-file", type=int, default=4096)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the median is reported")
+    arg_parser.add_argument("--extract-files", type=int, default=20, help="files to run the llm extraction loops on")
+    arg_parser.add_argument("--latency", type=float, default=0.0, help="fake ollama seconds per request")
+    arg_parser.add_argument("--token-latency", type=float, default=0.0, help="fake ollama seconds per generated token")
+    arg_parser.add_argument("--tokens", type=int, default=32, help="fake ollama tokens per generic answer")
+    arg_parser.add_argument("--rerank", type=int, help="candidates the binary vector prefilter keeps for exact scoring, default is vectorchunk's or a tenth of the chunks if that's fewer. recall isn't reported when it's >= the chunk count")
+    arg_parser.add_argument("--json", help="write the results here, for comparing runs")
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results, corpus_bytes = run_benchmarks(args, workdir)
+
+    width = max(len(x["name"]) for x in results)
+    for result in results:
+        extra = ", ".join(f"{k} {v:.3f}" if isinstance(v, float) else f"{k} {v}" for k, v in result.items() if k not in ("name", "seconds"))
+        seconds = f"{result['seconds'] * 1000:10.2f} ms" if "seconds" in result else " " * 13
+        print(f"{result['name']:<{width}} {seconds}  {extra}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "time": time.time(),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "corpus_bytes": corpus_bytes,
+                "args": vars(args),
+                "results": results,
+            }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
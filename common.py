@@ -1,31 +1,55 @@
-import pickle
-import tempfile
-from ollama import generate
-import time
+import calendar
+import hashlib
 import os
 import re
 import math
 import sys
-from nltk.corpus import stopwords
+import threading
 
-from ollama import embeddings
+from tracing import TimerLogger, span, tracer
+
+# ollama and nltk are imported where they're used, so scripts that never call the model start up quickly
 LLM_MODEL = "llama3.2"
-EMBED_MODEL = 'nomic-embed-text'
+# backend:model, see embedding.py. "onnx:path/to/model" embeds in this process instead of asking ollama
+EMBED_MODEL = os.environ.get("EMBED_MODEL", "ollama:nomic-embed-text")
 
 chunk_size_bytes = 1024
 
+# how long ollama keeps the model (and its KV cache) loaded between calls
+# if it gets unloaded, every shared prefix has to be prefilled from scratch again
+KEEP_ALIVE = "30m"
+
 # don't quote me on this
 average_bytes_per_token = 3.5
 
-stop = stopwords.words('english')
+# how many tokens of retrieved text go into one prompt. leaves room in the context window for
+# the instructions, chat history and the response, so ollama doesn't quietly cut the prompt off
+context_token_budget = 2048
+
+# tokenizer used to count prompt tokens, should match LLM_MODEL: a local tokenizer.json, like the one in huggingface's
+# unsloth/Llama-3.2-1B-Instruct. optional, needs `pip install tokenizers`, and it's never downloaded, counting happens mid query.
+# without it we estimate from bytes, using what ollama reports back to correct the estimate
+TOKENIZER_FILE = os.environ.get("TOKENIZER_FILE", "")
 
 additional_terms = ['', 'got', 'really', 'pretty', 'bit', 'didnt', 'get', 'also', 'like', 'went', 'go', 'im']
-stop.extend(additional_terms)
+stop = None
+
+# loading the nltk corpus takes a while, only do it the first time something gets tokenized
+def stopword_set():
+    global stop
+    if stop is None:
+        from nltk.corpus import stopwords
+        stop = set(stopwords.words('english') + additional_terms)
+    return stop
 
 
 
 def final_prompt(context, query, use_history=None):
+    # static instructions go first so they stay a stable prefix across queries and `more` pages,
+    # the server only has to prefill what comes after them
     return f"""
+    Respond to the prompt at the end using the information in the context and chat history. Just reply in JSON format with a step-by-step explanation followed by a detailed and concise final response. Use just a single JSON object, e.g. {{"explanation": "1. [REASONING] 2. [REASONING] 3. [REASONING] ", "response": "[FINAL RESPONSE]"}}. Keep the "response" attribute a detailed string rather than a object or list.
+
     Context:
     === start context ===
     {context}
@@ -35,8 +59,6 @@ def final_prompt(context, query, use_history=None):
 
     Prompt:
     {query}
-
-    Respond to the prompt using the information in the context and chat history. Just reply in JSON format with a step-by-step explanation followed by a detailed and concise final response. Use just a single JSON object, e.g. {{"explanation": "1. [REASONING] 2. [REASONING] 3. [REASONING] ", "response": "[FINAL RESPONSE]"}}. Keep the "response" attribute a detailed string rather than a object or list.
     """
     #Respond to the prompt using the information in the context. Just reply in JSON format with a step-by-step explanation followed by a detailed and concise final response. Use just a single JSON object, e.g. {{"explanation": "1. The text mentions Robs birthday. 2. The text has the date 12/5. 3. ... ", "response": "Robs birthday is December 5th"}}.
     #Respond to the prompt using the information in the context. Do not explain anything, just reply in JSON format with the response and a step-by-step explanation. Just use a single JSON object, for example: {{"explanation": "1. The text mentions Robs birthday. 2. The text has the date 12/5. 3. ... ", "response": "Robs birthday is December 5th"}}.
@@ -68,66 +90,277 @@ def chunkenize_smalloverlap(content, size=chunk_size_bytes):
     return chunks
 
 
-def llm(prompt, log=False, user_log=False, format='', response_stream=False):
-    output = ""
-    stats = {}
-    if user_log:
-        print(f"USER>{prompt}")
-    if response_stream:
-        # basically parse JSON in place
-        response_end = False
-        print(f"{LLM_MODEL}>", end='', flush=True)
-        for part in generate(LLM_MODEL, prompt, stream=True, format=format):
-            if 'prompt_eval_duration' in part:
-                stats = part
-            # this indicates that they've already printed the "response": part, and now we want the rest of the text
-            # i assume the " is a token itself
-            # let me set newline to check this real quick
-            p = part['response']
-
-            if response_end == False and ('"response": "' in output or '"response":"' in output):
-                # bit hacky. not sure what to look for for the end of response
-                # ah, so '."' is a token, as well as '}'
-                # might be llama3.2 specific, but here goes
-                # so what we're looking for is that response has start, but not finished yet
-                if p == '."':
-                    #print('first condition hit')
-                    print('.', flush=True)
-                    response_end = True
-                elif p == '}':
-                    #print('second condition hit')
-                    response_end = True
-                else:
-                    print(p, end='', flush=True)
-            output += p
-        #print()
-
-    elif log:
-        print(f"{LLM_MODEL}>", end='')
-        for part in generate(LLM_MODEL, prompt, stream=True, format=format):
-            if 'prompt_eval_duration' in part:
-                stats = part
-            output += part['response']
-            print(part['response'], end='', flush=True)
-        print()
+# names for the different ways of chunking, chunk ids like "2020-01-01#3" only mean something together with one of these
+CHUNKS_1024 = "chunkenize"
+SMALLOVERLAP_8192 = "chunkenize_smalloverlap-8192"
+
+CHUNKERS = {
+    CHUNKS_1024: chunkenize,
+    SMALLOVERLAP_8192: lambda content: chunkenize_smalloverlap(content, 8192),
+}
+
+# chunks a loaded file once per chunker and keeps them on the file's dict,
+# so stages that run on the same loaded files don't all chunk everything again
+def chunks_for(info, chunker):
+    cached = info.setdefault("chunks", {})
+    if chunker not in cached:
+        with span("chunk", chunker=chunker, bytes=len(info["content"])):
+            cached[chunker] = CHUNKERS[chunker](info["content"])
+    return cached[chunker]
+
+
+def llm(prompt, log=False, user_log=False, format='', response_stream=False, context=None, options=None):
+    from ollama import generate
+    with span("llm", prompt_bytes=len(prompt)):
+        output = ""
+        stats = {}
+        if user_log:
+            print(f"USER>{prompt}")
+        if response_stream:
+            print(f"{LLM_MODEL}>", end='', flush=True)
+            pieces = llm_stream(prompt, format=format, context=context, options=options)
+            while True:
+                try:
+                    print(next(pieces), end='', flush=True)
+                except StopIteration as done:
+                    output, stats = done.value
+                    break
+            print(flush=True)
+
+        elif log:
+            print(f"{LLM_MODEL}>", end='')
+            parts = []
+            for part in generate(LLM_MODEL, prompt, stream=True, format=format, context=context, options=options, keep_alive=KEEP_ALIVE):
+                if 'prompt_eval_duration' in part:
+                    stats = part
+                parts.append(part['response'])
+                print(part['response'], end='', flush=True)
+            print()
+            output = ''.join(parts)
+
+        else:
+            stats = generate(LLM_MODEL, prompt, format=format, context=context, options=options, keep_alive=KEEP_ALIVE)
+            output = stats['response']
+
+        if not response_stream:
+            tracer.llm_stats(stats)
+
+    if context is None:
+        calibrate_tokens(prompt, stats)
+    return output, stats
 
+JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+# incremental JSON tokenizer, fed the model output a token at a time
+# only tracks what we need: nesting depth, strings/escapes, and keys of the top level object
+# feed() returns the newly decoded characters of the top level `field` string, if it's open
+class JsonStreamer:
+    def __init__(self, field='response'):
+        self.field = field
+        self.raw = []
+        self.stack = []
+        self.in_string = False
+        self.escape = None
+        self.high_surrogate = None
+        self.expect_key = False
+        self.reading_key = False
+        self.key = []
+        self.last_key = None
+        self.streaming = False
+        self.done = False
+
+    def feed(self, text):
+        out = []
+        for c in text:
+            if self.done:
+                break
+            self.raw.append(c)
+            if self.in_string:
+                self.__string_char(c, out)
+                continue
+            if c == '"':
+                self.in_string = True
+                top_level_object = len(self.stack) == 1 and self.stack[0] == '{'
+                self.reading_key = top_level_object and self.expect_key
+                self.streaming = top_level_object and not self.expect_key and self.last_key == self.field
+                self.key = []
+            elif c in '{[':
+                self.stack.append(c)
+                self.expect_key = c == '{'
+            elif c in '}]':
+                if self.stack:
+                    self.stack.pop()
+                if not self.stack:
+                    self.done = True
+                self.expect_key = False
+            elif c == ',' and self.stack == ['{']:
+                self.expect_key = True
+            elif c == ':' and self.stack == ['{']:
+                self.expect_key = False
+        return ''.join(out)
+
+    def __string_char(self, c, out):
+        if self.escape is not None:
+            self.escape += c
+            if self.escape[0] == 'u':
+                if len(self.escape) < 5:
+                    return
+                try:
+                    code = int(self.escape[1:], 16)
+                except ValueError:
+                    code = ord('?')
+                self.escape = None
+                # characters outside the BMP come in as two \u escapes
+                if 0xD800 <= code < 0xDC00:
+                    self.high_surrogate = code
+                    return
+                if 0xDC00 <= code < 0xE000 and self.high_surrogate is not None:
+                    code = 0x10000 + ((self.high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+                self.high_surrogate = None
+                self.__emit(chr(code), out)
+            else:
+                self.escape = None
+                self.__emit(JSON_ESCAPES.get(c, c), out)
+        elif c == '\\':
+            self.escape = ''
+        elif c == '"':
+            self.in_string = False
+            if self.reading_key:
+                self.last_key = ''.join(self.key)
+                self.reading_key = False
+            self.streaming = False
+        else:
+            self.__emit(c, out)
+
+    def __emit(self, c, out):
+        if self.reading_key:
+            self.key.append(c)
+        elif self.streaming:
+            out.append(c)
+
+    def text(self):
+        return ''.join(self.raw)
+
+# yields the "response" field of the JSON output as it's generated, and returns (output, stats) when done.
+# the JSON gets parsed as it comes in, and generation stops once the top level object is closed.
+# client is an ollama Client to send it through instead of the default one (the prefetcher's, so it can hang up)
+def llm_stream(prompt, format='json', context=None, options=None, client=None):
+    if client is None:
+        from ollama import generate
     else:
-        stats = generate(LLM_MODEL, prompt, format=format)
-        output = stats['response']
-
-    return output, stats
+        generate = client.generate
+    streamer = JsonStreamer()
+    stats = {}
+    tokens = 0
+    with span("generate", prompt_bytes=len(prompt)) as generate_span:
+        stream = generate(LLM_MODEL, prompt, stream=True, format=format, context=context, options=options, keep_alive=KEEP_ALIVE)
+        try:
+            for part in stream:
+                if 'prompt_eval_duration' in part:
+                    stats = part
+                tokens += 1
+                text = streamer.feed(part['response'])
+                if text:
+                    yield text
+                if streamer.done:
+                    break
+        finally:
+            # closing the stream drops the connection, which makes ollama stop decoding
+            stream.close()
+            tracer.llm_stats(stats)
+            generate_span.set(response_tokens=tokens)
+    if streamer.done and not stats:
+        # stopped before the final stats message, so this is all we know
+        stats = {'eval_count': tokens, 'done_reason': 'object_closed'}
+    return streamer.text(), stats
+
+# how many prompt tokens the server didn't have to prefill because it already had them cached
+# the returned context is the whole prompt + the response, so whatever wasn't evaluated was reused
+def prefill_saved(stats):
+    if not stats or 'context' not in stats or stats['context'] is None:
+        return 0
+    prompt_tokens = len(stats['context']) - (stats.get('eval_count') or 0)
+    return max(0, prompt_tokens - (stats.get('prompt_eval_count') or 0))
+
+# for asking a bunch of different questions about the same text (e.g. every dimension of one chunk)
+# the text is sent once as its own turn, then every question goes on top of the returned context,
+# so the server can reuse the KV state for the text instead of prefilling it again each time
+class PrefixSession:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.context = None
+        self.prefix_tokens = 0
+        self.saved_tokens = 0
+
+    def prime(self):
+        # the reply doesn't matter, just keep it short
+        _, stats = llm(f"{self.prefix}\n\nRead the text above, questions about it will follow. Just reply OK.", options={'num_predict': 4})
+        self.context = stats['context']
+        self.prefix_tokens = len(self.context)
+
+    def llm(self, prompt, log=False, user_log=False, format='', response_stream=False):
+        if self.context is None:
+            self.prime()
+        output, stats = llm(prompt, log, user_log, format, response_stream, context=self.context)
+        self.saved_tokens += prefill_saved(stats)
+        return output, stats
+
+tokenizer = None
+
+# the TOKENIZER_FILE tokenizer, loaded the first time. False without one. things that run for a while (server.py) call it on startup
+def load_tokenizer():
+    global tokenizer
+    if tokenizer is None:
+        tokenizer = False
+        if TOKENIZER_FILE:
+            try:
+                from tokenizers import Tokenizer
+                tokenizer = Tokenizer.from_file(TOKENIZER_FILE)
+            except Exception as e:
+                # not installed or not a tokenizer, just estimate
+                print(f"Could not load the tokenizer from {TOKENIZER_FILE}, estimating token counts instead: {e}")
+    return tokenizer
+
+def count_tokens(text):
+    tokenizer = load_tokenizer()
+    if tokenizer:
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+    return math.ceil(len(text.encode('utf-8')) / average_bytes_per_token)
+
+# ollama tells us exactly how many tokens the prompt was (context minus the response), so nudge the estimate towards that
+def calibrate_tokens(prompt, stats):
+    global average_bytes_per_token
+    if tokenizer or not stats or 'context' not in stats or stats['context'] is None:
+        return
+    prompt_tokens = len(stats['context']) - (stats.get('eval_count') or 0)
+    if prompt_tokens > 0:
+        observed = len(prompt.encode('utf-8')) / prompt_tokens
+        average_bytes_per_token = 0.8 * average_bytes_per_token + 0.2 * observed
 
 def tokenize(text):
-    space_split = [x.lower() for x in text.split()]
+    with span("tokenize"):
+        space_split = [x.lower() for x in text.split()]
 
-    space_split = [re.sub(r"[.,’\-\?&;#!:\(\)''\"]", '', x) for x in space_split]
-    space_split = [x for x in space_split if x not in stop ]
+        space_split = [re.sub(r"[.,’\-\?&;#!:\(\)''\"]", '', x) for x in space_split]
+        stop = stopword_set()
+        space_split = [x for x in space_split if x not in stop ]
 
-    return space_split
+        return space_split
 
 def embed(text):
-    embed_response = embeddings(model=EMBED_MODEL, prompt=text)
-    return embed_response["embedding"]
+    return embed_batch([text])[0]
+
+# one request (or forward pass) for a bunch of texts
+def embed_batch(texts):
+    from embedding import get_backend
+    backend = get_backend(EMBED_MODEL)
+    with span("embed", texts=len(texts), backend=backend.name):
+        return backend.embed(list(texts))
+
+# goes into the hash of anything made of embeddings, so vectors from different backends/models never get mixed
+def embed_fingerprint():
+    from embedding import get_backend
+    return get_backend(EMBED_MODEL).fingerprint
 
 def cos_similarity(vector_a, vector_b):
     # if you use the same model, this shouldn't be a problem
@@ -145,47 +378,132 @@ def cos_similarity(vector_a, vector_b):
     
     return sum_ab / (math.sqrt(sum_a2) * math.sqrt(sum_b2))
 
-def loadfiles():
-    journal_dir = 'sample_journals'
+def get_journal_dir(journal_dir=None):
+    if journal_dir is not None:
+        return journal_dir
     if len(sys.argv) > 1:
-        journal_dir = sys.argv[1]
+        return sys.argv[1]
+    return 'sample_journals'
+
+def journal_files(journal_dir):
     files_and_dirs = sorted(
         os.listdir(journal_dir)
         #key=lambda x: os.path.getmtime(os.path.join(journal_dir, x))
     )
     #files_and_dirs.sorted()
     pattern = re.compile("[12].*")
-    files_and_dirs = [ x for x in files_and_dirs if re.match(pattern, x)]
-
-    result = []
-    for file_path in files_and_dirs:
-        with open(journal_dir + '/' + file_path, 'r') as file:
-            date = os.path.basename(file_path).replace(".txt", "")
-            content = file.read()
-            result.append({"date": date, "content": content})
+    return [ x for x in files_and_dirs if re.match(pattern, x)]
+
+def loadfiles(journal_dir=None):
+    journal_dir = get_journal_dir(journal_dir)
+    with span("load") as load_span:
+        files_and_dirs = journal_files(journal_dir)
+
+        result = []
+        for file_path in files_and_dirs:
+            with open(journal_dir + '/' + file_path, 'r') as file:
+                date = os.path.basename(file_path).replace(".txt", "")
+                content = file.read()
+                result.append({"date": date, "content": content})
+        load_span.set(files=len(result), bytes=sum(len(x["content"]) for x in result))
     
     return result
 
-# Function to save progress using pickle
-#data is a dict of whatever
-def save_progress(save_file, data):
-    with tempfile.NamedTemporaryFile('wb', delete=False) as temp_file:
-        pickle.dump(data, temp_file)
-        temp_file_path = temp_file.name
-    os.replace(temp_file_path, save_file)
-
-class TimerLogger:
-    def __init__(self, label):
-        self.label = label
-        self.start_time = time.time()
-
-    def stop_and_log(self, corpus_size):
-        if self.start_time is None:
-            raise ValueError("Timer was not started.")
-        end_time = time.time()
-        elapsed_time = end_time - self.start_time
-        print(f"{self.label} stats: {elapsed_time * 1000:.2f} milliseconds, {corpus_size} bytes, {(elapsed_time * 1000 / corpus_size) * 1024 * 1024:.2f} milliseconds/MB, {(elapsed_time / corpus_size) * 1024*1024:.4f} seconds/MB")
-
+# changes whenever a journal file is added, removed or edited. used to tell if things built from all the files are stale
+def files_fingerprint(loaded_files):
+    digest = hashlib.sha256()
+    for info in loaded_files:
+        digest.update(info["date"].encode())
+        digest.update(hashlib.sha256(info["content"].encode()).digest())
+    return digest.hexdigest()
+
+# dates in queries, so "what did I do in summer 2019" only searches june to august 2019.
+# explicit filters (after:2019-06 before:2019-09-15) win over anything found in the text, and get taken out of it.
+# since:/until: include the period they name, after:/before: don't. dates:all turns the whole thing off for a query
+# ("what did I do in 2019 compared to now dates:all")
+MONTH_NAMES = r"jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?"
+SEASONS = {"spring": (3, 5), "summer": (6, 8), "fall": (9, 11), "autumn": (9, 11), "winter": (12, 2)}
+DATE_FILTER = re.compile(r"\b(after|since|before|until):((?:19|20)\d\d(?:-\d\d){0,2})\b", re.I)
+NO_DATES = re.compile(r"\bdates:all\b", re.I)
+ISO_DATE = re.compile(r"\b((?:19|20)\d\d)-(\d\d)-(\d\d)\b")
+# a bare year needs something like "in" before it, otherwise "walked 2000 steps" is a date.
+# since/from/until/... only bound one side, "since 2020" is 2020 onwards and not just 2020
+DATE_EXPRESSION = re.compile(r"\b(?:(?P<bound>since|from|after|until|till|to|through|before)\s+)?(?:(?P<season>spring|summer|fall|autumn|winter)|(?P<month>" + MONTH_NAMES + r")|in|during|around|between|and|of)?\s*(?:of\s+)?(?<![\w-])(?P<year>(?:19|20)\d\d)\b", re.I)
+# the side of the range each bound word sets, and whether the named period itself is in it
+DATE_BOUNDS = {"since": ("start", True), "from": ("start", True), "after": ("start", False),
+               "until": ("end", True), "till": ("end", True), "to": ("end", True), "through": ("end", True), "before": ("end", False)}
+
+def month_number(name):
+    return ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"].index(name[:3].lower()) + 1
+
+def month_range(year, first, last):
+    if last < first:
+        # winter runs into the next year
+        return f"{year:04d}-{first:02d}-01", f"{year + 1:04d}-{last:02d}-{calendar.monthrange(year + 1, last)[1]:02d}"
+    return f"{year:04d}-{first:02d}-01", f"{year:04d}-{last:02d}-{calendar.monthrange(year, last)[1]:02d}"
+
+# "2019", "2019-06" or "2019-06-15" -> first and last day it covers
+def period_bounds(value):
+    parts = [int(x) for x in value.split("-")]
+    if len(parts) == 1:
+        return month_range(parts[0], 1, 12)
+    if len(parts) == 2:
+        return month_range(parts[0], parts[1], parts[1])
+    return value, value
+
+def add_days(date, days):
+    import datetime
+    return (datetime.date.fromisoformat(date) + datetime.timedelta(days=days)).isoformat()
+
+# where a range starts (or ends) for a period, with or without the period itself
+def bound_date(side, inclusive, first, last):
+    if side == "start":
+        return first if inclusive else add_days(last, 1)
+    return last if inclusive else add_days(first, -1)
+
+# returns the query without the explicit filters, and the start and end date (YYYY-MM-DD, either can be None)
+def parse_date_range(query):
+    if NO_DATES.search(query):
+        return " ".join(NO_DATES.sub("", query).split()), None, None
+
+    start, end = None, None
+    for kind, value in DATE_FILTER.findall(query):
+        side, inclusive = DATE_BOUNDS[kind.lower()]
+        if side == "start":
+            start = bound_date(side, inclusive, *period_bounds(value))
+        else:
+            end = bound_date(side, inclusive, *period_bounds(value))
+    query = DATE_FILTER.sub("", query).strip()
+    if start or end:
+        return query, start, end
+
+    # otherwise cover everything the query mentions, "between march 2017 and june 2017" -> march 1st to june 30th,
+    # and "since"/"until" only move one end
+    starts = [x.group(0) for x in ISO_DATE.finditer(query)]
+    ends = list(starts)
+    for match in DATE_EXPRESSION.finditer(ISO_DATE.sub("", query)):
+        if not (match.group("bound") or match.group("season") or match.group("month") or match.group(0)[:1].isalpha()):
+            # just a number
+            continue
+        year = int(match.group("year"))
+        if match.group("season"):
+            first, last = month_range(year, *SEASONS[match.group("season").lower()])
+        elif match.group("month"):
+            month = month_number(match.group("month"))
+            first, last = month_range(year, month, month)
+        else:
+            first, last = month_range(year, 1, 12)
+        if match.group("bound"):
+            side, inclusive = DATE_BOUNDS[match.group("bound").lower()]
+            (starts if side == "start" else ends).append(bound_date(side, inclusive, first, last))
+        else:
+            starts.append(first)
+            ends.append(last)
+    if starts:
+        start = min(starts)
+    if ends:
+        end = max(ends)
+    return query, start, end
 
 def expand(query, type='tfidf', history=None):
     prompt = ""
@@ -210,34 +528,216 @@ Query: {query}"""
 # assuming this handles garbage collection automatically
 # this has a lot of queries, could probably more more stuff to this and avoid params
 class RetrievalHandler:
-    def __init__(self, query, full_scores, chunk_store, page_size=20, history=None):
+    def __init__(self, query, full_scores, chunk_store, page_size=20, history=None, token_budget=None, stride=int(chunk_size_bytes/2)):
         self.query = query
         self.full_scores = full_scores
         self.page_size = page_size
         self.chunk_store = chunk_store
         self.history = history
+        self.token_budget = token_budget if token_budget is not None else context_token_budget
+        # chunk i of a file starts at i*stride, chunkenize overlaps them by half
+        self.stride = stride
         # essentially pagination
         self.start = 0
+        self.last_page = []
+        self.last_page_tokens = 0
 
     def has_more(self):
         return self.start < len(self.full_scores)
 
-    # returns another prompt
+    def __raw_chunk(self, chunk_id):
+        date = chunk_id.rsplit('#', 1)[0]
+        return self.chunk_store[chunk_id][len(date)+1:]
+
+    # stitch overlapping/adjacent chunks of one file back into a single span of text
+    def __span_text(self, date, indices):
+        text = []
+        end = None
+        for i in sorted(indices):
+            offset = i * self.stride
+            raw = self.__raw_chunk(f"{date}#{i}")
+            if end is None or offset > end:
+                if end is not None:
+                    text.append("\n...\n")
+                text.append(raw)
+            else:
+                text.append(raw[end - offset:])
+            end = max(end or 0, offset + len(raw))
+        return date + "\n" + ''.join(text)
+
+    # fill the token budget with the best hits, merging hits from the same file that overlap or touch.
+    # a hit that bridges two spans joins them into one, so the text they share only goes in once
+    # returns the spans in score order
     def __get_next_page(self):
-        # we can probably put the whole thing together here
-        res = self.full_scores[self.start:(self.start+self.page_size)]
-        self.start += self.page_size
-        return res
+        reach = max(1, round(chunk_size_bytes / self.stride))
+        spans = []
+        total = 0
+        hits = 0
+        while self.has_more() and hits < self.page_size:
+            chunk_id, _ = self.full_scores[self.start]
+            date, i = chunk_id.rsplit('#', 1)
+            i = int(i)
+
+            touching = [x for x in spans if x["date"] == date and min(x["indices"]) - reach <= i <= max(x["indices"]) + reach]
+            indices = set().union(*(x["indices"] for x in touching)) | {i}
+            text = self.__span_text(date, indices)
+            tokens = count_tokens(text)
+            new_total = total - sum(x["tokens"] for x in touching) + tokens
+
+            if new_total > self.token_budget and spans:
+                # leave it for the next page rather than cutting anything off
+                break
+            if new_total > self.token_budget:
+                print(f"system>one chunk is {tokens} tokens, over the {self.token_budget} token budget")
+
+            if touching:
+                # the joined span stays where the best of them was
+                span = touching[0]
+                for x in touching[1:]:
+                    spans.remove(x)
+            else:
+                span = {"date": date}
+                spans.append(span)
+            span["indices"] = indices
+            span["text"] = text
+            span["tokens"] = tokens
+            total = new_total
+            hits += 1
+            self.start += 1
+
+        self.last_page = [f"{x['date']}#{i}" for x in spans for i in sorted(x["indices"])]
+        self.last_page_tokens = total
+        return spans
 
     def build_prompt(self):
-        scores = []
-        if self.has_more():
-            scores = self.__get_next_page()
-        chunk_context = '\n\n'.join([self.chunk_store[i] for i,_ in scores[::-1]])
-        prompt = final_prompt(chunk_context, self.query, use_history=self.history)
+        with span("prompt build") as build_span:
+            spans = []
+            if self.has_more():
+                spans = self.__get_next_page()
+            # best stuff goes last, closest to the question
+            chunk_context = '\n\n'.join([x["text"] for x in spans[::-1]])
+            prompt = final_prompt(chunk_context, self.query, use_history=self.history)
+            build_span.set(chunks=len(self.last_page), context_tokens=self.last_page_tokens)
         #print(prompt)
         return prompt
 
+# after an answer, build the next page and start generating it in the background so `more` comes back right away
+# ollama only runs it next to something else if it has a free slot (OLLAMA_NUM_PARALLEL > 1), otherwise it just queues.
+# to keep it from getting in the way: only one prefetch at a time, it's capped at max_tokens,
+# and it gets cancelled as soon as anything else needs the model
+class Prefetcher:
+    def __init__(self, format='json', max_tokens=1024):
+        self.format = format
+        self.max_tokens = max_tokens
+        self.holder = None
+        self.prompt = None
+        self.run = None
+
+    def start(self, holder):
+        self.cancel()
+        if not holder.has_more():
+            return
+        self.holder = holder
+        self.prompt = holder.build_prompt()
+        self.run = PrefetchRun()
+        self.run.thread = threading.Thread(target=self.__run, args=(self.prompt, self.run), daemon=True)
+        self.run.thread.start()
+
+    # everything it finds out goes on its own run, so one that got cancelled can't leave its page on a newer one
+    def __run(self, prompt, run):
+        pieces = llm_stream(prompt, format=self.format, options={'num_predict': self.max_tokens}, client=run.client)
+        try:
+            while True:
+                if run.cancelled.is_set():
+                    return
+                next(pieces)
+        except StopIteration as done:
+            output, stats = done.value
+        except Exception as e:
+            # hanging up on ollama ends up here too
+            if not run.cancelled.is_set():
+                print(f"system>prefetch failed: {e}")
+            return
+        finally:
+            pieces.close()
+        if run.cancelled.is_set():
+            return
+        run.stats = stats
+        # hit the token cap before finishing, not worth serving half an answer
+        if stats.get('done_reason') == 'length':
+            return
+        run.output = output
+
+    # the holder has already moved past the prefetched page, so check this too before saying there's nothing more
+    def pending(self, holder):
+        return self.holder is holder and self.prompt is not None
+
+    # returns (prompt, output, stats) for the next page of this holder.
+    # output is None if the prefetch didn't work out, then the prompt still needs to be generated
+    def take(self, holder):
+        if self.holder is not holder or self.prompt is None:
+            return None
+        self.run.thread.join()
+        self.run.client.close()
+        result = (self.prompt, self.run.output, self.run.stats)
+        self.holder = None
+        self.prompt = None
+        self.run = None
+        return result
+
+    # a new query came in, throw away whatever we had and stop ollama working on it
+    def cancel(self):
+        if self.run is not None:
+            self.run.cancel()
+        self.holder = None
+        self.prompt = None
+        self.run = None
+
+# one prefetch: its result, and an ollama client of its own that cancel() can hang up on.
+# the server uses one per generation too, to stop the ones whose client went away.
+# closing an httpx client from another thread doesn't wake up a read that's waiting on ollama (which can be
+# prefilling for seconds), shutting the socket down does, and ollama stops the generation once the connection is gone
+class PrefetchRun:
+    def __init__(self):
+        from ollama import Client
+        self.output = None
+        self.stats = {}
+        self.thread = None
+        self.cancelled = threading.Event()
+        self.sockets = []
+        self.lock = threading.Lock()
+
+        # httpcore reports the socket it connected through to a request's trace callback
+        def trace(event, info):
+            if event == "connection.connect_tcp.complete":
+                self.__add_socket(info["return_value"].get_extra_info("socket"))
+
+        def add_trace(request):
+            request.extensions["trace"] = trace
+
+        self.client = Client(event_hooks={"request": [add_trace]})
+
+    def __add_socket(self, sock):
+        with self.lock:
+            self.sockets.append(sock)
+            if self.cancelled.is_set():
+                # cancelled while it was still connecting
+                self.__hang_up(sock)
+
+    def __hang_up(self, sock):
+        import socket
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled.set()
+            for sock in self.sockets:
+                self.__hang_up(sock)
+        self.client.close()
+
 class ChatHistory:
     def __init__(self):
         self.history = []
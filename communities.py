@@ -0,0 +1,177 @@
+import hashlib
+import json
+import pickle
+
+import numpy as np
+
+from common import LLM_MODEL, llm, tokenize
+from store import open_store
+from tracing import span
+
+# groups of entities that mostly relate to each other, found offline with label propagation over the compiled graph,
+# each summarized once by the llm. broad questions ("what were the main themes of my friendships") get answered
+# from a few of those summaries in one generation instead of from 7 chunks.
+# a summary is saved under a hash of its community's edges, so it's only redone when those edges change,
+# and communities that come out the same after the graph grows keep theirs.
+
+LABEL_PROPAGATION_ITERATIONS = 30
+# smaller groups aren't themes
+MIN_COMMUNITY_NODES = 3
+# one llm call each, the biggest (by total edge weight) get summarized
+MAX_COMMUNITIES = 100
+# heaviest edges of a community that go in its summary prompt
+MAX_SUMMARY_EDGES = 80
+# summaries that go into one answer
+COMMUNITIES_PER_ANSWER = 8
+
+# bump when the summary prompt changes
+SUMMARY_VERSION = "1"
+summary_version = hashlib.sha256(pickle.dumps([LLM_MODEL, SUMMARY_VERSION])).hexdigest()[:7]
+
+# a community label per node. every node starts in its own, then repeatedly takes the label with the most edge
+# weight among its neighbours. only a random half of the nodes move each round, otherwise two halves of a
+# bipartite bit can keep swapping labels forever
+def label_propagation(knowledge_graph, edge_mask, iterations=LABEL_PROPAGATION_ITERATIONS, seed=0):
+    n = knowledge_graph.node_count
+    sources, targets = knowledge_graph.sources()[edge_mask], knowledge_graph.indices[edge_mask]
+    weights = knowledge_graph.weights[edge_mask].astype(np.float64)
+    # both directions, who you know counts whichever way round it was said
+    nodes = np.concatenate([sources, targets]).astype(np.int64)
+    neighbors = np.concatenate([targets, sources]).astype(np.int64)
+    weights = np.concatenate([weights, weights])
+
+    rng = np.random.default_rng(seed)
+    labels = np.arange(n, dtype=np.int64)
+    with span("label propagation", nodes=n, edges=len(sources)) as propagation_span:
+        for i in range(iterations):
+            # total weight per (node, neighbour's label), then the heaviest label per node, lowest label on ties
+            pairs, inverse = np.unique(nodes * n + labels[neighbors], return_inverse=True)
+            totals = np.bincount(inverse, weights)
+            pair_nodes, pair_labels = pairs // n, pairs % n
+            order = np.lexsort((pair_labels, -totals, pair_nodes))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = pair_nodes[order][1:] != pair_nodes[order][:-1]
+            best_nodes, best_labels = pair_nodes[order][first], pair_labels[order][first]
+
+            changing = labels[best_nodes] != best_labels
+            if not changing.any():
+                break
+            move = changing & (rng.random(len(best_nodes)) < 0.5)
+            labels[best_nodes[move]] = best_labels[move]
+        propagation_span.set(iterations=i + 1)
+    return labels
+
+# [{"nodes": node ids, "edges": edge ids, "weight": total edge weight}], biggest first
+def detect_communities(knowledge_graph, edge_mask, min_nodes=MIN_COMMUNITY_NODES, limit=MAX_COMMUNITIES):
+    labels = label_propagation(knowledge_graph, edge_mask)
+    sources = knowledge_graph.sources()
+    inside = edge_mask & (labels[sources] == labels[knowledge_graph.indices])
+    edges_by_label = {}
+    for edge in np.flatnonzero(inside).tolist():
+        edges_by_label.setdefault(int(labels[sources[edge]]), []).append(edge)
+
+    communities = []
+    for label, edges in edges_by_label.items():
+        edges = np.array(edges)
+        nodes = np.unique(np.concatenate([sources[edges], knowledge_graph.indices[edges]]))
+        if len(nodes) >= min_nodes:
+            communities.append({"nodes": nodes, "edges": edges, "weight": int(knowledge_graph.weights[edges].sum())})
+    communities.sort(key=lambda x: -x["weight"])
+    return communities[:limit]
+
+def edge_lines(knowledge_graph, edges):
+    sources = knowledge_graph.sources()
+    heaviest = edges[np.argsort(-knowledge_graph.weights[edges], kind="stable")]
+    return [
+        f"{knowledge_graph.nodes[sources[e]]} {knowledge_graph.predicates[knowledge_graph.predicate_ids[e]]} {knowledge_graph.nodes[knowledge_graph.indices[e]]} (x{knowledge_graph.weights[e]})"
+        for e in heaviest.tolist()
+    ]
+
+# what a summary is saved under, changes whenever an edge in the community does (or its weight)
+def community_fingerprint(knowledge_graph, community):
+    return hashlib.sha256("\n".join(sorted(edge_lines(knowledge_graph, community["edges"]))).encode()).hexdigest()[:16]
+
+def summarize_community(knowledge_graph, community):
+    lines = edge_lines(knowledge_graph, community["edges"])[:MAX_SUMMARY_EDGES]
+    dates = sorted({knowledge_graph.chunks[c].split('#')[0] for e in community["edges"].tolist()
+                    for c in knowledge_graph.provenance[knowledge_graph.provenance_ptr[e]:knowledge_graph.provenance_ptr[e+1]].tolist()})
+    prompt = f"""Relationships from a personal journal, written between {dates[0]} and {dates[-1]}, as "subject predicate object (xtimes mentioned)":
+{chr(10).join(lines)}
+
+These people, places and things form one group in the journal. Give the group a short title and summarize in a few sentences who or what is in it, how they relate to each other and to the author, and how that changed over time.
+Answer in JSON with the keys "title" and "summary".
+"""
+    response, stats = llm(prompt, format='json')
+    try:
+        obj = json.loads(response.strip())
+    except json.JSONDecodeError:
+        obj = {}
+    if not isinstance(obj, dict):
+        obj = {}
+    return {
+        "title": str(obj.get("title", "")) or lines[0],
+        "summary": str(obj.get("summary", "")),
+        "first": dates[0],
+        "last": dates[-1],
+    }
+
+# the summary of every community, from the store where the edges haven't changed and from the llm where they have.
+# summaries of communities that no longer exist get dropped from the store.
+# with cached_only (at query time) nothing gets summarized or dropped, communities without a summary are left out
+# and the second thing returned is how many those were
+def summarize_communities(knowledge_graph, store=None, cached_only=False):
+    store = store or open_store()
+    edge_mask = knowledge_graph.without_self_references()
+    communities = detect_communities(knowledge_graph, edge_mask)
+    degree = knowledge_graph.degree(edge_mask)
+
+    summaries = []
+    summarized = 0
+    missing = 0
+    for community in communities:
+        name = f"community:{community_fingerprint(knowledge_graph, community)}"
+        summary = store.get_blob(name, summary_version)
+        if summary is None and cached_only:
+            missing += 1
+            continue
+        if summary is None:
+            summary = summarize_community(knowledge_graph, community)
+            store.put_blob(name, summary_version, summary)
+            summarized += 1
+        summary["name"] = name
+        summary["weight"] = community["weight"]
+        # most connected first
+        members = community["nodes"][np.argsort(-degree[community["nodes"]], kind="stable")]
+        summary["members"] = [knowledge_graph.nodes[x] for x in members.tolist()]
+        summaries.append(summary)
+    if cached_only:
+        return summaries, missing
+    store.delete_blobs("community:", keep={x["name"] for x in summaries})
+    print(f"Loaded {len(summaries)} community summaries, {summarized} new.")
+    return summaries, missing
+
+# the summaries sharing the most words with the question, the biggest communities if none do
+def relevant_summaries(summaries, question, k=COMMUNITIES_PER_ANSWER):
+    words = set(tokenize(question))
+    def overlap(summary):
+        text = " ".join([summary["title"], summary["summary"], *summary["members"][:20]])
+        return len(words & set(tokenize(text)))
+    return sorted(summaries, key=lambda x: (-overlap(x), -x["weight"]))[:k]
+
+def global_prompt(summaries, question):
+    context = "\n\n".join(f"{x['title']} ({x['first']} to {x['last']}, {', '.join(x['members'][:8])}):\n{x['summary']}" for x in summaries)
+    return f"""Based on the following summaries of groups of people, places and things in a personal journal, answer the user's question.
+
+Summaries:
+{context}
+
+Question:
+{question}
+
+Provide a clear and concise answer in JSON format with a "response" key.
+
+Example Output:
+{{
+  "response": "Your answer here."
+}}
+"""
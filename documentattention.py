@@ -1,222 +1,137 @@
-import collections
-import pickle
+import argparse
+import json
 import os
-import hashlib
-
-from common import EMBED_MODEL, TimerLogger, chunkenize, cos_similarity, embed, final_prompt, llm, loadfiles, chunk_size_bytes, save_progress
-
-DOCUMENT_FREQUENCY = "DOCUMENT_FREQUENCY"
-INVERSE_DOCUMENT_FREQUENCY = "INVERSE_DOCUMENT_FREQUENCY"
-TERM_FREQUENCY = "TERM_FREQUENCY"
-
-preprocessing_timer = TimerLogger("Preprocessing")
-preprocessing_timer.start()
-
-corpus_size = 0
-
-ATTENTION_FILE = "attention.pkl"
-#Cool idea in theory but very very very slow
-DIMENSION_PROMPTS = {
-  "Summary": {
-    "document_prompt": "Summarize the main story or sequence of events.",
-    "query_prompt": "Summarize the main intent or request expressed in the text."
-  },
-  "People": {
-    "document_prompt": "Extract all key people mentioned in the text.",
-    "query_prompt": "Identify any people mentioned or referred to in the text."
-  },
-  "Places": {
-    "document_prompt": "Extract all key places mentioned in the text.",
-    "query_prompt": "Identify any places mentioned or referred to in the text."
-  },
-  "Organizations": {
-    "document_prompt": "Extract all key organizations mentioned in the text.",
-    "query_prompt": "Identify any organizations mentioned or referred to in the text."
-  },
-  "Objects": {
-    "document_prompt": "Extract all key objects mentioned in the text.",
-    "query_prompt": "Identify any objects or items mentioned or referred to in the text."
-  },
-  "Actions/Events": {
-    "document_prompt": "Identify all key actions or events described, focusing on central activities.",
-    "query_prompt": "Identify the key actions or events the text is interested in or is requesting information about."
-  },
-  "Concepts/Themes": {
-    "document_prompt": "Extract and explain key concepts, themes, or ideas that are central to the text but may not be tied to concrete entities.",
-    "query_prompt": "Extract and explain key concepts, themes, or ideas that are central to the text."
-  },
-  "Emotional Tone/Sentiment": {
-    "document_prompt": "Analyze the overall emotional tone of the text and any sentiments expressed towards specific entities (people, organizations, etc.).",
-    "query_prompt": "Analyze the overall emotional tone or sentiment of the text, and any sentiments expressed towards specific entities."
-  },
-  "Relationships": {
-    "document_prompt": "Identify and describe relationships between key people, places, organizations, and objects mentioned in the text.",
-    "query_prompt": "Identify and describe any relationships between people, places, organizations, or objects mentioned in the text."
-  },
-  "Cause-and-effect": {
-    "document_prompt": "Extract any cause-and-effect relationships described.",
-    "query_prompt": "Identify any cause-and-effect relationships implied or stated in the text."
-  },
-  "Motivations": {
-    "document_prompt": "Identify reasons or goals behind actions or feelings (motivations).",
-    "query_prompt": "Identify reasons or motivations behind the text."
-  },
-  "Time References": {
-    "document_prompt": "Extract any explicit or implicit references to time (dates, seasons, periods).",
-    "query_prompt": "Extract any explicit or implicit references to time (dates, seasons, periods) in the text."
-  },
-  "Significant Locations": {
-    "document_prompt": "Identify significant locations and explain their contextual importance.",
-    "query_prompt": "Identify any significant locations mentioned in the text and explain their relevance."
-  },
-  "Recurring Themes/Behaviors": {
-    "document_prompt": "Analyze the text for any recurring behaviors, themes, or trends.",
-    "query_prompt": "Identify any recurring behaviors, themes, or trends the user is interested in based on the text."
-  },
-  "Writing Style/Structure": {
-    "document_prompt": "Describe the writing style, tone, and notable structural elements of the text (e.g., narrative style, use of dialogue).",
-    "query_prompt": "Analyze the language style and tone of the text (e.g., formal, informal, urgent, inquisitive)."
-  },
-  "Cultural/Historical Context": {
-    "document_prompt": "Identify any cultural, historical, or societal contexts referenced and explain their significance to the text.",
-    "query_prompt": "Identify any cultural, historical, or societal contexts referenced in the text and explain their significance."
-  },
-  "Contradictions/Inconsistencies": {
-    "document_prompt": "Identify any contradictions or inconsistencies within the text and discuss their potential impact.",
-    "query_prompt": "Identify any contradictions or inconsistencies within the text and discuss their potential impact on understanding the request."
-  },
-  "Intended Audience/Purpose": {
-    "document_prompt": "Analyze the intended audience and purpose of the text, including any calls to action or persuasive elements.",
-    "query_prompt": "Analyze the intended purpose of the text, including any specific requests or desired outcomes."
-  },
-  "Ethical/Moral Dilemmas": {
-    "document_prompt": "Identify any ethical or moral dilemmas presented and discuss their significance.",
-    "query_prompt": "Identify any ethical or moral issues raised in the text and discuss their significance."
-  },
-  "Literary Devices/Techniques": {
-    "document_prompt": "Identify any rhetorical devices or literary techniques used (e.g., metaphors, similes, analogies) and discuss their effect.",
-    "query_prompt": "Identify any rhetorical devices or expressions used in the text and discuss their effect."
-  }
+import statistics
+import subprocess
+import sys
+import time
+
+# one entry point for all the scripts: python documentattention.py <command> [journal_dir]
+# only argparse and friends get imported up here. each command imports its own script when it runs,
+# so `--help` doesn't wait for ollama, nltk, matplotlib, pandas, folium...
+
+# command -> the script it runs, `startup` imports each of these to see what they cost
+COMMAND_MODULES = {
+    "index": "pipeline",
+    "query": "tfidf",
+    "sentiment": "sentiment",
+    "location": "location",
+    "graph": "graph",
+    "viz": "viz",
+    "outliers": "outliers",
 }
 
-
-
-# will possibly replace document_vectors
-dimension_vectors = {}
-# starting to think it might not be a good idea to store chunks, as we basically duplicate everything
-# but then again, the vectors take up WAY more space
-chunk_store = {}
-
-loaded_files = loadfiles()
-
-# Compute a hash to verify the state of the input files
-hash_input = pickle.dumps([chunk_size_bytes, EMBED_MODEL, DIMENSION_PROMPTS])
-hash_value = hashlib.sha256(hash_input).hexdigest()
-
-save_file = f"{hash_value[:7]}-{ATTENTION_FILE}"
-
-def extract_metadata(chunk, type='document'):
-    metadata = {}
-    suffix = " Do not explain anything or repeat the question, just answer. The response will be put into a vector db. Keep the response to a concise sentence."
-    for key, prompts in DIMENSION_PROMPTS.items():
-        full_prompt = f"{prompts[("document_prompt" if type=='document' else "query_prompt")]}{suffix}\n\nText:\n{chunk}"
-        response, stats = llm(full_prompt)
-        # should we keep original response rather than just embed?
-        metadata[key] = embed(response.strip())
-
-    # this just takes the chunk and embeds it. could be useful, we'll see. 
-    #metadata["raw"] = embed(chunk)
-    return metadata
-
-# Load embeddings from file if they exist and match the hash
-if os.path.exists(save_file):
-    with open(save_file, 'rb') as f:
-        try:
-            saved_data = pickle.load(f)
-            if saved_data.get("hash") == hash_value:
-                dimension_vectors = saved_data["dimension_vectors"]
-                print("Loaded existing embeddings from file.")
-            else:
-                print("Embeddings file found but hash mismatch. Starting fresh.")
-        except pickle.PickleError:
-            print("Error decoding embeddings file. Starting fresh.")
-else:
-    print("No existing embeddings file found. Starting fresh.")
-
-
-# Embed chunks and save to file after each document is processed
-chunks_processed = 0
-for info in loaded_files:
-    date = info["date"]
-    content = info["content"]
-    corpus_size += len(content)
-
-    chunks = chunkenize(content)
-
-    for i, chunk in enumerate(chunks):
-        id = f"{date}#{i}"
-        print(id)
-
-        chunk_store[id] = date + "\n" + chunk
-        # Skip if already embedded
-        if id in dimension_vectors:
-            # little trick so that it doesn't save repeatedly when we've already processed chunks in json, but haven't seen them here
-            if chunks_processed % 5 == 0:
-                chunks_processed += 1
-            continue
-
-        chunks_processed += 1
-        metadata = extract_metadata(chunk)
-
-        dimension_vectors[id] = metadata
-
-        # Save progress to file using a temporary file to avoid corruption. But don't do it too much, it slows down pre-processing
-        # save more frequently cuz each chunk is slow af
-        if chunks_processed % 5 == 0:
-            save_progress(save_file, {"hash": hash_value, "dimension_vectors": dimension_vectors})
-    print(date)
-
-# one last time
-save_progress(save_file, {"hash": hash_value, "dimension_vectors": dimension_vectors})
-
-preprocessing_timer.stop_and_log(corpus_size)
-
-while True:
-    query = input(">")
-    query_timer = TimerLogger("Query")
-    query_timer.start()
-
-    embedded_query = embed(query)
-
-    # we need to get query metadata
-    query_heads = extract_metadata(query, type='query')
-
-    # then we need to ask it one more time to get weights for each dimension, but for now we'll set all weights to 1
-
-    combined_scores = collections.Counter()
-
-    for k,v in dimension_vectors.items():
-        score = 0
-        for dim in DIMENSION_PROMPTS.keys():
-            sim = cos_similarity(query_heads[dim], v[dim])
-            print(k, query, dim, sim)
-            score += sim
-
-        combined_scores[k] = score
-        print(k, query, score)
-
-    sorted_combined_scores = combined_scores.most_common()
-    for chunk_id, score in sorted_combined_scores[:7]:
-        print(score, chunk_id, chunk_store[chunk_id][:100].replace('\n', ''))
-        #print(score, chunk_store[chunk_id])
-
-    chunk_context = '\n\n'.join([chunk_store[i] for i,s in sorted_combined_scores[:7][::-1]])
-
-    prompt = final_prompt(chunk_context, query)
-
-    out = llm(prompt, True, True, format='json')
-    # JSON isn't working perfectly. Rather than retrying, which could take fuckign forever, let's make the prompt better
-    #obj = json.loads(out.strip())
-    #print(obj["response"])
-
-    query_timer.stop_and_log(corpus_size)
+def index(args):
+    from pipeline import STAGES, run_pipeline, with_inputs
+    from common import loadfiles
+
+    stages = STAGES
+    if args.stages:
+        stages = with_inputs(STAGES, [x.strip() for x in args.stages.split(",") if x.strip()])
+    force = {x.strip() for x in args.force.split(",") if x.strip()}
+    ran, failed = run_pipeline(loadfiles(args.journal_dir), stages, force=force, workers=args.workers)
+    print(f"pipeline> ran {len(ran)} stages, {len(failed)} failed")
+    return 1 if failed else 0
+
+def query(args):
+    if args.mode == "vector":
+        import vectorchunk
+        vectorchunk.main(args.journal_dir)
+    else:
+        import tfidf
+        tfidf.main(args.journal_dir)
+
+def sentiment(args):
+    import sentiment
+    sentiment.main(args.journal_dir, show_year=args.by_year, output=args.output)
+
+def location(args):
+    import location
+    location.main(args.journal_dir)
+
+def graph(args):
+    import graph
+    graph.main(args.journal_dir)
+
+def viz(args):
+    import viz
+    viz.main(min_degree=args.min_degree, lod_by=args.lod_by)
+
+def outliers(args):
+    import outliers
+    outliers.main(args.journal_dir)
+
+# runs each thing in a fresh interpreter, since a module only gets imported once per process
+def time_command(command, runs):
+    times = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        times.append((time.perf_counter() - start_time) * 1000)
+    return statistics.median(times)
+
+def startup(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {"--help": time_command([sys.executable, os.path.join(here, "documentattention.py"), "--help"], args.runs)}
+    baseline = time_command([sys.executable, "-c", "pass"], args.runs)
+    for command, module in COMMAND_MODULES.items():
+        code = f"import sys; sys.path.insert(0, {here!r}); import {module}"
+        results[command] = time_command([sys.executable, "-c", code], args.runs)
+
+    print(f"python itself: {baseline:.1f} ms")
+    for name, ms in results.items():
+        print(f"{name:>10}: {ms:8.1f} ms ({ms - baseline:.1f} ms over bare python)")
+
+    # one line per run, so it can be compared over time
+    if args.json:
+        with open(args.json, "a") as f:
+            f.write(json.dumps({"time": time.time(), "python": baseline, "median_ms": results}) + "\n")
+
+def build_parser():
+    arg_parser = argparse.ArgumentParser(prog="documentattention", description="Ask questions about your journals with a local LLM")
+    arg_parser.add_argument("--trace", metavar="FILE", help="time everything and write a chrome trace here on exit, plus a summary table")
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+
+    def command(name, func, help, journal_dir=True):
+        sub = commands.add_parser(name, help=help)
+        if journal_dir:
+            sub.add_argument("journal_dir", nargs="?", default="sample_journals")
+        sub.set_defaults(func=func)
+        return sub
+
+    sub = command("index", index, "preprocess the journals, only redoing stages whose inputs changed")
+    sub.add_argument("--stages", help="comma separated, runs these and whatever they need. default is everything")
+    sub.add_argument("--force", default="", help="comma separated stages to rerun even if they're up to date")
+    sub.add_argument("--workers", type=int, default=4)
+
+    sub = command("query", query, "chat with the journals")
+    sub.add_argument("--mode", choices=["tfidf", "vector"], default="tfidf")
+
+    sub = command("sentiment", sentiment, "score happiness per chunk and plot it")
+    sub.add_argument("--by-year", action="store_true", help="one row per year instead of one long timeline")
+    sub.add_argument("--output", metavar="FILE", help="save the chart here (.png, .svg) instead of opening a window, works without a display")
+
+    command("location", location, "extract where each entry was written, plot a timeline and a map")
+    command("graph", graph, "extract relationships and query them")
+
+    sub = command("viz", viz, "draw the relationship graph graph.py extracted", journal_dir=False)
+    sub.add_argument("--min-degree", type=int, default=10)
+    sub.add_argument("--lod-by", choices=["degree", "weight"], default="degree", help="what decides which nodes make the smaller levels of detail")
+
+    command("outliers", outliers, "plot entry sizes over time")
+
+    sub = command("startup", startup, "measure how long each command takes just to start", journal_dir=False)
+    sub.add_argument("--runs", type=int, default=5)
+    sub.add_argument("--json", help="append the results to this file as a json line")
+
+    return arg_parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.trace:
+        from tracing import tracer
+        tracer.enable(args.trace)
+    return args.func(args) or 0
+
+if __name__ == "__main__":
+    sys.exit(main())
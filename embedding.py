@@ -0,0 +1,92 @@
+import os
+import threading
+
+# where embeddings come from. EMBED_MODEL in common.py says which backend and which model:
+#   "ollama:nomic-embed-text"  goes over http to ollama, like it always did
+#   "onnx:models/nomic-embed-text"  runs an onnx export in this process (needs `pip install onnxruntime tokenizers`),
+#       the folder needs model.onnx and tokenizer.json. no http/json per query, and it doesn't compete with generation on the ollama server
+# a name without a prefix is an ollama model.
+
+# threads onnxruntime uses per batch, 0 lets it decide
+EMBED_THREADS = int(os.environ.get("EMBED_THREADS", "0"))
+# texts per forward pass, bigger is faster per text but pads everything to the longest one
+ONNX_BATCH_SIZE = 16
+ONNX_MAX_TOKENS = 512
+
+class OllamaEmbedder:
+    def __init__(self, model):
+        self.model = model
+        self.name = "ollama:" + model
+        # only ollama existed before, so its vectors keep the version they were saved under
+        self.fingerprint = model
+
+    def embed(self, texts):
+        from ollama import embed as embed_many
+        return list(embed_many(model=self.model, input=texts)["embeddings"])
+
+class OnnxEmbedder:
+    def __init__(self, model_dir, threads=EMBED_THREADS, batch_size=ONNX_BATCH_SIZE):
+        import hashlib
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self.name = "onnx:" + model_dir
+        self.batch_size = batch_size
+        model_path = os.path.join(model_dir, "model.onnx")
+
+        # different weights give different vectors, so they're part of the version
+        digest = hashlib.sha256()
+        with open(model_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        self.fingerprint = f"onnx:{digest.hexdigest()[:16]}"
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {x.name for x in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(ONNX_MAX_TOKENS)
+        self.tokenizer.enable_padding()
+        # onnxruntime sessions are fine with concurrent run() calls, but the tokenizer's padding settings aren't per call
+        self.lock = threading.Lock()
+
+    def embed(self, texts):
+        import numpy as np
+
+        result = []
+        for start in range(0, len(texts), self.batch_size):
+            with self.lock:
+                encoded = self.tokenizer.encode_batch(texts[start:start+self.batch_size])
+            ids = np.array([x.ids for x in encoded], dtype=np.int64)
+            mask = np.array([x.attention_mask for x in encoded], dtype=np.int64)
+            feed = {"input_ids": ids, "attention_mask": mask}
+            if "token_type_ids" in self.input_names:
+                feed["token_type_ids"] = np.zeros_like(ids)
+            hidden = self.session.run(None, feed)[0]
+            # mean over the real tokens, then unit length, same as sentence-transformers does
+            weights = mask[:, :, None].astype(hidden.dtype)
+            pooled = (hidden * weights).sum(axis=1) / np.maximum(weights.sum(axis=1), 1e-9)
+            pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+            result.extend(pooled.tolist())
+        return result
+
+BACKENDS = {
+    "ollama": OllamaEmbedder,
+    "onnx": OnnxEmbedder,
+}
+
+backends = {}
+backends_lock = threading.Lock()
+
+# loading an onnx model takes a while, so there's one per name
+def get_backend(name):
+    kind, _, model = name.partition(":")
+    if not model or kind not in BACKENDS:
+        kind, model = "ollama", name
+    with backends_lock:
+        if name not in backends:
+            backends[name] = BACKENDS[kind](model)
+        return backends[name]
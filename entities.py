@@ -0,0 +1,125 @@
+import collections
+import functools
+import re
+
+# optional, without it the trigram counts are added up in a Counter
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# fuzzy matching for the entities and predicates graph.py extracts, so "Mom", "my mom" and "mother" are the same node
+# and "sara" finds "sarah". names get normalized once when the index is built, then each distinct name goes into
+# an inverted index from character trigrams to name ids. a query name is scored against every name sharing a trigram
+# with it in one go (dice coefficient on the trigram sets) and the best few above the threshold win.
+
+# dice similarity a stored name needs to count as the same thing
+FUZZY_THRESHOLD = 0.5
+# stored variants a query name can resolve to
+FUZZY_VARIANTS = 3
+
+# dropped from the front of entity names. only articles and the author's own, "his mom" isn't the author's mom
+DETERMINERS = {"a", "an", "the", "my", "our"}
+
+# words that mean the same person/thing but share no letters, trigrams can't help with these.
+# husband/wife/girlfriend/... aren't here, an ex and a spouse aren't the same person
+ENTITY_ALIASES = {
+    "mother": "mom",
+    "mum": "mom",
+    "mommy": "mom",
+    "father": "dad",
+    "daddy": "dad",
+    "grandmother": "grandma",
+    "grandfather": "grandpa",
+    "nyc": "new york",
+    "new york city": "new york",
+    "sf": "san francisco",
+}
+
+# the author talking about themselves. every entry would hang off these, so they're not worth following or drawing
+SELF_REFERENCES = ['null', 'none', 'me', 'myself', 'user', 'i', 'author', 'narrator', 'the narrator', 'self', 'the author', 'the writer']
+
+def words(name):
+    return re.findall(r"[\w']+", name.lower()) if isinstance(name, str) else []
+
+# the same few names come up over and over, so these are cached
+@functools.lru_cache(maxsize=65536)
+def normalize_entity(name):
+    parts = words(name)
+    while len(parts) > 1 and parts[0] in DETERMINERS:
+        parts = parts[1:]
+    name = " ".join(parts)
+    return ENTITY_ALIASES.get(name, name)
+
+@functools.lru_cache(maxsize=65536)
+def normalize_predicate(name):
+    return " ".join(words(name))
+
+# padded like postgres' pg_trgm, so the start and end of a name count for more
+def trigrams(name):
+    padded = f"  {name} "
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+# names that get discarded keep their id but stop matching, names added later go on the end
+class EntityDictionary:
+    def __init__(self, names):
+        self.names = []
+        self.ids = {}
+        self.postings = {}
+        self.sizes = np.zeros(0, dtype=np.int32) if np is not None else []
+        self.live = np.zeros(0, dtype=bool) if np is not None else []
+        self.add(sorted(set(names)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, names):
+        new = [name for name in dict.fromkeys(names) if name and name not in self.ids]
+        postings = collections.defaultdict(list)
+        sizes = []
+        for i, name in enumerate(new, len(self.names)):
+            self.ids[name] = i
+            grams = trigrams(name)
+            sizes.append(len(grams))
+            for gram in grams:
+                postings[gram].append(i)
+        self.names.extend(new)
+        if np is not None:
+            for gram, ids in postings.items():
+                ids = np.array(ids, dtype=np.int32)
+                self.postings[gram] = np.concatenate([self.postings[gram], ids]) if gram in self.postings else ids
+            self.sizes = np.concatenate([self.sizes, np.array(sizes, dtype=np.int32)])
+            self.live = np.concatenate([self.live, np.ones(len(new), dtype=bool)])
+        else:
+            for gram, ids in postings.items():
+                self.postings.setdefault(gram, []).extend(ids)
+            self.sizes.extend(sizes)
+            self.live.extend([True] * len(new))
+
+    def discard(self, names):
+        for name in names:
+            i = self.ids.pop(name, None)
+            if i is not None:
+                self.live[i] = False
+
+    # [(stored name, similarity)], best first. a name that's stored as is only resolves to itself
+    def resolve(self, name, limit=FUZZY_VARIANTS, threshold=FUZZY_THRESHOLD):
+        if name in self.ids:
+            return [(name, 1.0)]
+        grams = trigrams(name)
+        lists = [self.postings[gram] for gram in grams if gram in self.postings]
+        if not lists:
+            return []
+
+        if np is None:
+            shared = collections.Counter(i for ids in lists for i in ids if self.live[i])
+            scored = [(self.names[i], 2 * count / (len(grams) + self.sizes[i])) for i, count in shared.items()]
+            scored = [x for x in scored if x[1] >= threshold]
+            return sorted(scored, key=lambda x: (-x[1], x[0]))[:limit]
+
+        candidates, shared = np.unique(np.concatenate(lists), return_counts=True)
+        scores = 2 * shared / (len(grams) + self.sizes[candidates])
+        keep = (scores >= threshold) & self.live[candidates]
+        candidates, scores = candidates[keep], scores[keep]
+        best = np.argsort(-scores, kind="stable")[:limit]
+        return [(self.names[candidates[i]], float(scores[i])) for i in best]
@@ -1,61 +1,55 @@
 import collections
+import itertools
 import json
 import pickle
-import os
 import hashlib
-import tempfile
 
-from common import ChatHistory, RetrievalHandler, TimerLogger, chunkenize, chunkenize_smalloverlap, llm, loadfiles, chunk_size_bytes
+from common import ChatHistory, TimerLogger, chunks_for, llm, loadfiles, chunk_size_bytes
+from entities import SELF_REFERENCES, EntityDictionary, normalize_entity, normalize_predicate
+from store import SMALLOVERLAP_8192, open_store, split_key
 
 EMBED_MODEL = 'nomic-embed-text'
 
-preprocessing_timer = TimerLogger("Preprocessing")
-
-corpus_size = 0
-
-RELATIONSHIPS_FILE = "relationships.pkl"
-
-relationships_store = {}
-chunk_store = {}
-
-loaded_files = loadfiles()
+STAGE = "relationships"
 
 # Compute a hash to verify the state of the input files
 hash_input = pickle.dumps([chunk_size_bytes, EMBED_MODEL])
 hash_value = hashlib.sha256(hash_input).hexdigest()
 
-save_file = f"{hash_value[:7]}-{RELATIONSHIPS_FILE}"
-
-# Function to save progress using pickle
-def save_progress():
-    with tempfile.NamedTemporaryFile('wb', delete=False) as temp_file:
-        pickle.dump({"hash": hash_value, "relationships_store": relationships_store, }, temp_file)
-        temp_file_path = temp_file.name
-    os.replace(temp_file_path, save_file)
-
-# Load relationships from file if they exist and match the hash
-if os.path.exists(save_file):
-    with open(save_file, 'rb') as f:
-        try:
-            saved_data = pickle.load(f)
-            if saved_data.get("hash") == hash_value:
-                relationships_store = saved_data["relationships_store"]
-                #chunk_store = saved_data["chunk_store"]
-                print("Loaded existing relationships from file.")
-            else:
-                print("Relationships file found but hash mismatch. Starting fresh.")
-        except pickle.PickleError:
-            print("Error decoding relationships file. Starting fresh.")
-else:
-    print("No existing relationships file found. Starting fresh.")
+version = hash_value[:7]
+
+# the secondary indexes, name -> which parts of the (subject, predicate, object) key they're on
+TRIPLE_FIELDS = {
+    "s": (0,),
+    "p": (1,),
+    "o": (2,),
+    "sp": (0, 1),
+    "po": (1, 2),
+    "so": (0, 2),
+}
+# when there's no exact match, try these in order and stop at the first that finds something
+FALLBACK_TIERS = ["sp", "po", "so"]
+# bump when what TripleIndex keeps changes, so the saved one gets rebuilt
+INDEX_VERSION = "5"
+# bump when canonical_entity/canonical_key (or the normalization in entities.py) give different names.
+# the store keeps the names the llm gave, so only what's built from them (the triple index and the graph) gets redone.
+# 2: possessives other than the author's stay in names, partner words aren't merged
+CANONICAL_VERSION = "2"
+canonical_version = hashlib.sha256(pickle.dumps([version, CANONICAL_VERSION])).hexdigest()[:7]
+
+# every way the author refers to themselves is stored as this one entity
+AUTHOR = "i"
+SELF_NAMES = {normalize_entity(x) for x in SELF_REFERENCES} - {"null", "none"}
+# what the llm says when there's no subject/object, the relationship gets dropped
+NO_ENTITY = {"", "null", "none"}
 
 # Function to extract relationships in JSON format
 def extract_relationships(chunk):
-    prompt = f"""Extract all relationships between entities mentioned in the following text. For each relationship, provide it in JSON format with keys "subject", "predicate", and "object". Include all relevant relationships you can find. Do not include any text other than the JSON array of relationships.
-
-Text:
+    prompt = f"""Text:
 {chunk}
 
+Extract all relationships between entities mentioned in the text above. For each relationship, provide it in JSON format with keys "subject", "predicate", and "object". Include all relevant relationships you can find. Do not include any text other than the JSON array of relationships.
+
 Example Output:
 [
   {{"subject": "Entity1", "predicate": "relation", "object": "Entity2"}},
@@ -74,132 +68,385 @@ Example Output:
     print(relationships)
     return relationships
 
-# Process chunks and extract relationships
-chunks_processed = 0
-for info in loaded_files:
-    date = info["date"]
-    content = info["content"]
-    corpus_size += len(content)
+# what a chunk's text was when its relationships got extracted, so an edited file gets them extracted again
+def chunk_hash(chunk):
+    return hashlib.sha256(chunk.encode()).hexdigest()[:16]
+
+# Process chunks and extract relationships, skipping whatever is already in the store and hasn't changed since.
+# chunks past the end of a file that got shorter, and every chunk of a file that's gone, are dropped from the store
+# returns the relationships, the chunk store and the corpus size
+def extract_all_relationships(loaded_files, store=None):
+    store = store or open_store()
+    corpus_size = 0
+    chunk_store = {}
+
+    # Load relationships from the store
+    relationships_store = load_relationships(store)
+    print(f"Loaded {len(relationships_store)} existing relationships from the store.")
+    extracted = collections.defaultdict(list)
+    for key in relationships_store:
+        extracted[split_key(key)[0]].append(key)
+    retired = []
+
+    for info in loaded_files:
+        date = info["date"]
+        content = info["content"]
+        corpus_size += len(content)
+
+        chunks = chunks_for(info, SMALLOVERLAP_8192)
+        # committed before any llm call, the other pipeline stages write to the same file and wait on an open transaction
+        with store.db:
+            store.add_chunks(SMALLOVERLAP_8192, date, chunks)
+        retired.extend(key for key in extracted.get(date, ()) if split_key(key)[1] >= len(chunks))
+
+        for i, chunk in enumerate(chunks):
+            id = f"{date}#{i}"
+            print(id)
+            #print(chunk)
+
+
+            chunk_store[id] = date + "\n" + chunk
+
+            # Skip if already processed from the same text, entries from before the hashes were kept count as the same
+            text_hash = chunk_hash(chunk)
+            if id in relationships_store and relationships_store[id].get('hash', text_hash) == text_hash and not lossy_entry(relationships_store[id]):
+                continue
+
+            relationships = extract_relationships(chunk)
+
+            relationships_store[id] = {
+                'date': date,
+                'hash': text_hash,
+                'extracted': extracted_triples(relationships)
+            }
+            # Commit every chunk, so the write lock is never held across the next llm call
+            with store.db:
+                store.put(STAGE, version, SMALLOVERLAP_8192, id, relationships_store[id])
+        # print(date)
+
+    # files that were deleted (or renamed to another date)
+    loaded_dates = {info["date"] for info in loaded_files}
+    retired.extend(key for date, keys in extracted.items() if date not in loaded_dates for key in keys)
+
+    for key in retired:
+        del relationships_store[key]
+    with store.db:
+        store.delete(STAGE, version, SMALLOVERLAP_8192, retired)
+    if retired:
+        print(f"Dropped the relationships of {len(retired)} chunks past the end of their files or from files that are gone.")
+
+    # Commit the final progress
+    store.commit()
+
+    return relationships_store, chunk_store, corpus_size
+
+def canonical_entity(name):
+    name = normalize_entity(name)
+    if name in NO_ENTITY:
+        return ''
+    return AUTHOR if name in SELF_NAMES else name
+
+# (subject, predicate, object) as the llm gave them. it sometimes gives null or a list instead of a string, those count as ''
+def raw_key(rel):
+    def field(name):
+        value = rel.get(name)
+        return value.strip() if isinstance(value, str) else ''
+    return (field('subject'), field('predicate'), field('object'))
+
+# (subject, predicate, object) normalized, "My Mom" -> "mom", "myself" -> "i"
+def canonical_key(subject, predicate, obj):
+    return (canonical_entity(subject), normalize_predicate(predicate), canonical_entity(obj))
+
+def triple_key(rel):
+    return canonical_key(*raw_key(rel))
+
+def query_triples(query_relationships):
+    return [triple_key(rel) for rel in query_relationships if isinstance(rel, dict)]
+
+# what gets stored for a chunk instead of the llm's json: [(subject, predicate, object, count)] with the names as the llm
+# gave them, and the same triple said several times in the chunk kept once with how many times
+def extracted_triples(relationships):
+    counts = collections.Counter(raw_key(rel) for rel in relationships if isinstance(rel, dict))
+    return [(*key, count) for key, count in counts.items()]
+
+# the stored triples normalized, without the ones missing a part or that are just the author and themselves.
+# triples that only differed in how a name was written are one now, with their counts added up
+def canonical_triples(triples):
+    counts = {}
+    for subject, predicate, obj, count in triples:
+        key = canonical_key(subject, predicate, obj)
+        if not all(key) or key[0] == key[2] == AUTHOR:
+            continue
+        counts[key] = counts.get(key, 0) + count
+    return [(*key, count) for key, count in counts.items()]
+
+# a stored entry the way the triple index and the graph take it, {'date', 'triples': canonical triples}.
+# the names get canonicalized here rather than when they're stored, so a change to the normalization only needs
+# CANONICAL_VERSION bumped and not the llm run again. entries stored canonicalized already go through it again too
+def canonical_entry(data):
+    return {'date': data['date'], 'triples': canonical_triples(data['extracted'] if 'extracted' in data else data['triples'])}
+
+# entries stored with only their canonical triples went through the old normalization, which made "his mom" the author's
+# mom and husbands, wives, boyfriends and girlfriends one "partner". the names the llm gave are gone, so
+# re-canonicalizing can't split them again, they get extracted again instead
+def lossy_entry(data):
+    return 'extracted' not in data and 'relationships' not in data
+
+# chunks extracted before the triples were kept still have the llm's json and their text (which the chunks table has anyway).
+# rewritten the first time they're loaded, after that every entry is just its triples.
+# the pages this frees only go back to the disk with a vacuum, python pipeline.py --vacuum
+def compact_relationships(relationships_store, store):
+    compacted = 0
+    with store.db:
+        for chunk_id, data in relationships_store.items():
+            if 'relationships' not in data:
+                continue
+            relationships_store[chunk_id] = {'date': data['date'], 'hash': chunk_hash(data['chunk']), 'extracted': extracted_triples(data['relationships'])}
+            store.put(STAGE, version, SMALLOVERLAP_8192, chunk_id, relationships_store[chunk_id])
+            compacted += 1
+    if compacted:
+        print(f"Compacted the relationships of {compacted} chunks.")
+    return compacted
+
+def load_relationships(store=None):
+    store = store or open_store()
+    relationships_store = store.get(STAGE, version, SMALLOVERLAP_8192)
+    compact_relationships(relationships_store, store)
+    return relationships_store
+
+# what changed since something was built from the relationships with old_stamps ({chunk id: digest} from store.digests).
+# returns the stamps now, the chunk ids whose old relationships have to come out (edited and gone) and
+# {chunk id: canonical_entry} for the ones to put in (new and edited). everything is new when old_stamps is empty
+def relationship_changes(store, old_stamps, relationships_store=None):
+    stamps = store.digests(STAGE, version, SMALLOVERLAP_8192)
+    retired = [chunk_id for chunk_id, digest in old_stamps.items() if stamps.get(chunk_id) != digest]
+    changed = [chunk_id for chunk_id, digest in stamps.items() if old_stamps.get(chunk_id) != digest]
+    if relationships_store is not None:
+        added = {chunk_id: relationships_store[chunk_id] for chunk_id in changed}
+    else:
+        added = store.get(STAGE, version, SMALLOVERLAP_8192, changed)
+        # compacting rewrites them, which changes their digests
+        if compact_relationships(added, store):
+            stamps = store.digests(STAGE, version, SMALLOVERLAP_8192)
+    return stamps, retired, {chunk_id: canonical_entry(data) for chunk_id, data in added.items()}
 
-    chunks = chunkenize_smalloverlap(content, 8192)
+# Build an inverted index for quick lookup
+def build_inverted_index(relationships_store):
+    inverted_index = {}
+    for doc_id, data in relationships_store.items():
+        for subject, predicate, obj, _ in data['triples']:
+            inverted_index.setdefault((subject, predicate, obj), set()).add(doc_id)
+    return inverted_index
+
+# the exact triple index plus one per field and per pair of fields, so every kind of partial match is a dict lookup.
+# plus trigram dictionaries of the entity and predicate names, for resolving a query's names to the stored ones.
+# it keeps each doc's triples too, so a doc can be taken out again when its file gets edited
+class TripleIndex:
+    def __init__(self, relationships_store):
+        self.triples = {doc_id: [(subject, predicate, obj) for subject, predicate, obj, _ in data['triples']] for doc_id, data in relationships_store.items()}
+        self.inverted_index = build_inverted_index(relationships_store)
+        self.indexes = {name: {} for name in TRIPLE_FIELDS}
+        for key, docs in self.inverted_index.items():
+            for name, fields in TRIPLE_FIELDS.items():
+                self.indexes[name].setdefault(tuple(key[i] for i in fields), set()).update(docs)
+        self.entities = EntityDictionary([key[0] for key in self.inverted_index] + [key[2] for key in self.inverted_index])
+        self.predicates = EntityDictionary(key[1] for key in self.inverted_index)
+        # store.digests of what it was built from
+        self.stamps = {}
+
+    # (index, the part of key it's on) for the exact index and every secondary one
+    def entries(self, key):
+        yield self.inverted_index, key
+        for name, fields in TRIPLE_FIELDS.items():
+            yield self.indexes[name], tuple(key[i] for i in fields)
+
+    def remove(self, doc_id):
+        for key in self.triples.pop(doc_id, ()):
+            for index, part in self.entries(key):
+                docs = index.get(part)
+                if docs is not None:
+                    docs.discard(doc_id)
+                    if not docs:
+                        del index[part]
+
+    def add(self, doc_id, triples):
+        self.triples[doc_id] = [(subject, predicate, obj) for subject, predicate, obj, _ in triples]
+        for key in self.triples[doc_id]:
+            for index, part in self.entries(key):
+                index.setdefault(part, set()).add(doc_id)
+
+    # takes the retired docs out and puts the added ones ({doc id: data}) in. the dictionaries get the new names
+    # and lose the ones no triple has any more
+    def update(self, retired, added):
+        removed = [key for doc_id in retired for key in self.triples.get(doc_id, ())]
+        for doc_id in retired:
+            self.remove(doc_id)
+        for doc_id, data in added.items():
+            self.add(doc_id, data['triples'])
+
+        self.entities.discard({name for key in removed for name in (key[0], key[2]) if (name,) not in self.indexes["s"] and (name,) not in self.indexes["o"]})
+        self.predicates.discard({key[1] for key in removed if (key[1],) not in self.indexes["p"]})
+        self.entities.add(name for data in added.values() for subject, _, obj, _ in data['triples'] for name in (subject, obj))
+        self.predicates.add(predicate for data in added.values() for _, predicate, _, _ in data['triples'])
+
+    # the stored triples a query triple could mean, each field swapped for its closest stored variants
+    def variants(self, key):
+        subject, predicate, obj = key
+        def resolve(dictionary, name):
+            return [x for x, _ in dictionary.resolve(name)] or [name]
+        return list(itertools.product(resolve(self.entities, subject), resolve(self.predicates, predicate), resolve(self.entities, obj)))
+
+    # docs with a triple matching key on the fields of the named index, "spo" is the exact one
+    def lookup(self, name, key):
+        if name == "spo":
+            return self.inverted_index.get(key, ())
+        return self.indexes[name].get(tuple(key[i] for i in TRIPLE_FIELDS[name]), ())
+
+# the index is saved next to the relationships it was built from, and when some chunks changed since
+# (a new entry, an edited file) just those get taken out and put back in. the relationships are read from the store unless given
+def load_triple_index(store=None, relationships_store=None):
+    store = store or open_store()
+    index_version = hashlib.sha256(pickle.dumps([canonical_version, INDEX_VERSION])).hexdigest()[:16]
+    triple_index = store.get_blob("relationships_index", index_version)
+    stamps, retired, added = relationship_changes(store, triple_index.stamps if triple_index is not None else {}, relationships_store)
+    if triple_index is None:
+        triple_index = TripleIndex(added)
+    elif retired or added:
+        triple_index.update(retired, added)
+    else:
+        return triple_index
+    triple_index.stamps = stamps
+    store.put_blob("relationships_index", index_version, triple_index)
+    return triple_index
+
+# Find matching documents, exact triples first and then partial matches
+def find_matches(triple_index, query_relationships):
+    keys = [variant for key in query_triples(query_relationships) for variant in triple_index.variants(key)]
+    for name in ["spo"] + FALLBACK_TIERS:
+        matched_docs = set()
+        for key in keys:
+            matched_docs.update(triple_index.lookup(name, key))
+        if matched_docs:
+            return matched_docs
+    return set()
+
+# graph nodes for the entities a question mentions, {node id: how well the name matched}
+def query_seeds(triple_index, knowledge_graph, query_relationships):
+    seeds = {}
+    for subject, _, obj in query_triples(query_relationships):
+        for name in (subject, obj):
+            if not name or name == AUTHOR:
+                continue
+            for variant, similarity in triple_index.entities.resolve(name):
+                node = knowledge_graph.nodes.id(variant)
+                if node is not None:
+                    seeds[node] = max(similarity, seeds.get(node, 0.0))
+    return seeds
+
+# generates the answer, prints it and logs it
+def answer(prompt, chat_history):
+    out, stats = llm(prompt, False, False, format='json', response_stream=True)
+    try:
+        obj = json.loads(out.strip())
+        if 'response' in obj:
+            print(obj['response'])
+            chat_history.log_llm(obj['response'])
+        else:
+            print("No 'response' field in the output.")
+            chat_history.log_llm("")
+    except json.JSONDecodeError:
+        print("Failed to parse LLM output as JSON.")
+        chat_history.log_llm("")
 
-    for i, chunk in enumerate(chunks):
-        id = f"{date}#{i}"
-        print(id)
-        #print(chunk)
+def main(journal_dir=None):
+    preprocessing_timer = TimerLogger("Preprocessing")
 
+    relationships_store, chunk_store, corpus_size = extract_all_relationships(loadfiles(journal_dir))
 
-        chunk_store[id] = date + "\n" + chunk
+    preprocessing_timer.stop_and_log(corpus_size)
 
-        # Skip if already processed
-        if id in relationships_store:
-            if chunks_processed % 5 == 0:
-                chunks_processed += 1
-            continue
+    triple_index = load_triple_index(relationships_store=relationships_store)
 
-        chunks_processed += 1
-        relationships = extract_relationships(chunk)
+    # compile the graph now while the relationships are loaded anyway, so viz.py doesn't have to
+    import kgraph
+    knowledge_graph = kgraph.open_graph(relationships_store=relationships_store)
+    # the walk doesn't go through the author, they're in almost every entry
+    walk_mask = knowledge_graph.without_self_references()
 
-        relationships_store[id] = {
-            'date': date,
-            'chunk': chunk,
-            'relationships': relationships
-        }
+    # Initialize chat history
+    chat_history = ChatHistory()
 
-        # Save progress every 100 chunks
-        if chunks_processed % 5 == 0:
-            save_progress()
-    # print(date)
+    # loaded on the first broad question. only what the pipeline's summarize-communities stage already saved, summarizing is an llm call per community
+    community_summaries = None
 
-# Save the final progress
-save_progress()
+    while True:
+        query = input("user>")
 
-preprocessing_timer.stop_and_log(corpus_size)
+        if query == 'clear':
+            chat_history.clear()
+            print('system>cleared chat history')
+            continue
 
-# Build an inverted index for quick lookup
-inverted_index = {}
-for doc_id, data in relationships_store.items():
-    for rel in data['relationships']:
-        subject = rel.get('subject', '').lower()
-        predicate = rel.get('predicate', '').lower()
-        obj = rel.get('object', '').lower() if rel.get('object', '') else ''
-        key = (subject, predicate, obj)
-        inverted_index.setdefault(key, set()).add(doc_id)
-
-# Initialize chat history
-chat_history = ChatHistory()
-
-while True:
-    query = input("user>")
-    query_timer = TimerLogger("Query")
-
-    if query == 'clear':
-        chat_history.clear()
-        print('system>cleared chat history')
-        continue
-
-    elif query == 'more':
-        # Implement 'more' functionality if needed
-        print('system>\'more\' functionality is not implemented.')
-        continue
+        elif query == 'more':
+            # Implement 'more' functionality if needed
+            print('system>\'more\' functionality is not implemented.')
+            continue
 
-    else:
-        chat_history.log_user(query)
-        # Extract relationships from the query
-        query_relationships = extract_relationships(query)
+        elif query.startswith('global '):
+            # broad questions about the whole journal, answered from the community summaries
+            import communities
+            chat_history.log_user(query)
+            if community_summaries is None:
+                community_summaries, missing = communities.summarize_communities(knowledge_graph, cached_only=True)
+                if missing:
+                    print(f"system>{missing} communities haven't been summarized yet, run `python pipeline.py --stages summarize-communities` for them")
+            if not community_summaries:
+                print("system>no community summaries yet, run `python pipeline.py --stages summarize-communities` first")
+                # look again next time, the stage might have run by then
+                community_summaries = None
+                continue
+            question = query[len('global '):]
+            summaries = communities.relevant_summaries(community_summaries, question)
+            print(f"system>answering from {len(summaries)} community summaries: {', '.join(x['title'] for x in summaries)}")
+            answer(communities.global_prompt(summaries, question), chat_history)
 
-        # Find matching documents
-        matched_docs = set()
-        for rel in query_relationships:
-            subject = rel.get('subject', '').lower()
-            predicate = rel.get('predicate', '').lower()
-            obj = rel.get('object', '').lower()
-            key = (subject, predicate, obj)
-            if key in inverted_index:
-                matched_docs.update(inverted_index[key])
-
-        # If no exact matches, try partial matches
-        if not matched_docs:
-            # Try matching on subject and predicate
-            for rel in query_relationships:
-                subject = rel.get('subject', '').lower()
-                predicate = rel.get('predicate', '').lower()
-                for stored_key in inverted_index.keys():
-                    if stored_key[0] == subject and stored_key[1] == predicate:
-                        matched_docs.update(inverted_index[stored_key])
-
-            # Try matching on predicate and object
-            if not matched_docs:
-                for rel in query_relationships:
-                    predicate = rel.get('predicate', '').lower()
-                    obj = rel.get('object', '').lower()
-                    for stored_key in inverted_index.keys():
-                        if stored_key[1] == predicate and stored_key[2] == obj:
-                            matched_docs.update(inverted_index[stored_key])
-
-        # Retrieve and display the matched chunks
-        if matched_docs:
-            # Optionally, rank the matched documents
-            doc_scores = {}
-            for doc_id in matched_docs:
-                doc_scores[doc_id] = doc_scores.get(doc_id, 0) + 1  # Simple count of matches
-
-            sorted_docs = sorted(doc_scores.items(), key=lambda x: x[1], reverse=True)
-
-            for doc_id, score in sorted_docs[:7]:  # Show top 7 matches
-                data = relationships_store[doc_id]
-                print(f"Document ID: {doc_id}")
-                print(f"Date: {data['date']}")
-                print(f"Score: {score}")
-                print(f"Chunk: {data['chunk'][:500]}...")  # Print first 500 chars
-                print("\n")
         else:
-            print("No matching documents found.")
+            chat_history.log_user(query)
+            # Extract relationships from the query
+            query_relationships = extract_relationships(query)
+
+            # Find matching documents
+            matched_docs = find_matches(triple_index, query_relationships)
+
+            # plus whatever is a hop or two away from the people/things in the question, "who did I meet through jamie"
+            expanded_docs, finished = knowledge_graph.expand(query_seeds(triple_index, knowledge_graph, query_relationships), edge_mask=walk_mask)
+            if not finished:
+                print("system>ran out of time expanding the graph, using what was found so far")
+
+            # Retrieve and display the matched chunks
+            # direct matches first, then by path score
+            doc_scores = {doc_id: 1.0 for doc_id in matched_docs if doc_id in chunk_store}
+            for doc_id, score in expanded_docs:
+                if doc_id in chunk_store:
+                    doc_scores[doc_id] = doc_scores.get(doc_id, 0) + score
+
+            if doc_scores:
+                sorted_docs = sorted(doc_scores.items(), key=lambda x: (x[0] in matched_docs, x[1]), reverse=True)
+
+                for doc_id, score in sorted_docs[:7]:  # Show top 7 matches
+                    date, chunk = chunk_store[doc_id].split("\n", 1)
+                    print(f"Document ID: {doc_id}")
+                    print(f"Date: {date}")
+                    print(f"Score: {score}")
+                    print(f"Chunk: {chunk[:500]}...")  # Print first 500 chars
+                    print("\n")
+            else:
+                print("No matching documents found. For questions about the whole journal, start with 'global '.")
 
-        # Optionally, generate a final response using the matched chunks
-        if matched_docs:
-            chunk_context = '\n\n'.join([chunk_store[doc_id] for doc_id, _ in sorted_docs[:7][::-1]])
-            prompt = f"""Based on the following context, answer the user's question.
+            # Optionally, generate a final response using the matched chunks
+            if doc_scores:
+                chunk_context = '\n\n'.join([chunk_store[doc_id] for doc_id, _ in sorted_docs[:7][::-1]])
+                prompt = f"""Based on the following context, answer the user's question.
 
 Context:
 {chunk_context}
@@ -214,17 +461,7 @@ Example Output:
   "response": "Your answer here."
 }}
 """
-            out, stats = llm(prompt, False, False, format='json', response_stream=True)
-            try:
-                obj = json.loads(out.strip())
-                if 'response' in obj:
-                    print(obj['response'])
-                    chat_history.log_llm(obj['response'])
-                else:
-                    print("No 'response' field in the output.")
-                    chat_history.log_llm("")
-            except json.JSONDecodeError:
-                print("Failed to parse LLM output as JSON.")
-                chat_history.log_llm("")
-
-    # query_timer.stop_and_log(corpus_size)
+                answer(prompt, chat_history)
+
+if __name__ == "__main__":
+    main()
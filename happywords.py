@@ -1,16 +1,17 @@
 import collections
-import os
 import pickle
 import hashlib
 
-from common import EMBED_MODEL, TimerLogger, chunkenize_smalloverlap, loadfiles, tokenize, chunk_size_bytes
+from common import TimerLogger, chunkenize_smalloverlap, loadfiles, tokenize, chunk_size_bytes
+from store import open_store
+import tables
 
 preprocessing_timer = TimerLogger("Preprocessing")
 
 corpus_size = 0
 
-# Load the existing sentiment data from the previous sentiment file
-SENTIMENT_FILE = "my_sentiment.pkl"
+# Load the existing sentiment data from mysenti.py
+STAGE = "my_sentiment"
 
 sentiment_store = {}
 word_sentiment = collections.Counter()
@@ -18,31 +19,29 @@ word_counts = collections.Counter()
 
 loaded_files = loadfiles()
 
+# mysenti.py hashes the plain ollama model name
+EMBED_MODEL = 'nomic-embed-text'
+
 # Compute a hash to verify the state of the input files
 hash_input = pickle.dumps([chunk_size_bytes, EMBED_MODEL])
 hash_value = hashlib.sha256(hash_input).hexdigest()
 
-# Use the same sentiment file as before
-save_file = f"{hash_value[:7]}-{SENTIMENT_FILE}"
+# Use the same version as mysenti.py
+version = hash_value[:7]
 
 # not exactly stopwords, but not what I'm looking for and not relevant to specific thing
 ignore_words = ['good', 'day', 'one', 'today', 'back', 'much', 'wasnt', 'even', 'know', 'actually', 'would', 'took', 'dont', 'time', 'still', 'place', 'year', 'going', 'thats', 'could', 'well', 'around']
 #ignore_words = []
 
-# Load sentiment data from the existing sentiment file
-if os.path.exists(save_file):
-    with open(save_file, 'rb') as f:
-        try:
-            saved_data = pickle.load(f)
-            if saved_data.get("hash") == hash_value:
-                sentiment_store = saved_data["sentiment_store"]
-                print("Loaded existing sentiment data from file.")
-            else:
-                print("Sentiment file found but hash mismatch. Starting fresh.")
-        except pickle.PickleError:
-            print("Error decoding sentiment file. Starting fresh.")
+# Load sentiment data from the store, just the chunk keys and scores out of the columnar table
+store = open_store()
+scores = tables.load_frame(STAGE, version, ["key", "sentiment_score"], store)
+# chunk id -> score, None where there's none
+sentiment_store = dict(zip(scores["key"], scores["sentiment_score"].astype(object).where(scores["sentiment_score"].notna(), None)))
+if sentiment_store:
+    print(f"Loaded {len(sentiment_store)} existing sentiment scores from the store.")
 else:
-    print("No existing sentiment file found. Please run the sentiment analysis code first.")
+    print("No sentiment data in the store. Please run the sentiment analysis code first.")
     exit()
 
 # Process chunks to build word sentiment mappings
@@ -61,7 +60,7 @@ for info in loaded_files:
 
         # Check if this chunk ID is in sentiment_store
         if id in sentiment_store:
-            sentiment_score = sentiment_store[id]['sentiment_score']
+            sentiment_score = sentiment_store[id]
 
             # Normalize sentiment score
             if sentiment_score is not None:
@@ -0,0 +1,359 @@
+import collections
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from graph import canonical_entry, canonical_version, relationship_changes
+from store import open_store
+from tracing import span
+
+# the relationship graph compiled once into flat arrays, so graph.py and viz.py don't each rebuild it from the pickled
+# relationships every run. nodes and predicates are interned to integer ids and the edges are in CSR form:
+# the edges out of node n are indices[indptr[n]:indptr[n+1]], sorted by target, with a weight (how many times the
+# relationship was extracted), the id of its most common predicate, and the chunks it came from
+# (provenance[provenance_ptr[e]:provenance_ptr[e+1]], ids into the chunk list, and counts, how many times in each).
+# the same edges are also indexed by target (rindptr/rindices/redges), so a node's incoming edges are a slice too.
+# it's saved as .npy files next to the store and loaded with mmap, so opening it only reads what gets touched.
+# every save is a directory of its own, and the graph path is a symlink to the current one.
+# the saved graph remembers a digest of every chunk's relationships it was built from, and when some changed
+# (a new entry, an edited file) only those chunks get taken out and put back in, the rest of the arrays are reused.
+
+# bump when the arrays change, so the saved graph gets recompiled
+GRAPH_FORMAT = "4"
+
+ARRAYS = ["indptr", "indices", "weights", "predicate_ids", "provenance_ptr", "provenance", "counts", "rindptr", "rindices", "redges"]
+STRINGS = ["nodes", "predicates", "chunks"]
+
+# expand() defaults. hops out from the query's entities, edges followed per node (the heaviest ones),
+# the weight an edge needs to be followed at all, and how much a path's score drops per hop
+EXPAND_HOPS = 2
+EXPAND_FANOUT = 16
+EXPAND_MIN_WEIGHT = 1
+HOP_DECAY = 0.5
+# seconds, expand() returns whatever it has when it runs out
+EXPAND_BUDGET = 0.05
+
+# a list of strings kept as one utf-8 blob plus offsets, so it can be mmapped like the rest
+class Strings:
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+        self.ids = None
+
+    @classmethod
+    def from_list(cls, strings):
+        encoded = [x.encode() for x in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(x) for x in encoded])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]].tobytes().decode()
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    # string -> id, only made when something looks a string up
+    def index(self):
+        if self.ids is None:
+            self.ids = {x: i for i, x in enumerate(self)}
+        return self.ids
+
+    def id(self, string):
+        return self.index().get(string)
+
+    # these plus the strings it doesn't have yet on the end, so the ids that were already handed out stay the same
+    def extend(self, strings):
+        ids = self.index()
+        new = [x for x in dict.fromkeys(strings) if x not in ids]
+        if not new:
+            return self
+        added = Strings.from_list(new)
+        result = Strings(np.concatenate([self.data, added.data]), np.concatenate([self.offsets, added.offsets[1:] + self.offsets[-1]]))
+        result.ids = dict(ids)
+        result.ids.update((x, len(self) + i) for i, x in enumerate(new))
+        return result
+
+class KnowledgeGraph:
+    def __init__(self, arrays, strings):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        for name in STRINGS:
+            setattr(self, name, strings[name])
+
+    @property
+    def node_count(self):
+        return len(self.indptr) - 1
+
+    @property
+    def edge_count(self):
+        return len(self.indices)
+
+    # source node of every edge, the row part of the CSR spelled out
+    def sources(self):
+        return np.repeat(np.arange(self.node_count, dtype=np.int32), np.diff(self.indptr))
+
+    # edges in plus edges out, like networkx's DiGraph.degree. edge_mask leaves edges out of the count
+    def degree(self, edge_mask=None):
+        sources, targets = self.sources(), self.indices
+        if edge_mask is not None:
+            sources, targets = sources[edge_mask], targets[edge_mask]
+        return np.bincount(sources, minlength=self.node_count) + np.bincount(targets, minlength=self.node_count)
+
+    # which edges don't touch the author talking about themselves (entities.SELF_REFERENCES), those would connect everything
+    def without_self_references(self):
+        from entities import SELF_REFERENCES, normalize_entity
+
+        excluded = np.zeros(self.node_count, dtype=bool)
+        for name in SELF_REFERENCES:
+            node = self.nodes.id(normalize_entity(name))
+            if node is not None:
+                excluded[node] = True
+        return ~excluded[self.sources()] & ~excluded[self.indices]
+
+    # the edges touching a node in either direction, and the node at the other end of each
+    def incident(self, node):
+        out_start, out_end = self.indptr[node], self.indptr[node+1]
+        in_start, in_end = self.rindptr[node], self.rindptr[node+1]
+        edges = np.concatenate([np.arange(out_start, out_end), self.redges[in_start:in_end]])
+        neighbors = np.concatenate([self.indices[out_start:out_end], self.rindices[in_start:in_end]])
+        return edges, neighbors
+
+    # breadth first out from seeds ({node id: score}), at most hops deep and fanout edges per node, only edges with at least min_weight.
+    # a path's score is the seed's score times HOP_DECAY * weight / (weight + 1) for every edge on it. only the best path to each
+    # node is followed, and every chunk an edge on one of those was extracted from gets its score. edge_mask leaves edges out of the walk
+    # (without_self_references(), otherwise two hops from anyone goes through the author to everything they wrote about).
+    # returns ([(chunk_id, score)] best first, whether it got through every hop before the budget ran out)
+    def expand(self, seeds, hops=EXPAND_HOPS, fanout=EXPAND_FANOUT, min_weight=EXPAND_MIN_WEIGHT, budget=EXPAND_BUDGET, edge_mask=None):
+        deadline = time.perf_counter() + budget
+        best = dict(seeds)
+        frontier = sorted(seeds.items(), key=lambda x: -x[1])
+        chunk_scores = collections.defaultdict(float)
+        finished = True
+
+        with span("expand", seeds=len(seeds), hops=hops) as expand_span:
+            for hop in range(hops):
+                next_frontier = {}
+                for node, score in frontier:
+                    if time.perf_counter() > deadline:
+                        finished = False
+                        break
+                    edges, neighbors = self.incident(node)
+                    if edge_mask is not None:
+                        keep = edge_mask[edges]
+                        edges, neighbors = edges[keep], neighbors[keep]
+                    weights = self.weights[edges]
+                    if min_weight > 1:
+                        keep = weights >= min_weight
+                        edges, neighbors, weights = edges[keep], neighbors[keep], weights[keep]
+                    # hubs like "work" touch everything, only their strongest edges are worth following
+                    if len(edges) > fanout:
+                        top = np.argpartition(-weights, fanout)[:fanout]
+                        edges, neighbors, weights = edges[top], neighbors[top], weights[top]
+                    path_scores = score * HOP_DECAY * weights / (weights + 1.0)
+
+                    for edge, neighbor, path_score in zip(edges.tolist(), neighbors.tolist(), path_scores.tolist()):
+                        # going back the way we came, or a worse way to somewhere already reached
+                        if path_score <= best.get(neighbor, 0.0):
+                            continue
+                        best[neighbor] = path_score
+                        next_frontier[neighbor] = path_score
+                        for chunk in self.provenance[self.provenance_ptr[edge]:self.provenance_ptr[edge+1]].tolist():
+                            chunk_scores[chunk] += path_score
+                if not finished or not next_frontier:
+                    break
+                frontier = sorted(next_frontier.items(), key=lambda x: -x[1])
+            expand_span.set(nodes=len(best), chunks=len(chunk_scores), finished=finished)
+
+        ranked = sorted(chunk_scores.items(), key=lambda x: -x[1])
+        return [(self.chunks[chunk], score) for chunk, score in ranked], finished
+
+    def edge_chunks(self, edge):
+        return [self.chunks[i] for i in self.provenance[self.provenance_ptr[edge]:self.provenance_ptr[edge+1]]]
+
+    # a new graph without what the retired chunks (ids) contributed and with the added ones ({chunk id: [(subject, predicate, object, count)]}).
+    # an edited chunk is in both. the nodes, predicates and chunks already there keep their ids and new ones go on the end, so
+    # whatever was saved by node id (viz.py's layouts) still lines up. everything is worked out on (edge, chunk, count) rows:
+    # the old graph's rows minus the retired chunks' plus the new ones, grouped into edges again
+    def patch(self, retired, added):
+        triples = [(chunk_id, *triple) for chunk_id, chunk_triples in added.items() for triple in chunk_triples]
+        nodes = self.nodes.extend(name for _, subject, _, obj, _ in triples for name in (subject, obj))
+        predicates = self.predicates.extend(predicate for _, _, predicate, _, _ in triples)
+        chunks = self.chunks.extend(added)
+        node_ids, predicate_ids, chunk_ids = nodes.index(), predicates.index(), chunks.index()
+        n = len(nodes)
+
+        # the old rows that stay
+        old_sources = self.sources().astype(np.int64)
+        old_keys = old_sources * n + self.indices
+        row_edges = np.repeat(np.arange(self.edge_count), np.diff(self.provenance_ptr))
+        retired_chunks = np.zeros(len(chunks), dtype=bool)
+        retired_chunks[[chunk_ids[x] for x in retired if x in chunk_ids]] = True
+        keep = ~retired_chunks[self.provenance]
+        row_keys = [old_keys[row_edges[keep]]]
+        row_chunks = [np.asarray(self.provenance)[keep]]
+        row_counts = [np.asarray(self.counts)[keep]]
+
+        # and the new ones
+        new_keys = np.array([node_ids[subject] * n + node_ids[obj] for _, subject, _, obj, _ in triples], dtype=np.int64)
+        new_predicates = np.array([predicate_ids[predicate] for _, _, predicate, _, _ in triples], dtype=np.int64)
+        new_counts = np.array([count for *_, count in triples], dtype=np.int64)
+        row_keys.append(new_keys)
+        row_chunks.append(np.array([chunk_ids[chunk_id] for chunk_id, *_ in triples], dtype=np.int64))
+        row_counts.append(new_counts)
+
+        # the same triple under different predicates is one row per chunk
+        keys, row_chunks, counts = np.concatenate(row_keys), np.concatenate(row_chunks), np.concatenate(row_counts)
+        order, starts = group_pairs(keys, row_chunks)
+        keys, row_chunks, counts = keys[order][starts], row_chunks[order][starts], np.add.reduceat(counts[order], starts) if len(starts) else counts[:0]
+        edge_keys, row_edges = np.unique(keys, return_inverse=True)
+
+        # an edge that's still there from before keeps its predicate, one that only new chunks have gets their most common one
+        predicate_of = np.zeros(len(edge_keys), dtype=np.int64)
+        old_position = np.searchsorted(old_keys, edge_keys)
+        in_old = old_position < len(old_keys)
+        in_old[in_old] = old_keys[old_position[in_old]] == edge_keys[in_old]
+        has_old = np.zeros(len(edge_keys), dtype=bool)
+        has_old[np.searchsorted(edge_keys, np.unique(row_keys[0]))] = True
+        use_old = in_old & has_old
+        predicate_of[use_old] = np.asarray(self.predicate_ids)[old_position[use_old]]
+        if len(new_keys):
+            order, starts = group_pairs(new_keys, new_predicates)
+            totals = np.add.reduceat(new_counts[order], starts)
+            pair_keys, pair_predicates = new_keys[order][starts], new_predicates[order][starts]
+            # heaviest predicate per edge, the lowest id on ties
+            order = np.lexsort((pair_predicates, -totals, pair_keys))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = pair_keys[order][1:] != pair_keys[order][:-1]
+            best_keys, best_predicates = pair_keys[order][first], pair_predicates[order][first]
+            edges = np.searchsorted(edge_keys, best_keys)
+            fill = ~use_old[edges]
+            predicate_of[edges[fill]] = best_predicates[fill]
+
+        sources = (edge_keys // n).astype(np.int32)
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(sources, minlength=n))
+        provenance_ptr = np.zeros(len(edge_keys) + 1, dtype=np.int64)
+        provenance_ptr[1:] = np.cumsum(np.bincount(row_edges, minlength=len(edge_keys)))
+        arrays = {
+            "indptr": indptr,
+            "indices": (edge_keys % n).astype(np.int32),
+            "weights": np.bincount(row_edges, counts, minlength=len(edge_keys)).astype(np.int32),
+            "predicate_ids": predicate_of.astype(np.int32),
+            "provenance_ptr": provenance_ptr,
+            # rows are already sorted by edge and then chunk
+            "provenance": row_chunks.astype(np.int32),
+            "counts": counts.astype(np.int32),
+        }
+        arrays.update(reverse_arrays(indptr, arrays["indices"], sources))
+        return KnowledgeGraph(arrays, {"nodes": nodes, "predicates": predicates, "chunks": chunks})
+
+# sorts (key, chunk) pairs and adds up the counts of the ones that are the same, returns the order they were sorted in and where each new group starts
+def group_pairs(keys, chunks):
+    order = np.lexsort((chunks, keys))
+    keys, chunks = keys[order], chunks[order]
+    starts = np.ones(len(keys), dtype=bool)
+    starts[1:] = (keys[1:] != keys[:-1]) | (chunks[1:] != chunks[:-1])
+    return order, np.flatnonzero(starts)
+
+# the edges again but grouped by target: rindptr like indptr, rindices the source of each, redges the edge's id
+def reverse_arrays(indptr, indices, sources):
+    order = np.argsort(indices, kind="stable")
+    rindptr = np.zeros(len(indptr), dtype=np.int64)
+    rindptr[1:] = np.cumsum(np.bincount(indices, minlength=len(indptr) - 1))
+    return {"rindptr": rindptr, "rindices": sources[order].astype(np.int32), "redges": order.astype(np.int64)}
+
+def empty_graph():
+    arrays = {name: np.zeros(1 if name in ("indptr", "provenance_ptr", "rindptr") else 0, dtype=np.int64) for name in ARRAYS}
+    return KnowledgeGraph(arrays, {name: Strings.from_list([]) for name in STRINGS})
+
+def compile_graph(relationships_store):
+    with span("compile graph", chunks=len(relationships_store)):
+        return empty_graph().patch((), {chunk_id: canonical_entry(data)['triples'] for chunk_id, data in relationships_store.items()})
+
+def graph_dir(store):
+    return os.path.splitext(store.path)[0] + ".graph"
+
+# written into a new directory next to the old one, then the symlink at path is switched over to it with one rename,
+# so a reader gets the old graph or the new one, never half of one or none
+def save_graph(knowledge_graph, path, stamps, keep_layouts=False):
+    parent, base = os.path.split(os.path.abspath(path))
+    tmp_path = tempfile.mkdtemp(prefix=base + ".", dir=parent)
+    for name in ARRAYS:
+        np.save(os.path.join(tmp_path, f"{name}.npy"), getattr(knowledge_graph, name))
+    for name in STRINGS:
+        strings = getattr(knowledge_graph, name)
+        np.save(os.path.join(tmp_path, f"{name}.npy"), strings.data)
+        np.save(os.path.join(tmp_path, f"{name}_offsets.npy"), strings.offsets)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({"format": GRAPH_FORMAT, "version": canonical_version, "nodes": knowledge_graph.node_count, "edges": knowledge_graph.edge_count, "stamps": stamps}, f)
+    # a patched graph keeps its node ids, so viz.py's layouts can start from where the nodes were.
+    # copied, the old graph might still be being read
+    if keep_layouts and os.path.isdir(path):
+        for name in os.listdir(path):
+            if name.startswith("layout-"):
+                shutil.copy2(os.path.join(path, name), os.path.join(tmp_path, name))
+
+    if os.path.isdir(path) and not os.path.islink(path):
+        # saved before graphs had a directory each, moved aside once so the symlink can go in its place
+        os.replace(path, tmp_path + ".old")
+    link = tmp_path + ".link"
+    os.symlink(os.path.basename(tmp_path), link)
+    os.replace(link, path)
+
+    # everything else next to it is an older graph, or what's left of a save that didn't finish
+    for name in os.listdir(parent):
+        other = os.path.join(parent, name)
+        if name.startswith(base + ".") and other != tmp_path:
+            if os.path.isdir(other) and not os.path.islink(other):
+                shutil.rmtree(other, ignore_errors=True)
+            else:
+                os.remove(other)
+
+# the saved graph and the stamps of the chunks it was built from, (None, {}) if there's none or it was saved by another version
+def load_graph(path):
+    # follow the symlink once, so everything comes from the same save even if a new one gets swapped in meanwhile
+    path = os.path.realpath(path)
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None, {}
+    if meta.get("format") != GRAPH_FORMAT or meta.get("version") != canonical_version:
+        return None, {}
+
+    def load(name):
+        return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+    arrays = {name: load(name) for name in ARRAYS}
+    strings = {name: Strings(load(name), load(f"{name}_offsets")) for name in STRINGS}
+    return KnowledgeGraph(arrays, strings), meta["stamps"]
+
+# the saved graph, with the chunks whose relationships changed since patched in and saved again.
+# compiled from scratch if there's no saved graph. the relationships are read from the store unless given
+def open_graph(store=None, relationships_store=None):
+    store = store or open_store()
+    path = graph_dir(store)
+
+    with span("load graph"):
+        knowledge_graph, old_stamps = load_graph(path)
+    stamps, retired, added = relationship_changes(store, old_stamps, relationships_store)
+    if knowledge_graph is not None and not retired and not added:
+        print(f"Loaded knowledge graph with {knowledge_graph.node_count} nodes and {knowledge_graph.edge_count} edges.")
+        return knowledge_graph
+
+    patching = knowledge_graph is not None
+    with span("patch graph" if patching else "compile graph", retired=len(retired), added=len(added)):
+        knowledge_graph = (knowledge_graph if patching else empty_graph()).patch(retired, {chunk_id: data['triples'] for chunk_id, data in added.items()})
+    save_graph(knowledge_graph, path, stamps, keep_layouts=patching)
+    if patching:
+        print(f"Updated knowledge graph with {len(added)} new or changed and {len(set(retired) - set(added))} removed chunks, now {knowledge_graph.node_count} nodes and {knowledge_graph.edge_count} edges.")
+    else:
+        print(f"Compiled knowledge graph with {knowledge_graph.node_count} nodes and {knowledge_graph.edge_count} edges.")
+    return knowledge_graph
@@ -1,67 +1,44 @@
-import collections
 import json
 import pickle
-from collections import defaultdict
 import os
 import hashlib
 import tempfile
 
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import folium
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut
 import time
 
-import matplotlib.colors as mcolors
-import matplotlib.cm as cm
-import pandas as pd
-from datetime import datetime, timedelta
+from datetime import timedelta
 from dateutil import parser
 
-from common import ChatHistory, RetrievalHandler, TimerLogger, chunkenize, chunkenize_smalloverlap, llm, loadfiles, chunk_size_bytes, LLM_MODEL
+from common import TimerLogger, chunks_for, llm, loadfiles, chunk_size_bytes, LLM_MODEL
+from store import SMALLOVERLAP_8192, open_store
+import tables
 
 EMBED_MODEL = 'nomic-embed-text'
 
-preprocessing_timer = TimerLogger("Preprocessing")
-
-corpus_size = 0
-
-INFO_FILE = "info.pkl"
+STAGE = "info"
 GEOCODE_CACHE_FILE = "geocode_cache.json"
 
-info_store = {}
-chunk_store = {}
 geocode_cache = {}
 
-# Load geocode cache if it exists
-if os.path.exists(GEOCODE_CACHE_FILE):
-    try:
-        with open(GEOCODE_CACHE_FILE, 'r') as f:
-            geocode_cache = json.load(f)
-        print(f"Loaded {len(geocode_cache)} locations from geocode cache.")
-    except json.JSONDecodeError:
-        print("Error loading geocode cache. Starting with empty cache.")
-        geocode_cache = {}
-else:
-    print("No geocode cache found. Starting with empty cache.")
-
-loaded_files = loadfiles()
-
-show_year = False
-
 # Compute a hash to verify the state of the input files
 hash_input = pickle.dumps([chunk_size_bytes, LLM_MODEL])
 hash_value = hashlib.sha256(hash_input).hexdigest()
 
-save_file = f"{hash_value[:7]}-{INFO_FILE}"
+version = hash_value[:7]
 
-# Function to save progress using pickle
-def save_progress():
-    with tempfile.NamedTemporaryFile('wb', delete=False) as temp_file:
-        pickle.dump({"hash": hash_value, "info_store": info_store}, temp_file)
-        temp_file_path = temp_file.name
-    os.replace(temp_file_path, save_file)
+# Load geocode cache if it exists
+def load_geocode_cache():
+    global geocode_cache
+    if os.path.exists(GEOCODE_CACHE_FILE):
+        try:
+            with open(GEOCODE_CACHE_FILE, 'r') as f:
+                geocode_cache = json.load(f)
+            print(f"Loaded {len(geocode_cache)} locations from geocode cache.")
+        except json.JSONDecodeError:
+            print("Error loading geocode cache. Starting with empty cache.")
+            geocode_cache = {}
+    else:
+        print("No geocode cache found. Starting with empty cache.")
 
 # Function to save geocode cache
 def save_geocode_cache():
@@ -71,21 +48,6 @@ def save_geocode_cache():
     os.replace(temp_file_path, GEOCODE_CACHE_FILE)
     print(f"Saved {len(geocode_cache)} locations to geocode cache.")
 
-# Load sentiment data from file if it exists and matches the hash
-if os.path.exists(save_file):
-    with open(save_file, 'rb') as f:
-        try:
-            saved_data = pickle.load(f)
-            if saved_data.get("hash") == hash_value:
-                info_store = saved_data["info_store"]
-                print("Loaded existing sentiment data from file.")
-            else:
-                print("Sentiment file found but hash mismatch. Starting fresh.")
-        except pickle.PickleError:
-            print("Error decoding sentiment file. Starting fresh.")
-else:
-    print("No existing sentiment file found. Starting fresh.")
-
 # Location mapping dictionary to standardize location names
 LOCATION_MAPPING = {
     # San Francisco neighborhoods
@@ -478,7 +440,10 @@ def standardize_location(location):
 # Function to extract sentiment score
 def extract_location(chunk):
 
-    prompt = f"""You are analysing a journal fragment.
+    prompt = f"""Text:
+{chunk}
+
+You are analysing the journal fragment above.
 Extract the location ONLY if the fragment clearly indicates being in some city/metropolitan area, do not include references to places.
 If you're not sure, return a JSON with location none.
 If you are not familar with the location, return a JSON with location none.
@@ -486,9 +451,6 @@ If the fragment is set in a street or a building or a neighborhood or something
 If the location is not specific, such as "home" or "work", return a JSON with location none.
 Return ONE JSON per line.
 
-Text:
-{chunk}
-
 Example Outputs:
 {{"location": "Cape Cod"}}
 {{"location": "none"}}
@@ -517,159 +479,148 @@ def parse_date(date_str):
     except (ValueError, parser.ParserError):
         return None
 
-# Process chunks and extract sentiment scores
-chunks_processed = 0
-for info in loaded_files:
-    date_str = info["date"]
-    print(f"Original date string: {date_str}")
-    parsed_date = parse_date(date_str)
-    if parsed_date is None:
-        print(f"Could not parse date: {date_str}")
-        continue  # Skip this entry
-    content = info["content"]
-    corpus_size += len(content)
-
-    chunks = chunkenize_smalloverlap(content, 8192)
-
-    for i, chunk in enumerate(chunks):
-        id = f"{date_str}#{i}"
-        print(f"Processing chunk ID: {id}")
-
-        chunk_store[id] = date_str + "\n" + chunk
-
-        # Skip if already processed
-        if id in info_store:
-            if chunks_processed % 5 == 0:
-                chunks_processed += 1
-            continue
-
-        chunks_processed += 1
-        location = extract_location(chunk)
-
-        info_store[id] = {
-            'date_str': date_str,  # Store date string
-            'date': parsed_date,   # Store parsed date
-            #'chunk': chunk,
-            'location': location["location"]
-        }
-
-        # Save progress every 50 chunks
-        if chunks_processed % 50 == 0:
-            save_progress()
-
-# Save the final progress
-save_progress()
-
-preprocessing_timer.stop_and_log(corpus_size)
-
-spans = defaultdict(list)
-
-
-li = []
-
-
-sorted_keys = sorted(info_store.keys())
-
-# a bit tricky because it's weekly rather than daily
-# best bet might be to just determine one location for each week
-# all per-chunk locations should have the same v["date"], so we could build {date -> location}
-for k in sorted_keys:
-    v = info_store[k]
-
-    location = standardize_location(v["location"])
-
-    if not li:
-        li.append({"location": location, "start": v["date"], "end": v["date"] + timedelta(days=7)})
-
-    else:
-        last = li[-1]
-        cur_date = v["date"]
-        if location == "none" or last["location"] == location:
-            if cur_date > last["end"]:
-                last["end"] = cur_date
-        else:
+# Process chunks and extract locations, skipping whatever is already in the store
+# returns the locations and the corpus size
+def extract_locations(loaded_files, store=None):
+    store = store or open_store()
+    corpus_size = 0
+
+    # Load location data from the store
+    info_store = store.get(STAGE, version, SMALLOVERLAP_8192)
+    print(f"Loaded {len(info_store)} existing locations from the store.")
+
+    for info in loaded_files:
+        date_str = info["date"]
+        print(f"Original date string: {date_str}")
+        parsed_date = parse_date(date_str)
+        if parsed_date is None:
+            print(f"Could not parse date: {date_str}")
+            continue  # Skip this entry
+        content = info["content"]
+        corpus_size += len(content)
+
+        chunks = chunks_for(info, SMALLOVERLAP_8192)
+        # committed before any llm call, the other pipeline stages write to the same file and wait on an open transaction
+        with store.db:
+            store.add_chunks(SMALLOVERLAP_8192, date_str, chunks)
+
+        for i, chunk in enumerate(chunks):
+            id = f"{date_str}#{i}"
+            print(f"Processing chunk ID: {id}")
+
+            # Skip if already processed
+            if id in info_store:
+                continue
+
+            location = extract_location(chunk)
+
+            info_store[id] = {
+                'date_str': date_str,  # Store date string
+                'date': parsed_date,   # Store parsed date
+                #'chunk': chunk,
+                'location': location["location"]
+            }
+            # Commit every chunk, so the write lock is never held across the next llm call
+            with store.db:
+                store.put(STAGE, version, SMALLOVERLAP_8192, id, info_store[id])
+
+    # Commit the final progress
+    store.commit()
+
+    return info_store, corpus_size
+
+# turns the per-chunk locations into a DataFrame of (location, start, end) spans, with a row per location for plotting.
+# locations is the info table (tables.py) as a DataFrame, in date order with the standardized names
+def location_spans(locations):
+    import pandas as pd
+
+    li = []
+
+    # a bit tricky because it's weekly rather than daily
+    # best bet might be to just determine one location for each week
+    # all per-chunk locations should have the same date, so we could build {date -> location}
+    for cur_date, location in zip(locations["date"], locations["location"]):
+        if not li:
             li.append({"location": location, "start": cur_date, "end": cur_date + timedelta(days=7)})
-    print(v)
 
-
-
-records = []
-for location,lst in spans.items():
-    for start,end,_ in lst:
-        if end is None:
-            end = datetime.now().isoformat()
-        records.append({"location": location, "start": start, "end": end})
-
-df = pd.DataFrame(li)
-print(df)
-
-# Calculate total duration for each location
-location_durations = {}
-for _, row in df.iterrows():
-    location = row["location"]
-    duration = (row["end"] - row["start"]).days
-    if location in location_durations:
-        location_durations[location] += duration
-    else:
-        location_durations[location] = duration
-
-# Sort locations by total duration (descending)
-sorted_locations = sorted(location_durations.items(), key=lambda x: x[1], reverse=True)
-row_map = {location: i for i, (location, _) in enumerate(sorted_locations)}
-df["row"] = df["location"].map(row_map)
-
-df["start"] = pd.to_datetime(df["start"])
-df["end"] = pd.to_datetime(df["end"])
-
-# Plot
-fig, ax = plt.subplots(figsize=(12, min(20, 1 + len(row_map) * 0.3)))  # Limit height to 20 inches
-colors = {c: plt.cm.tab20(i % 20) for i,c in enumerate(row_map)}
-for _, r in df.iterrows():
-    ax.barh(y=r["row"],
-            left=r["start"],
-            width = (r["end"] - r["start"]).days,
-
-
-            height=0.6,
-            color=colors[r["location"]],
-            label=r["location"])
-
-ax.set_yticks(list(row_map.values()))
-ax.set_yticklabels(list(row_map.keys()))
-ax.xaxis.set_major_locator(mdates.YearLocator())
-ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
-plt.xticks(rotation=45)
-
-# Single legend entry per location
-handles, labels = ax.get_legend_handles_labels()
-uniq = dict(zip(labels, handles))
-ax.legend(uniq.values(), uniq.keys(), fontsize="small", ncol=3, loc='upper center', bbox_to_anchor=(0.5, -0.15))
-ax.set_title("Location Timeline (from info_store)")
-
-# Format x-axis as dates
-ax.xaxis_date()
-ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d"))
-ax.xaxis.set_major_locator(mdates.AutoDateLocator())
-fig.autofmt_xdate()
-
-# 7. Label and show
-ax.set_xlabel("Date")
-
-# Adjust layout to prevent cutoff
-plt.tight_layout()
-
-# Print locations that have only 1 span
-location_span_counts = df['location'].value_counts()
-single_span_locations = location_span_counts[location_span_counts == 1].index.tolist()
-print("\nLocations with only 1 span:")
-for location in single_span_locations:
-    span_row = df[df['location'] == location].iloc[0]
-    duration = (span_row['end'] - span_row['start']).days
-    print(f"{location}: {span_row['start'].strftime('%Y-%m-%d')} to {span_row['end'].strftime('%Y-%m-%d')} ({duration} days)")
-
-#plt.show()
+        else:
+            last = li[-1]
+            if location == "none" or last["location"] == location:
+                if cur_date > last["end"]:
+                    last["end"] = cur_date
+            else:
+                li.append({"location": location, "start": cur_date, "end": cur_date + timedelta(days=7)})
+
+    df = pd.DataFrame(li, columns=["location", "start", "end"])
+    df["start"] = pd.to_datetime(df["start"])
+    df["end"] = pd.to_datetime(df["end"])
+    print(df)
+
+    # Sort locations by total duration (descending)
+    location_durations = (df["end"] - df["start"]).dt.days.groupby(df["location"], sort=False).sum()
+    sorted_locations = location_durations.sort_values(ascending=False, kind="stable").index
+    row_map = {location: i for i, location in enumerate(sorted_locations)}
+    df["row"] = df["location"].map(row_map)
+
+    return df, row_map
+
+def plot_timeline(df, row_map):
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+
+    # Plot
+    fig, ax = plt.subplots(figsize=(12, min(20, 1 + len(row_map) * 0.3)))  # Limit height to 20 inches
+    colors = {c: plt.cm.tab20(i % 20) for i,c in enumerate(row_map)}
+    for _, r in df.iterrows():
+        ax.barh(y=r["row"],
+                left=r["start"],
+                width = (r["end"] - r["start"]).days,
+
+
+                height=0.6,
+                color=colors[r["location"]],
+                label=r["location"])
+
+    ax.set_yticks(list(row_map.values()))
+    ax.set_yticklabels(list(row_map.keys()))
+    ax.xaxis.set_major_locator(mdates.YearLocator())
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
+    plt.xticks(rotation=45)
+
+    # Single legend entry per location
+    handles, labels = ax.get_legend_handles_labels()
+    uniq = dict(zip(labels, handles))
+    ax.legend(uniq.values(), uniq.keys(), fontsize="small", ncol=3, loc='upper center', bbox_to_anchor=(0.5, -0.15))
+    ax.set_title("Location Timeline (from info_store)")
+
+    # Format x-axis as dates
+    ax.xaxis_date()
+    ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d"))
+    ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+    fig.autofmt_xdate()
+
+    # 7. Label and show
+    ax.set_xlabel("Date")
+
+    # Adjust layout to prevent cutoff
+    plt.tight_layout()
+
+    # Print locations that have only 1 span
+    location_span_counts = df['location'].value_counts()
+    single_span_locations = location_span_counts[location_span_counts == 1].index.tolist()
+    print("\nLocations with only 1 span:")
+    for location in single_span_locations:
+        span_row = df[df['location'] == location].iloc[0]
+        duration = (span_row['end'] - span_row['start']).days
+        print(f"{location}: {span_row['start'].strftime('%Y-%m-%d')} to {span_row['end'].strftime('%Y-%m-%d')} ({duration} days)")
+
+    #plt.show()
 
 def create_location_map(df):
+    import folium
+    from geopy.geocoders import Nominatim
+    from geopy.exc import GeocoderTimedOut
+
     # Create a map centered at a default location
     m = folium.Map(location=[0, 0], zoom_start=2)
     
@@ -734,6 +685,22 @@ def create_location_map(df):
     m.save('location_map.html')
     print("Map has been saved as 'location_map.html'")
 
-# After creating the DataFrame, add this line to create the map
-create_location_map(df)
+def main(journal_dir=None):
+    preprocessing_timer = TimerLogger("Preprocessing")
+
+    load_geocode_cache()
+    store = open_store()
+    info_store, corpus_size = extract_locations(loadfiles(journal_dir), store)
+
+    preprocessing_timer.stop_and_log(corpus_size)
+
+    # only the columns the spans need, out of the columnar table
+    locations = tables.load_frame(STAGE, version, ["date", "location"], store)
+    df, row_map = location_spans(locations)
+    plot_timeline(df, row_map)
+
+    # After creating the DataFrame, add this line to create the map
+    create_location_map(df)
 
+if __name__ == "__main__":
+    main()
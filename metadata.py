@@ -0,0 +1,226 @@
+import bisect
+import collections
+import re
+
+from common import chunk_size_bytes
+from store import SMALLOVERLAP_8192, open_store, split_key
+
+# metadata filters for retrieval, written into the query: "location == nyc", "sentiment < 30", "year in 2016..2018".
+# a location can be more than one word ("location == new york"), it takes as many words as make a location that's
+# in the extracted data, so the words after it stay in the query. quote it ("location == 'st. louis'") to take it exactly.
+# every retrieval chunk gets an integer id (its position in date order) and every value of every field gets a bitmap over those ids,
+# a python int with bit n set when chunk n has that value. a predicate ors the bitmaps of the values it accepts,
+# the predicates get and-ed together, and only the chunks left over are scored and can end up in the prompt.
+# the result goes down to the searches as a bitmap too. ids are in date order, so each shard's chunks are one run of bits
+# and a shard only looks at its own slice.
+
+FIELDS = ("location", "sentiment", "year")
+# an unquoted value gets up to MAX_VALUE_WORDS words, parse_filters gives back the ones that aren't part of it
+MAX_VALUE_WORDS = 4
+FILTER = re.compile(r'\b(location|sentiment|year)\s*(==|!=|<=|>=|=|<|>|:|\bin\b)\s*("[^"]*"|\'[^\']*\'|[\w.,-]+(?:[ \t]+(?!(?:location|sentiment|year)\b)[\w.,-]+){0,%d})' % (MAX_VALUE_WORDS - 1), re.IGNORECASE)
+
+# sentiment and location are extracted per 8192 byte chunk with a 1/64 overlap
+METADATA_CHUNK_STEP = 8192 - 8192 // 64
+
+# the bit positions set in each byte value, so turning a bitmap back into ids goes a byte at a time
+BYTE_BITS = [tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+
+def to_bitmap(positions, size):
+    data = bytearray((size + 7) // 8)
+    for n in positions:
+        data[n >> 3] |= 1 << (n & 7)
+    return int.from_bytes(data, "little")
+
+def from_bitmap(bitmap):
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    return [i * 8 + bit for i, byte in enumerate(data) if byte for bit in BYTE_BITS[byte]]
+
+# retrieval chunks are 1024 bytes starting every 512, they get the metadata of the big chunk their middle falls in
+def metadata_key(chunk_id):
+    date, i = split_key(chunk_id)
+    middle = i * (chunk_size_bytes // 2) + chunk_size_bytes // 2
+    return f"{date}#{middle // METADATA_CHUNK_STEP}"
+
+def standardize(location):
+    from location import standardize_location
+    return standardize_location(location).casefold()
+
+# "2016..2018" -> (2016, 2018), "nyc,boston" -> ["nyc", "boston"], anything else is just the value
+def parse_value(field, value):
+    value = value.strip("\"'.,")
+    if ".." in value:
+        low, _, high = value.partition("..")
+        return (int(low), int(high)) if field != "location" else None
+    values = [x.strip() for x in value.split(",") if x.strip()]
+    if field == "location":
+        return [standardize(x) for x in values]
+    return [int(x) for x in values]
+
+# how many of the words an unquoted location is: the most that name locations we have data for, otherwise just the first
+def location_words(words, locations):
+    if locations:
+        for n in range(len(words), 1, -1):
+            if all(x in locations for x in parse_value("location", " ".join(words[:n]))):
+                return n
+    return 1
+
+# takes the filters out of the query, returns the rest of the query and [(field, op, values)]
+# something that only looks like a filter ("the year in review") stays in the query.
+# locations are the standardized ones there's data for, they decide where a multi word location ends
+def parse_filters(query, locations=None):
+    filters = []
+
+    def take(match):
+        field, op, value = match.group(1).lower(), match.group(2).lower(), match.group(3)
+        rest = ""
+        if value[0] not in "\"'":
+            words = value.split()
+            n = location_words(words, locations) if field == "location" else 1
+            value, rest = " ".join(words[:n]), " ".join(words[n:])
+        try:
+            values = parse_value(field, value)
+        except ValueError:
+            return match.group(0)
+        if values is None or (op in ("<", "<=", ">", ">=") and (field == "location" or isinstance(values, tuple) or len(values) != 1)):
+            return match.group(0)
+        filters.append((field, "==" if op in ("=", ":", "in") else op, values))
+        return " " + rest
+
+    query = FILTER.sub(take, query)
+    return " ".join(query.split()), filters
+
+def describe(filters):
+    def value(values):
+        return f"{values[0]}..{values[1]}" if isinstance(values, tuple) else ",".join(str(x) for x in values)
+    return ", ".join(f"{field} {op} {value(values)}" for field, op, values in filters)
+
+def accepts(op, values, x):
+    if isinstance(values, tuple):
+        inside = values[0] <= x <= values[1]
+        return not inside if op == "!=" else inside
+    if op == "==":
+        return x in values
+    if op == "!=":
+        return x not in values
+    return {"<": x < values[0], "<=": x <= values[0], ">": x > values[0], ">=": x >= values[0]}[op]
+
+class MetadataIndex:
+    # chunk_ids are the retrieval chunks, the stores are what sentiment.py and location.py extracted
+    def __init__(self, chunk_ids, sentiment_store, info_store):
+        self.ids = sorted(chunk_ids, key=split_key)
+        self.dates = [split_key(x)[0] for x in self.ids]
+        self.position = {x: n for n, x in enumerate(self.ids)}
+        self.all = (1 << len(self.ids)) - 1
+
+        # field -> value -> positions, then turned into bitmaps in one go each
+        positions = {field: collections.defaultdict(list) for field in FIELDS}
+        for n, chunk_id in enumerate(self.ids):
+            positions["year"][int(chunk_id[:4])].append(n)
+            key = metadata_key(chunk_id)
+            score = sentiment_store.get(key, {}).get("sentiment_score")
+            if score is not None:
+                positions["sentiment"][score].append(n)
+            location = info_store.get(key, {}).get("location")
+            if location is not None:
+                positions["location"][standardize(location)].append(n)
+        self.bitmaps = {field: {value: to_bitmap(p, len(self.ids)) for value, p in by_value.items()} for field, by_value in positions.items()}
+
+    def bitmap(self, field, op, values):
+        result = 0
+        for value, bitmap in self.bitmaps[field].items():
+            if accepts(op, values, value):
+                result |= bitmap
+        return result
+
+    def select(self, filters):
+        result = self.all
+        for field, op, values in filters:
+            result &= self.bitmap(field, op, values)
+        return result
+
+    # the chunks that pass every filter, as a Selection
+    def matching(self, filters):
+        return Selection(self, self.select(filters))
+
+    def missing(self, filters):
+        return [field for field, _, _ in filters if not self.bitmaps[field]]
+
+# what the filters let through: the bitmap, and the index whose positions its bits are
+class Selection:
+    def __init__(self, index, bitmap):
+        self.index = index
+        self.bitmap = bitmap
+
+    def __len__(self):
+        return self.bitmap.bit_count()
+
+    # the chunks from start to end (YYYY-MM-DD, inclusive)
+    def window(self, start=None, end=None):
+        lo = bisect.bisect_left(self.index.dates, start) if start else 0
+        hi = max(lo, bisect.bisect_right(self.index.dates, end) if end else len(self.index.ids))
+        return Window(self.index, lo, (self.bitmap >> lo) & ((1 << (hi - lo)) - 1), hi - lo)
+
+# one shard's slice of a Selection, bit n is position base + n. works like a set of chunk ids for the tfidf postings,
+# and mask() checks a whole array of positions at once for the vector rows
+class Window:
+    def __init__(self, index, base, bits, size):
+        self.index = index
+        self.base = base
+        self.bits = bits
+        self.data = bits.to_bytes((size + 7) // 8, "little")
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __len__(self):
+        return self.bits.bit_count()
+
+    def __contains__(self, chunk_id):
+        n = self.index.position.get(chunk_id, -1) - self.base
+        return 0 <= n < len(self.data) * 8 and bool(self.data[n >> 3] >> (n & 7) & 1)
+
+    def __iter__(self):
+        return (self.index.ids[self.base + n] for n in from_bitmap(self.bits))
+
+    # which of the positions (in the index's numbering, -1 for chunks it doesn't have) got through, as a numpy bool array
+    def mask(self, positions):
+        import numpy as np
+
+        bits = np.unpackbits(np.frombuffer(self.data, dtype=np.uint8), bitorder="little").astype(bool)
+        offsets = positions - self.base
+        inside = (positions >= 0) & (offsets >= 0) & (offsets < len(bits))
+        result = np.zeros(len(positions), dtype=bool)
+        result[inside] = bits[offsets[inside]]
+        return result
+
+def load_metadata(chunk_ids, store=None):
+    import sentiment
+    import location
+
+    store = store or open_store()
+    sentiment_store = store.get(sentiment.STAGE, sentiment.version, SMALLOVERLAP_8192)
+    info_store = store.get(location.STAGE, location.version, SMALLOVERLAP_8192)
+    return MetadataIndex(chunk_ids, sentiment_store, info_store)
+
+# what the query loops use: takes the filters out of a query and returns (query, a Selection of the allowed chunks or None).
+# the stores only get read the first time a query has filters in it
+class QueryFilters:
+    def __init__(self, chunk_ids):
+        self.chunk_ids = chunk_ids
+        self.index = None
+
+    def apply(self, query):
+        original = query
+        query, filters = parse_filters(query)
+        if not filters:
+            return query, None
+        if self.index is None:
+            self.index = load_metadata(self.chunk_ids)
+        if any(field == "location" for field, _, _ in filters):
+            # again, now that it's known which locations there are
+            query, filters = parse_filters(original, self.index.bitmaps["location"].keys())
+        for field in self.index.missing(filters):
+            print(f"system>no {field} data in the store yet, run pipeline.py to extract it")
+        allowed = self.index.matching(filters)
+        print(f"system>{describe(filters)}: {len(allowed)} of {len(self.index.ids)} chunks")
+        return query, allowed
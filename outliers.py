@@ -2,7 +2,6 @@ import os
 from os import walk
 import re
 import datetime as dt
-import matplotlib.pyplot as plt
 
 from common import loadfiles
 
@@ -15,9 +14,11 @@ def parse_date(date_str):
     year, month, day = date_str.split('-')
     return dt.datetime(int(year), int(month), int(day))
 
-def main():
+def main(journal_dir=None):
+    import matplotlib.pyplot as plt
+
     # Load the files from your custom function
-    entries = loadfiles()
+    entries = loadfiles(journal_dir)
     # Sort them by date
     entries.sort(key=lambda x: x['date'])
 
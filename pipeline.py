@@ -0,0 +1,180 @@
+import argparse
+import hashlib
+import pickle
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from common import CHUNKERS, EMBED_MODEL, LLM_MODEL, TimerLogger, chunk_size_bytes, chunks_for, files_fingerprint, loadfiles
+from store import STORE_FILE, ArtifactStore, open_store
+
+# runs the preprocessing every script does on startup as one graph of stages.
+# each stage remembers the fingerprint of what it was last built from (the files, the models, its own version and its inputs),
+# so a second run with nothing changed doesn't do anything, and editing one journal only reruns what depends on the files.
+# the extraction stages also skip chunks that are already in the store, so a rerun only pays for the new chunks.
+
+class Stage:
+    # bump version when the stage's code changes in a way that should redo its output
+    def __init__(self, name, run, inputs=(), version="1"):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.version = version
+
+def chunk_stage(loaded_files, store):
+    with store.db:
+        for info in loaded_files:
+            for chunker in CHUNKERS:
+                store.add_chunks(chunker, info["date"], chunks_for(info, chunker))
+
+def embed_stage(loaded_files, store):
+    import vectorchunk
+    vectorchunk.load_vectors(loaded_files, store, load=False)
+
+def index_stage(loaded_files, store):
+    import shards
+    shards.load_tfidf_shards(loaded_files, store)
+
+def sentiment_stage(loaded_files, store):
+    import sentiment
+    import tables
+    sentiment.extract_sentiments(loaded_files, store)
+    # the columnar table the analysis scripts read, rebuilt here instead of on their first run
+    tables.load_table(sentiment.STAGE, sentiment.version, store=store)
+
+def location_stage(loaded_files, store):
+    import location
+    import tables
+    location.extract_locations(loaded_files, store)
+    # the columnar table the analysis scripts read, rebuilt here instead of on their first run
+    tables.load_table(location.STAGE, location.version, store=store)
+
+def relationships_stage(loaded_files, store):
+    import graph
+    graph.extract_all_relationships(loaded_files, store)
+
+def graph_stage(loaded_files, store):
+    import graph
+    import kgraph
+    # both only patch in the chunks that changed since they were last saved
+    kgraph.open_graph(store)
+    graph.load_triple_index(store)
+
+def communities_stage(loaded_files, store):
+    import kgraph
+    import communities
+    communities.summarize_communities(kgraph.open_graph(store), store)
+
+# in dependency order. mysenti isn't here since it needs someone at the keyboard, viz only draws what graph extracted
+STAGES = [
+    Stage("chunk", chunk_stage),
+    Stage("embed", embed_stage, ["chunk"]),
+    Stage("build-index", index_stage, ["chunk"]),
+    Stage("extract-sentiment", sentiment_stage, ["chunk"]),
+    Stage("extract-location", location_stage, ["chunk"]),
+    # 2: re-extracts the chunks stored with only canonical triples, graph.lossy_entry
+    Stage("extract-relationships", relationships_stage, ["chunk"], version="2"),
+    Stage("build-graph", graph_stage, ["extract-relationships"]),
+    Stage("summarize-communities", communities_stage, ["build-graph"]),
+]
+
+def fingerprints(stages, loaded_files):
+    files = files_fingerprint(loaded_files)
+    result = {}
+    for stage in stages:
+        inputs = [result[name] for name in stage.inputs]
+        hash_input = pickle.dumps([stage.name, stage.version, files, chunk_size_bytes, LLM_MODEL, EMBED_MODEL, inputs])
+        result[stage.name] = hashlib.sha256(hash_input).hexdigest()
+    return result
+
+# the asked for stages plus everything upstream of them
+def with_inputs(stages, names):
+    by_name = {stage.name: stage for stage in stages}
+    unknown = [name for name in names if name not in by_name]
+    if unknown:
+        raise ValueError(f"Unknown stages: {', '.join(unknown)}. Known: {', '.join(by_name)}")
+    wanted = set()
+    todo = list(names)
+    while todo:
+        name = todo.pop()
+        if name not in wanted:
+            wanted.add(name)
+            todo.extend(by_name[name].inputs)
+    return [stage for stage in stages if stage.name in wanted]
+
+def run_pipeline(loaded_files, stages=STAGES, store_path=STORE_FILE, force=(), workers=4):
+    fingerprint = fingerprints(stages, loaded_files)
+
+    # open_store once up front, so an old pickle migration happens before anything runs
+    store = open_store(store_path)
+    stale = set()
+    for stage in stages:
+        if stage.name in force or any(name in stale for name in stage.inputs) or store.stage_fingerprint(stage.name) != fingerprint[stage.name]:
+            stale.add(stage.name)
+    store.close()
+
+    corpus_size = sum(len(info["content"]) for info in loaded_files)
+    print_lock = threading.Lock()
+
+    def run(stage, upstream):
+        # a failed input fails this stage too
+        for future in upstream:
+            future.result()
+        with print_lock:
+            print(f"pipeline> running {stage.name}")
+        timer = TimerLogger(stage.name)
+        # sqlite connections shouldn't be shared between threads that write
+        stage_store = ArtifactStore(store_path)
+        try:
+            stage.run(loaded_files, stage_store)
+            stage_store.set_stage_fingerprint(stage.name, fingerprint[stage.name])
+        finally:
+            stage_store.close()
+        with print_lock:
+            timer.stop_and_log(corpus_size)
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # stages are submitted after their inputs, so a worker only ever waits on something that already started or is ahead in the queue
+        for stage in stages:
+            if stage.name not in stale:
+                print(f"pipeline> {stage.name} is up to date")
+                continue
+            upstream = [futures[name] for name in stage.inputs if name in futures]
+            futures[stage.name] = pool.submit(run, stage, upstream)
+
+    failed = []
+    for name, future in futures.items():
+        if future.exception() is not None:
+            print(f"pipeline> {name} failed: {future.exception()!r}")
+            failed.append(name)
+    return futures.keys() - set(failed), failed
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Preprocess the journals, only redoing the stages whose inputs changed")
+    arg_parser.add_argument("journal_dir", nargs="?", default="sample_journals")
+    arg_parser.add_argument("--stages", help="comma separated, runs these and whatever they need. default is everything")
+    arg_parser.add_argument("--force", default="", help="comma separated stages to rerun even if they're up to date")
+    arg_parser.add_argument("--workers", type=int, default=4)
+    arg_parser.add_argument("--store", default=STORE_FILE)
+    arg_parser.add_argument("--vacuum", action="store_true", help="shrink the store file afterwards, nothing else can have it open")
+    args = arg_parser.parse_args()
+
+    stages = STAGES
+    if args.stages:
+        stages = with_inputs(STAGES, [x.strip() for x in args.stages.split(",") if x.strip()])
+    force = {x.strip() for x in args.force.split(",") if x.strip()}
+
+    loaded_files = loadfiles(args.journal_dir)
+    ran, failed = run_pipeline(loaded_files, stages, args.store, force, args.workers)
+    print(f"pipeline> ran {len(ran)} stages, {len(failed)} failed")
+    if args.vacuum:
+        store = ArtifactStore(args.store)
+        freed = store.vacuum()
+        store.close()
+        print(f"pipeline> vacuumed the store, {freed / 1024 / 1024:.1f} MB freed")
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
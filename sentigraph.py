@@ -2,57 +2,41 @@
 """
 plot_sentiment_points.py
 
-Loads the sentiment pickle file (my_sentiment.pkl or hashed variant)
+Loads the sentiment scores from mysenti.py out of the artifact store
 and creates a scatter plot (x = date, y = sentiment).
 - Points in black for "normal" sentiment
 - Points in red for outliers (defined by IQR rule below)
 """
 
-import os
-import pickle
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
-import pandas as pd
+import numpy as np
+
+from store import STORE_FILE, open_store
+import tables
 
 # -----------------------------------------------------------------------
-# If you used a hashed file name (e.g., "abc1234-my_sentiment.pkl"), 
-# set SENTIMENT_FILE to that. Otherwise, it should be "my_sentiment.pkl" 
-# by default.
+# Whatever version mysenti.py wrote last is used, so there's no hash
+# to copy around anymore.
 # -----------------------------------------------------------------------
-SENTIMENT_FILE = "0e61aa5-my_sentiment.pkl"
+SENTIMENT_STAGE = "my_sentiment"
 
-def load_sentiment_data(pickle_path):
-    if not os.path.exists(pickle_path):
-        raise FileNotFoundError(f"Could not find sentiment file: {pickle_path}")
-    with open(pickle_path, "rb") as f:
-        data = pickle.load(f)
-    # "data" should be a dict with keys: {"hash", "sentiment_store", "summary_store"}
-    sentiment_store = data["sentiment_store"]
-    return sentiment_store
+# just the date and score columns of the columnar table (tables.py), as a DataFrame
+def load_sentiment_data(store_path=STORE_FILE):
+    store = open_store(store_path)
+    version = store.latest_version(SENTIMENT_STAGE)
+    if version is None:
+        raise FileNotFoundError(f"No {SENTIMENT_STAGE} data in {store_path}, run mysenti.py first")
+    return tables.load_frame(SENTIMENT_STAGE, version, ["date", "sentiment_score"], store)
 
 def main():
     # 1. Load the sentiment data
-    sentiment_store = load_sentiment_data(SENTIMENT_FILE)
-    
-    # 2. Convert the sentiment_store dictionary into a DataFrame
-    #    Each entry has:
-    #     - 'date' (a datetime object)
-    #     - 'sentiment_score' (1–100 or None)
-    #     - 'date_str' (unused here)
-    rows = []
-    for chunk_id, info in sentiment_store.items():
-        date_val = info.get("date", None)
-        score = info.get("sentiment_score", None)
-        if date_val is None or score is None:
-            # If date or sentiment missing, skip
-            continue
-        rows.append({
-            "id": chunk_id,
-            "date": date_val,
-            "sentiment_score": score
-        })
-    
-    df = pd.DataFrame(rows)
+    #    - 'date' (datetime64)
+    #    - 'sentiment_score' (1–100, nan where there's none)
+    df = load_sentiment_data()
+
+    # 2. If date or sentiment missing, skip
+    df = df.dropna()
     if df.empty:
         print("No valid data to plot. Exiting.")
         return
@@ -67,11 +51,9 @@ def main():
     lower_bound = Q1 - 1.5 * IQR
     upper_bound = Q3 + 1.5 * IQR
 
-    def is_outlier(x):
-        return (x < lower_bound) or (x > upper_bound)
-
     # Assign colors
-    df["color"] = df["sentiment_score"].apply(lambda x: "red" if is_outlier(x) else "black")
+    outlier = (df["sentiment_score"] < lower_bound) | (df["sentiment_score"] > upper_bound)
+    df["color"] = np.where(outlier, "red", "black")
 
     # 5. Plot
     fig, ax = plt.subplots(figsize=(12, 6))
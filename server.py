@@ -0,0 +1,297 @@
+import asyncio
+import json
+import time
+import uuid
+
+from common import ChatHistory, PrefetchRun, RetrievalHandler, TimerLogger, embed_batch, expand, llm_stream, load_tokenizer, loadfiles, parse_date_range, tokenize
+from metadata import QueryFilters
+import shards
+import vectorchunk
+
+# long running version of tfidf.py/vectorchunk.py. loads everything once and answers over HTTP
+#
+# POST /query {"query": "...", "session": "...", "index": "vector" or "tfidf", "stream": false, "start": "2019-01-01", "end": "2019-12-31"}
+# POST /more  {"session": "...", "stream": false}
+# POST /clear {"session": "..."}
+# GET  /health
+#
+# with "stream": true the answer comes back as newline delimited JSON, {"text": "..."} per piece and then {"done": true, ...}
+# leave out "session" on the first query and use the one that comes back
+# if a streamed answer fails partway through, the last line is {"error": "..."} instead of {"done": true, ...}
+# closing the connection (or half closing it) before the answer is done cancels the generation
+# start/end are optional, without them a date range in the query itself ("in march 2019", "after:2018-06") is used.
+# metadata filters go in the query too: "location == nyc", "sentiment < 30", "year in 2016..2018"
+
+HOST = "127.0.0.1"
+PORT = 8000
+
+# how many LLM generations run at once, more than OLLAMA_NUM_PARALLEL just queues up on the ollama side anyway
+MAX_CONCURRENT_GENERATIONS = 2
+# requests past this get a 503 instead of waiting forever
+MAX_PENDING_REQUESTS = 32
+# query embeddings that come in within this many seconds of each other go out as one request
+EMBED_BATCH_WINDOW = 0.01
+# forget sessions nobody has used for this long
+SESSION_TIMEOUT = 60 * 60
+
+CHUNKS_PER_QUERY = 10
+
+class Session:
+    def __init__(self):
+        self.history = ChatHistory()
+        self.holder = None
+        self.lock = asyncio.Lock()
+        self.last_used = time.time()
+
+# collects query embeddings that arrive close together and sends them in a single embed call
+class EmbedBatcher:
+    def __init__(self, window=EMBED_BATCH_WINDOW):
+        self.window = window
+        self.pending = []
+
+    async def embed(self, text):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((text, future))
+        if len(self.pending) == 1:
+            asyncio.get_running_loop().call_later(self.window, lambda: asyncio.ensure_future(self.flush()))
+        return await future
+
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        try:
+            vectors = await asyncio.to_thread(embed_batch, [text for text, _ in batch])
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+class QueryService:
+    def __init__(self, loaded_files):
+        preprocessing_timer = TimerLogger("Preprocessing")
+        self.index, self.chunk_store, corpus_size = shards.load_tfidf_shards(loaded_files)
+        # same chunking as tfidf, so the chunk stores are the same
+        vectorchunk.load_vectors(loaded_files, load=False)
+        self.vector_index = shards.load_vector_shards(loaded_files)
+        self.query_filters = QueryFilters(self.chunk_store.keys())
+        # prompts get packed by token count, load the tokenizer now rather than in the middle of someone's query
+        load_tokenizer()
+        preprocessing_timer.stop_and_log(corpus_size)
+
+        self.sessions = {}
+        self.generations = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
+        self.pending = 0
+        self.embedder = EmbedBatcher()
+
+    def session(self, session_id):
+        now = time.time()
+        for k in [k for k, v in self.sessions.items() if now - v.last_used > SESSION_TIMEOUT]:
+            del self.sessions[k]
+        if session_id is None or session_id not in self.sessions:
+            session_id = session_id or uuid.uuid4().hex
+            self.sessions[session_id] = Session()
+        session = self.sessions[session_id]
+        session.last_used = now
+        return session_id, session
+
+    async def retrieve(self, session, query, index_type, start=None, end=None):
+        # the first query with filters reads the sentiment/location stores, keep that off the event loop
+        query, allowed = await asyncio.to_thread(self.query_filters.apply, query)
+        query, query_start, query_end = parse_date_range(query)
+        start, end = start or query_start, end or query_end
+        async with self.generations:
+            expanded_query = query + await asyncio.to_thread(expand, query, 'tfidf', session.history)
+        if index_type == 'tfidf':
+            scores = await asyncio.to_thread(self.index.search, tokenize(expanded_query), start=start, end=end, allowed=allowed)
+        else:
+            embedded_query = await self.embedder.embed(expanded_query)
+            scores = await asyncio.to_thread(self.vector_index.search, embedded_query, start=start, end=end, allowed=allowed)
+        return RetrievalHandler(query, scores, self.chunk_store, CHUNKS_PER_QUERY)
+
+    # runs the blocking generation in a thread and hands the pieces back to the event loop as they come.
+    # if the request goes away (client hung up, sending a piece failed) the run hangs up on ollama,
+    # and the generation slot is only given back once the thread is actually done with it
+    async def generate(self, prompt, on_text):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        run = PrefetchRun()
+
+        def work():
+            pieces = llm_stream(prompt, format='json', client=run.client)
+            try:
+                while not run.cancelled.is_set():
+                    loop.call_soon_threadsafe(queue.put_nowait, ('text', next(pieces)))
+            except StopIteration as done:
+                loop.call_soon_threadsafe(queue.put_nowait, ('done', done.value))
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, ('error', e))
+            finally:
+                pieces.close()
+
+        async with self.generations:
+            worker = asyncio.create_task(asyncio.to_thread(work))
+            try:
+                while True:
+                    kind, value = await queue.get()
+                    if kind == 'text':
+                        await on_text(value)
+                    elif kind == 'done':
+                        return value
+                    else:
+                        raise value
+            finally:
+                if worker.done():
+                    run.client.close()
+                else:
+                    run.cancel()
+                # wait() rather than await, so cancelling this request again doesn't cancel the wait for the thread
+                await asyncio.wait([worker])
+
+    async def answer(self, session, prompt, on_text):
+        output, stats = await self.generate(prompt, on_text)
+        try:
+            obj = json.loads(output.strip())
+        except json.JSONDecodeError:
+            obj = {}
+        response = obj.get("response", "") if isinstance(obj, dict) else ""
+        session.history.log_llm(response if isinstance(response, str) else json.dumps(response))
+        return {
+            "response": response,
+            "explanation": obj.get("explanation", "") if isinstance(obj, dict) else "",
+            "chunks": session.holder.last_page,
+            "has_more": session.holder.has_more(),
+            "prompt_eval_count": stats.get("prompt_eval_count", 0),
+            "eval_count": stats.get("eval_count", 0),
+        }
+
+    async def handle(self, method, path, data, respond):
+        if method == 'GET' and path == '/health':
+            return await respond(200, {"sessions": len(self.sessions), "pending": self.pending})
+        if method != 'POST' or path not in ('/query', '/more', '/clear'):
+            return await respond(404, {"error": "not found"})
+
+        session_id, session = self.session(data.get("session"))
+        async with session.lock:
+            if path == '/clear':
+                session.history.clear()
+                return await respond(200, {"session": session_id})
+
+            if path == '/more':
+                if session.holder is None:
+                    return await respond(400, {"session": session_id, "error": "no question previously asked"})
+                if not session.holder.has_more():
+                    return await respond(400, {"session": session_id, "error": "out of search results"})
+                session.history.log_user('more')
+            else:
+                query = data.get("query", "").strip()
+                if not query:
+                    return await respond(400, {"session": session_id, "error": "missing query"})
+                session.history.log_user(query)
+                session.holder = await self.retrieve(session, query, data.get("index", "vector"), data.get("start"), data.get("end"))
+
+            # counting tokens and reading the chunks' text, keep that off the event loop too
+            prompt = await asyncio.to_thread(session.holder.build_prompt)
+            if data.get("stream"):
+                send = await respond(200, None, stream=True)
+                result = await self.answer(session, prompt, lambda text: send({"text": text}))
+                await send({"done": True, "session": session_id, **result})
+                await send(None)
+            else:
+                async def ignore(text):
+                    pass
+                result = await self.answer(session, prompt, ignore)
+                await respond(200, {"session": session_id, **result})
+
+STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+# just enough HTTP/1.1 to get JSON in and (streamed) JSON out, one request per connection
+async def handle_connection(service, reader, writer):
+    # set once a streamed 200 has gone out, after that errors can only go out as the last line
+    stream_send = None
+
+    async def respond(status, obj, stream=False):
+        nonlocal stream_send
+        head = f"HTTP/1.1 {status} {STATUS[status]}\r\nConnection: close\r\n"
+        if stream:
+            writer.write((head + "Content-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n\r\n").encode())
+            await writer.drain()
+
+            async def send(obj):
+                if obj is None:
+                    writer.write(b"0\r\n\r\n")
+                else:
+                    line = (json.dumps(obj) + "\n").encode()
+                    writer.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+                await writer.drain()
+            stream_send = send
+            return send
+
+        body = json.dumps(obj).encode()
+        writer.write((head + f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n").encode() + body)
+        await writer.drain()
+
+    service.pending += 1
+    try:
+        request_line = await reader.readline()
+        if not request_line:
+            return
+        method, path, _ = request_line.decode().split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, value = line.decode().split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+        if service.pending > MAX_PENDING_REQUESTS:
+            return await respond(503, {"error": "too many requests"})
+        try:
+            data = json.loads(body) if body else {}
+        except json.JSONDecodeError:
+            return await respond(400, {"error": "body is not JSON"})
+        if not isinstance(data, dict):
+            return await respond(400, {"error": "body is not a JSON object"})
+
+        # nothing else is supposed to come in on this connection, so reaching the end means the client hung up.
+        # cancelling the handler lets generate() hang up on ollama too instead of decoding for nobody
+        handler = asyncio.create_task(service.handle(method, path.split('?')[0], data, respond))
+        hung_up = asyncio.create_task(reader.read())
+        try:
+            await asyncio.wait([handler, hung_up], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            hung_up.cancel()
+            if not handler.done():
+                handler.cancel()
+                await asyncio.wait([handler])
+        if not handler.cancelled():
+            await handler
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    except Exception as e:
+        print(f"system>error handling request: {e}")
+        try:
+            if stream_send is not None:
+                await stream_send({"error": str(e)})
+                await stream_send(None)
+            else:
+                await respond(500, {"error": str(e)})
+        except Exception:
+            pass
+    finally:
+        service.pending -= 1
+        writer.close()
+
+async def serve(host=HOST, port=PORT):
+    service = QueryService(loadfiles())
+    server = await asyncio.start_server(lambda r, w: handle_connection(service, r, w), host, port)
+    print(f"system>listening on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    asyncio.run(serve())
@@ -0,0 +1,204 @@
+import bisect
+import collections
+import heapq
+import math
+import os
+import pickle
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from common import CHUNKS_1024, embed_fingerprint, files_fingerprint, chunk_size_bytes
+from store import open_store, split_key
+from tracing import span
+import tfidf
+import vectorchunk
+
+# splits the tfidf index and the vectors by time period, year by default, from the date in the file name.
+# each shard is saved to the store on its own, keyed by a fingerprint of just its files, so a new entry this year
+# only rebuilds this year's shard and the older ones (which never change) just get unpickled.
+# queries go to every shard in parallel and the top k of each get merged.
+# with a date range, shards outside it are skipped and inside a shard only the postings/rows in the range get scored.
+
+# "year" or "month"
+SHARD_PERIOD = "year"
+# results kept per shard and overall. RetrievalHandler pages through these, nobody reads 500 chunks of context
+SHARD_TOP_K = 500
+SHARD_WORKERS = min(8, os.cpu_count() or 1)
+# bump when what gets pickled for a vector shard changes
+VECTOR_SHARD_FORMAT = 2
+# a shard never reranks fewer candidates than this with the binary prefilter, however small its share of the query
+SHARD_MIN_RERANK = 200
+
+pool = ThreadPoolExecutor(max_workers=SHARD_WORKERS)
+
+def shard_of(date, period=SHARD_PERIOD):
+    return date[:7] if period == "month" else date[:4]
+
+# first and last date a shard can have chunks from, YYYY-MM-DD compares as a string
+def shard_dates(key):
+    return (f"{key}-01", f"{key}-31") if len(key) == 7 else (f"{key}-01-01", f"{key}-12-31")
+
+def shard_files(loaded_files, period=SHARD_PERIOD):
+    shards = collections.defaultdict(list)
+    for info in loaded_files:
+        shards[shard_of(info["date"], period)].append(info)
+    return dict(sorted(shards.items()))
+
+def fan_out(fn, shards):
+    return list(pool.map(fn, shards))
+
+# whether any of the shard's period is between start and end, "2019" vs "2019-06-01" compares on the year
+def shard_in_range(key, start=None, end=None):
+    return (not start or key >= start[:len(key)]) and (not end or key <= end[:len(key)])
+
+# [(shard, its metadata.Window of allowed chunks or None)] for the shards a query has to look at.
+# allowed is the metadata.Selection the filters let through, shards with none of those don't get searched at all
+def select_shards(shards, start=None, end=None, allowed=None):
+    keys = [key for key in shards if shard_in_range(key, start, end)]
+    if allowed is None:
+        return [(shards[key], None) for key in keys]
+    windows = [(shards[key], allowed.window(*shard_dates(key))) for key in keys]
+    return [(shard, window) for shard, window in windows if window]
+
+class TfidfShards:
+    # shards is {period: (index, chunk_store, corpus_size)} as tfidf.build_index returns them
+    def __init__(self, shards):
+        self.shards = shards
+        self.chunk_count = sum(len(chunk_store) for _, chunk_store, _ in shards.values())
+        # (index, token) -> postings sorted by date, made the first time a date bounded query needs them
+        self.sorted_postings = {}
+
+    # chunk ids, their dates and term frequencies, in date order so a date range is a bisect
+    def date_postings(self, index, token):
+        key = (id(index), token)
+        postings = self.sorted_postings.get(key)
+        if postings is None:
+            term_frequency = index[token][tfidf.TERM_FREQUENCY]
+            ids = sorted(term_frequency, key=split_key)
+            postings = (ids, [x.rsplit('#', 1)[0] for x in ids], [term_frequency[x] for x in ids])
+            self.sorted_postings[key] = postings
+        return postings
+
+    # idf has to be over the whole corpus or scores from different shards wouldn't compare.
+    # the document frequency is just the length of the postings, so add those up per query term
+    def idf(self, tokenized_query):
+        result = {}
+        for token in set(tokenized_query):
+            document_frequency = sum(len(index[token][tfidf.TERM_FREQUENCY]) for index, _, _ in self.shards.values() if token in index)
+            if document_frequency:
+                result[token] = math.log(self.chunk_count) - math.log(document_frequency)
+        return result
+
+    # returns [(chunk_id, score)], best first, at most k. start/end (YYYY-MM-DD) limit it to those dates,
+    # allowed (a metadata.Selection from the filters) to those chunks
+    def search(self, tokenized_query, k=SHARD_TOP_K, start=None, end=None, allowed=None):
+        shards = select_shards(self.shards, start, end, allowed)
+        with span("score", shards=len(shards), terms=len(tokenized_query)):
+            # still over the whole corpus, a word being rare overall is what matters
+            idf = self.idf(tokenized_query)
+
+            def search_shard(shard_and_allowed):
+                (index, _, _), allowed = shard_and_allowed
+                combined_scores = collections.Counter()
+                for token in tokenized_query:
+                    if token not in idf or token not in index:
+                        continue
+                    if start or end:
+                        ids, dates, frequencies = self.date_postings(index, token)
+                        lo = bisect.bisect_left(dates, start) if start else 0
+                        hi = bisect.bisect_right(dates, end) if end else len(ids)
+                        for chunk_id, frequency in zip(ids[lo:hi], frequencies[lo:hi]):
+                            if allowed is None or chunk_id in allowed:
+                                combined_scores[chunk_id] += frequency * idf[token]
+                        continue
+                    term_frequency = index[token][tfidf.TERM_FREQUENCY]
+                    if allowed is not None:
+                        # walk whichever side is shorter, the shard's bits or the postings
+                        if len(allowed) < len(term_frequency):
+                            for chunk_id in allowed:
+                                if chunk_id in term_frequency:
+                                    combined_scores[chunk_id] += term_frequency[chunk_id] * idf[token]
+                        else:
+                            for chunk_id, frequency in term_frequency.items():
+                                if chunk_id in allowed:
+                                    combined_scores[chunk_id] += frequency * idf[token]
+                        continue
+                    for chunk_id in term_frequency.keys():
+                        combined_scores[chunk_id] += term_frequency[chunk_id] * idf[token]
+                return combined_scores.most_common(k)
+
+            results = fan_out(search_shard, shards)
+            return heapq.nlargest(k, (x for result in results for x in result), key=lambda x: x[1])
+
+    def chunk_store(self):
+        merged = {}
+        for _, chunk_store, _ in self.shards.values():
+            merged.update(chunk_store)
+        return merged
+
+class VectorShards:
+    # shards is {period: vectorchunk.VectorIndex}
+    def __init__(self, shards):
+        self.shards = shards
+
+    def search(self, embedded_query, k=SHARD_TOP_K, start=None, end=None, allowed=None):
+        shards = select_shards(self.shards, start, end, allowed)
+        # a year is far below where the binary prefilter pays off, but the query scans every shard, so whether
+        # it's used goes by all of them together. each shard then reranks its share of the candidates
+        sizes = [shard.row_count(start, end) for shard, _ in shards]
+        total = sum(sizes)
+        binary = total >= vectorchunk.BINARY_PREFILTER_MIN_CHUNKS
+
+        def search_shard(x):
+            (shard, shard_allowed), size = x
+            rerank = max(SHARD_MIN_RERANK, math.ceil(vectorchunk.BINARY_RERANK * size / max(total, 1)))
+            return shard.search(embedded_query, binary=binary, start=start, end=end, allowed=shard_allowed, rerank=rerank)[:k]
+
+        with span("score", shards=len(shards), binary=binary):
+            # numpy lets go of the GIL during the scans, so the shards really do run at the same time
+            results = fan_out(search_shard, list(zip(shards, sizes)))
+            return heapq.nlargest(k, (x for result in results for x in result), key=lambda x: x[1])
+
+def shard_version(files, *extra):
+    hash_input = pickle.dumps([chunk_size_bytes, files_fingerprint(files), *extra])
+    return hashlib.sha256(hash_input).hexdigest()[:16]
+
+# returns TfidfShards, the chunk store and the corpus size
+def load_tfidf_shards(loaded_files, store=None, period=SHARD_PERIOD):
+    store = store or open_store()
+    shards = {}
+    rebuilt = []
+    for key, files in shard_files(loaded_files, period).items():
+        version = shard_version(files)
+        shard = store.get_blob(f"tfidf_shard:{key}", version)
+        if shard is None:
+            shard = tfidf.build_index(files)
+            store.put_blob(f"tfidf_shard:{key}", version, shard)
+            rebuilt.append(key)
+        shards[key] = shard
+    print(f"Loaded {len(shards)} tfidf shards, rebuilt {', '.join(rebuilt) or 'none'}.")
+    index = TfidfShards(shards)
+    return index, index.chunk_store(), sum(corpus_size for _, _, corpus_size in shards.values())
+
+# builds (or loads) a VectorIndex per shard from the vectors vectorchunk.load_vectors saved.
+# a shard is keyed on the embeddings stored for its dates, so only the shards that are missing or changed read theirs
+def load_vector_shards(loaded_files, store=None, period=SHARD_PERIOD):
+    store = store or open_store()
+    fingerprint = embed_fingerprint()
+    embed_version = vectorchunk.embed_version()
+
+    shards = {}
+    rebuilt = []
+    for key, files in shard_files(loaded_files, period).items():
+        start, end = shard_dates(key)
+        stamp = store.stamp(vectorchunk.STAGE, embed_version, CHUNKS_1024, start, end)
+        version = shard_version(files, fingerprint, stamp, VECTOR_SHARD_FORMAT)
+        shard = store.get_blob(f"vector_shard:{key}", version)
+        if shard is None:
+            vectors = store.get_range(vectorchunk.STAGE, embed_version, CHUNKS_1024, start, end)
+            shard = vectorchunk.VectorIndex(vectors)
+            store.put_blob(f"vector_shard:{key}", version, shard)
+            rebuilt.append(key)
+        shards[key] = shard
+    print(f"Loaded {len(shards)} vector shards, rebuilt {', '.join(rebuilt) or 'none'}.")
+    return VectorShards(shards)
@@ -0,0 +1,262 @@
+import hashlib
+import os
+import pickle
+import re
+import sqlite3
+import sys
+import time
+
+from common import CHUNKS_1024, SMALLOVERLAP_8192
+
+# one sqlite file for everything the scripts compute per chunk, instead of a pickle per script.
+# chunks get an integer id, and every stage (embed, sentiment, ...) gets its own table keyed by (chunk id, stage version).
+# the version is the same hash the scripts used to put in the pickle file names, so changing a model/size still invalidates.
+STORE_FILE = "documentattention.db"
+
+# old pickle name -> [(stage, chunker, key in the pickle)]
+PICKLE_STAGES = {
+    "embeddings.pkl": [("embed", CHUNKS_1024, "document_vectors")],
+    "attention.pkl": [("attention", CHUNKS_1024, "dimension_vectors")],
+    "relationships.pkl": [("relationships", SMALLOVERLAP_8192, "relationships_store")],
+    "sentiment.pkl": [("sentiment", SMALLOVERLAP_8192, "sentiment_store")],
+    "my_sentiment.pkl": [("my_sentiment", SMALLOVERLAP_8192, "sentiment_store"), ("summary", SMALLOVERLAP_8192, "summary_store")],
+    "info.pkl": [("info", SMALLOVERLAP_8192, "info_store")],
+}
+
+def split_key(key):
+    date, i = key.rsplit('#', 1)
+    return date, int(i)
+
+class ArtifactStore:
+    def __init__(self, path=STORE_FILE):
+        self.path = path
+        # pipeline stages write from their own connections at the same time, so wait for the lock instead of failing
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS chunks (
+            id INTEGER PRIMARY KEY,
+            chunker TEXT NOT NULL,
+            key TEXT NOT NULL,
+            date TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            text TEXT,
+            UNIQUE (chunker, key))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS chunks_by_date ON chunks (chunker, date, idx)")
+        # stage -> newest version written, and which pickles were already migrated
+        self.db.execute("CREATE TABLE IF NOT EXISTS stages (stage TEXT PRIMARY KEY, version TEXT NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS migrated (file TEXT PRIMARY KEY)")
+        # things that aren't per chunk, like the whole tfidf index
+        self.db.execute("CREATE TABLE IF NOT EXISTS blobs (name TEXT PRIMARY KEY, version TEXT NOT NULL, value BLOB)")
+        # fingerprint of the inputs each pipeline stage last finished with
+        self.db.execute("CREATE TABLE IF NOT EXISTS pipeline (stage TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, finished REAL NOT NULL)")
+        self.db.commit()
+        self.tables = set()
+        self.chunk_ids = {}
+
+    def table(self, stage):
+        name = "artifact_" + re.sub(r'\W', '_', stage)
+        if name not in self.tables:
+            self.db.execute(f"""CREATE TABLE IF NOT EXISTS {name} (
+                chunk_id INTEGER NOT NULL REFERENCES chunks (id),
+                version TEXT NOT NULL,
+                value BLOB,
+                PRIMARY KEY (version, chunk_id))""")
+            self.tables.add(name)
+        return name
+
+    # returns the integer id of a chunk, adding it if it's new. text is optional, but keeps it up to date if given
+    def chunk_id(self, chunker, key, text=None):
+        cached = self.chunk_ids.get((chunker, key))
+        if cached is not None and text is None:
+            return cached
+        date, i = split_key(key)
+        self.db.execute("INSERT OR IGNORE INTO chunks (chunker, key, date, idx, text) VALUES (?, ?, ?, ?, ?)", (chunker, key, date, i, text))
+        if text is not None:
+            self.db.execute("UPDATE chunks SET text = ? WHERE chunker = ? AND key = ? AND (text IS NULL OR text != ?)", (text, chunker, key, text))
+        row = self.db.execute("SELECT id FROM chunks WHERE chunker = ? AND key = ?", (chunker, key)).fetchone()
+        self.chunk_ids[(chunker, key)] = row[0]
+        return row[0]
+
+    def add_chunks(self, chunker, date, chunks):
+        return [self.chunk_id(chunker, f"{date}#{i}", chunk) for i, chunk in enumerate(chunks)]
+
+    # writes go into the open transaction, call commit() every so often (or use `with store.db:`)
+    def put(self, stage, version, chunker, key, value):
+        chunk_id = self.chunk_id(chunker, key)
+        self.db.execute(f"INSERT OR REPLACE INTO {self.table(stage)} (chunk_id, version, value) VALUES (?, ?, ?)", (chunk_id, version, pickle.dumps(value)))
+        self.db.execute("INSERT OR REPLACE INTO stages (stage, version) VALUES (?, ?)", (stage, version))
+
+    def put_many(self, stage, version, chunker, values):
+        with self.db:
+            for key, value in values.items():
+                self.put(stage, version, chunker, key, value)
+
+    def commit(self):
+        self.db.commit()
+
+    def __rows(self, stage, version, chunker, where="", params=()):
+        return self.db.execute(
+            f"SELECT c.key, a.value FROM {self.table(stage)} a JOIN chunks c ON c.id = a.chunk_id "
+            f"WHERE a.version = ? AND c.chunker = ? {where} ORDER BY c.date, c.idx",
+            (version, chunker, *params))
+
+    # everything for a stage, or just the given keys
+    def get(self, stage, version, chunker, keys=None):
+        if keys is None:
+            return {key: pickle.loads(value) for key, value in self.__rows(stage, version, chunker)}
+        result = {}
+        keys = list(keys)
+        # sqlite has a limit on the number of parameters
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start+500]
+            where = f"AND c.key IN ({','.join('?' * len(batch))})"
+            result.update({key: pickle.loads(value) for key, value in self.__rows(stage, version, chunker, where, batch)})
+        return result
+
+    # chunks with start <= date <= end, dates are YYYY-MM-DD so string comparison works
+    def get_range(self, stage, version, chunker, start=None, end=None):
+        where = ""
+        params = []
+        if start is not None:
+            where += " AND c.date >= ?"
+            params.append(start)
+        if end is not None:
+            where += " AND c.date <= ?"
+            params.append(end)
+        return {key: pickle.loads(value) for key, value in self.__rows(stage, version, chunker, where, params)}
+
+    # which chunks a stage already has, without loading the values
+    def done_keys(self, stage, version, chunker):
+        return {row[0] for row in self.db.execute(
+            f"SELECT c.key FROM {self.table(stage)} a JOIN chunks c ON c.id = a.chunk_id WHERE a.version = ? AND c.chunker = ?",
+            (version, chunker))}
+
+    # (chunk id, key, date, index in the file, value) for everything a stage has, in date order
+    def records(self, stage, version, chunker):
+        return [(chunk_id, key, date, i, pickle.loads(value)) for chunk_id, key, date, i, value in self.db.execute(
+            f"SELECT c.id, c.key, c.date, c.idx, a.value FROM {self.table(stage)} a JOIN chunks c ON c.id = a.chunk_id "
+            f"WHERE a.version = ? AND c.chunker = ? ORDER BY c.date, c.idx",
+            (version, chunker))]
+
+    # changes whenever a chunk gets written or deleted for a stage, without reading any values. replacing a row gives it a new rowid.
+    # with start/end (and the chunker), only for the chunks between those dates
+    def stamp(self, stage, version, chunker=None, start=None, end=None):
+        if start is None and end is None:
+            count, last = self.db.execute(f"SELECT count(*), max(rowid) FROM {self.table(stage)} WHERE version = ?", (version,)).fetchone()
+            return f"{count}:{last}"
+        count, last = self.db.execute(
+            f"SELECT count(*), max(a.rowid) FROM {self.table(stage)} a JOIN chunks c ON c.id = a.chunk_id "
+            f"WHERE a.version = ? AND c.chunker = ? AND c.date >= ? AND c.date <= ?",
+            (version, chunker, start or "", end or "\uffff")).fetchone()
+        return f"{count}:{last}"
+
+    # a short hash of each chunk's stored value, to tell which ones changed since something was built from them without unpickling anything
+    def digests(self, stage, version, chunker):
+        return {row[0]: hashlib.blake2b(row[1], digest_size=8).hexdigest() for row in self.db.execute(
+            f"SELECT c.key, a.value FROM {self.table(stage)} a JOIN chunks c ON c.id = a.chunk_id WHERE a.version = ? AND c.chunker = ?",
+            (version, chunker))}
+
+    # drops what a stage has for the given chunks, like the ones past the end of a file that got shorter
+    def delete(self, stage, version, chunker, keys):
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start+500]
+            self.db.execute(
+                f"DELETE FROM {self.table(stage)} WHERE version = ? AND chunk_id IN "
+                f"(SELECT id FROM chunks WHERE chunker = ? AND key IN ({','.join('?' * len(batch))}))",
+                (version, chunker, *batch))
+
+    def put_blob(self, name, version, value):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO blobs (name, version, value) VALUES (?, ?, ?)", (name, version, pickle.dumps(value)))
+
+    # None if it's missing or was saved for another version
+    def get_blob(self, name, version):
+        row = self.db.execute("SELECT value FROM blobs WHERE name = ? AND version = ?", (name, version)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    # drops the blobs whose name starts with prefix, except the ones in keep
+    def delete_blobs(self, prefix, keep=()):
+        keep = set(keep)
+        names = [row[0] for row in self.db.execute("SELECT name FROM blobs WHERE substr(name, 1, ?) = ?", (len(prefix), prefix))]
+        with self.db:
+            self.db.executemany("DELETE FROM blobs WHERE name = ?", [(name,) for name in names if name not in keep])
+
+    def stage_fingerprint(self, stage):
+        row = self.db.execute("SELECT fingerprint FROM pipeline WHERE stage = ?", (stage,)).fetchone()
+        return row[0] if row else None
+
+    def set_stage_fingerprint(self, stage, fingerprint):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO pipeline (stage, fingerprint, finished) VALUES (?, ?, ?)", (stage, fingerprint, time.time()))
+
+    def latest_version(self, stage):
+        row = self.db.execute("SELECT version FROM stages WHERE stage = ?", (stage,)).fetchone()
+        return row[0] if row else None
+
+    def chunk_texts(self, chunker, start=None, end=None):
+        where = ""
+        params = [chunker]
+        if start is not None:
+            where += " AND date >= ?"
+            params.append(start)
+        if end is not None:
+            where += " AND date <= ?"
+            params.append(end)
+        return {key: text for key, text in self.db.execute(f"SELECT key, text FROM chunks WHERE chunker = ? {where} ORDER BY date, idx", params)}
+
+    # sqlite keeps the pages freed by deletes and rewrites (like compacting the relationships) for reuse, the file only
+    # gets smaller with a vacuum. it rewrites the whole file and needs the only connection to it, so it's not done by the
+    # stages themselves, python pipeline.py --vacuum runs it once they're done
+    # returns the bytes it freed
+    def vacuum(self):
+        def size():
+            return sum(os.path.getsize(x) for x in (self.path, self.path + "-wal") if os.path.exists(x))
+        self.db.commit()
+        before = size()
+        self.db.execute("VACUUM")
+        # in wal mode the vacuumed pages go to the log first, the checkpoint puts them back and truncates the log
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return before - size()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+# copies the old {hash[:7]}-*.pkl files into the store, once. the pickles are left alone
+def migrate_pickles(store, directory='.'):
+    pattern = re.compile(r"^([0-9a-f]{7})-(" + "|".join(re.escape(x) for x in PICKLE_STAGES) + r")$")
+    already = {row[0] for row in store.db.execute("SELECT file FROM migrated")}
+    for file_name in sorted(os.listdir(directory)):
+        match = pattern.match(file_name)
+        if not match or file_name in already:
+            continue
+        version, kind = match.groups()
+        try:
+            with open(os.path.join(directory, file_name), 'rb') as f:
+                saved_data = pickle.load(f)
+        except (pickle.PickleError, EOFError) as e:
+            print(f"Could not read {file_name}, skipping: {e}")
+            continue
+        with store.db:
+            for stage, chunker, field in PICKLE_STAGES[kind]:
+                values = saved_data.get(field, {})
+                for key, value in values.items():
+                    store.put(stage, version, chunker, key, value)
+                print(f"Migrated {len(values)} {stage} entries from {file_name}")
+            store.db.execute("INSERT INTO migrated (file) VALUES (?)", (file_name,))
+
+# the scripts use this. first time the store gets created it picks up whatever pickles are lying around
+def open_store(path=STORE_FILE):
+    fresh = not os.path.exists(path)
+    store = ArtifactStore(path)
+    if fresh:
+        migrate_pickles(store, os.path.dirname(os.path.abspath(path)))
+    return store
+
+if __name__ == "__main__":
+    # python store.py [dir with the old pickles]
+    store = ArtifactStore()
+    migrate_pickles(store, sys.argv[1] if len(sys.argv) > 1 else '.')
+    store.close()
@@ -0,0 +1,82 @@
+import os
+
+from store import SMALLOVERLAP_8192, open_store
+
+# the sentiment and location results as columnar tables, for the scripts that analyse them (sentigraph.py, happywords.py,
+# location.py) instead of each building a DataFrame out of the per-chunk dicts on every run.
+# one arrow ipc file per stage and version next to the store, uncompressed so reading it is a memory map and only the
+# columns a script asks for get touched. every table has the store's integer chunk id, the chunk key ("2020-01-01#0"),
+# the entry's date as a timestamp and the chunk's index in its file, then the stage's own columns:
+# sentiment_score (int16, null where the llm didn't give a number) or location (dictionary encoded, standardized names,
+# so the codes are small ints). a table gets rebuilt from the store when the stage wrote anything since.
+# needs pyarrow
+
+# bump when the columns change
+TABLE_FORMAT = "1"
+
+SENTIMENT_STAGES = ("sentiment", "my_sentiment")
+LOCATION_STAGES = ("info",)
+
+def tables_dir(store):
+    return os.path.splitext(store.path)[0] + ".tables"
+
+def table_path(store, stage, version):
+    return os.path.join(tables_dir(store), f"{stage}-{version}.arrow")
+
+def location_name(location):
+    from location import standardize_location
+    # the llm sometimes gives a list or a dict instead of a name
+    return standardize_location(location if isinstance(location, str) else None)
+
+def build_table(stage, records):
+    import pyarrow as pa
+
+    columns = {
+        "chunk_id": pa.array([r[0] for r in records], type=pa.int64()),
+        "key": pa.array([r[1] for r in records], type=pa.string()),
+        "date": pa.array([r[4].get("date") for r in records], type=pa.timestamp("s")),
+        "idx": pa.array([r[3] for r in records], type=pa.int32()),
+    }
+    if stage in SENTIMENT_STAGES:
+        scores = [r[4].get("sentiment_score") for r in records]
+        columns["sentiment_score"] = pa.array([x if isinstance(x, int) else None for x in scores], type=pa.int16())
+    elif stage in LOCATION_STAGES:
+        columns["location"] = pa.array([location_name(r[4].get("location")) for r in records], type=pa.string()).dictionary_encode()
+    else:
+        raise ValueError(f"No table for stage {stage}, known: {', '.join(SENTIMENT_STAGES + LOCATION_STAGES)}")
+    return pa.table(columns)
+
+def save_table(table, path, stamp):
+    import pyarrow.feather as feather
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = table.replace_schema_metadata({"stamp": stamp, "format": TABLE_FORMAT})
+    # written next to the old one and swapped in, a script reading it keeps its mapping of the old file
+    tmp_path = path + ".tmp"
+    feather.write_feather(table, tmp_path, compression="uncompressed")
+    os.replace(tmp_path, path)
+
+# the saved table if it's up to date, rebuilt from the store otherwise. columns limits what gets read
+def load_table(stage, version, columns=None, store=None):
+    import pyarrow.feather as feather
+
+    store = store or open_store()
+    path = table_path(store, stage, version)
+    stamp = store.stamp(stage, version)
+    try:
+        table = feather.read_table(path, columns=columns, memory_map=True)
+        metadata = table.schema.metadata or {}
+        if metadata.get(b"stamp") == stamp.encode() and metadata.get(b"format") == TABLE_FORMAT.encode():
+            return table
+    except (OSError, ValueError):
+        pass
+
+    records = store.records(stage, version, SMALLOVERLAP_8192)
+    table = build_table(stage, records)
+    save_table(table, path, stamp)
+    print(f"Wrote the {stage} table with {len(records)} chunks.")
+    return table.select(columns) if columns else table
+
+# load_table as a DataFrame. dates are datetime64, locations a Categorical, scores float with nan where there's none
+def load_frame(stage, version, columns=None, store=None):
+    return load_table(stage, version, columns, store).to_pandas()
@@ -0,0 +1,36 @@
+import pytest
+
+from common import parse_date_range
+
+# query -> (start, end) that gets searched
+CASES = [
+    ("what did I do in 2019", "2019-01-01", "2019-12-31"),
+    ("summer 2018 at the lake", "2018-06-01", "2018-08-31"),
+    ("winter 2019", "2019-12-01", "2020-02-29"),
+    ("between march 2017 and june 2017", "2017-03-01", "2017-06-30"),
+    ("what changed since 2020", "2020-01-01", None),
+    ("from 2017 to 2019", "2017-01-01", "2019-12-31"),
+    ("until 2019", None, "2019-12-31"),
+    ("since march 2019", "2019-03-01", None),
+    ("before 2019", None, "2018-12-31"),
+    ("after june 2018", "2018-07-01", None),
+    ("on 2019-06-15", "2019-06-15", "2019-06-15"),
+    ("walked 2000 steps", None, None),
+    ("since:2019-06", "2019-06-01", None),
+    ("until:2019", None, "2019-12-31"),
+    ("after:2018-06", "2018-07-01", None),
+    ("before:2019", None, "2018-12-31"),
+    ("after:2018-06 before:2018-09-15", "2018-07-01", "2018-09-14"),
+    # explicit filters win over the text
+    ("in 2015 since:2019", "2019-01-01", None),
+    ("what did I do in 2019 dates:all", None, None),
+]
+
+@pytest.mark.parametrize("query,start,end", CASES)
+def test_parse_date_range(query, start, end):
+    _, got_start, got_end = parse_date_range(query)
+    assert (got_start, got_end) == (start, end)
+
+def test_filters_are_taken_out():
+    assert "after:" not in parse_date_range("trips after:2018-06 with sam")[0]
+    assert parse_date_range("trips in 2019 dates:all")[0] == "trips in 2019"
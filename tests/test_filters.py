@@ -0,0 +1,26 @@
+import pytest
+
+from metadata import parse_filters
+
+KNOWN = {"new york", "boston", "nyc"}
+
+CASES = [
+    ("location == nyc dinner with anna", "dinner with anna", [("location", "==", ["nyc"])]),
+    ("location == new york what did i eat", "what did i eat", [("location", "==", ["new york"])]),
+    ("what did i eat location == new york", "what did i eat", [("location", "==", ["new york"])]),
+    ("location == new york,boston trips", "trips", [("location", "==", ["new york", "boston"])]),
+    ("location == 'new york' dinner", "dinner", [("location", "==", ["new york"])]),
+    # not a location there's data for, so only the first word
+    ("location == paris france trip", "france trip", [("location", "==", ["paris"])]),
+    ("location == nyc sentiment < 30 dinner", "dinner", [("location", "==", ["nyc"]), ("sentiment", "<", [30])]),
+    ("year in 2016 what happened", "what happened", [("year", "==", [2016])]),
+    ("year in 2016..2018 trips", "trips", [("year", "==", (2016, 2018))]),
+    ("the year in review", "the year in review", []),
+]
+
+@pytest.mark.parametrize("query,rest,filters", CASES)
+def test_parse_filters(query, rest, filters):
+    assert parse_filters(query, KNOWN) == (rest, filters)
+
+def test_without_known_locations_takes_one_word():
+    assert parse_filters("location == new york") == ("york", [("location", "==", ["new"])])
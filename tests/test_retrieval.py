@@ -0,0 +1,26 @@
+from common import RetrievalHandler
+
+DATE = "2019-06-15"
+STRIDE = 512
+
+# a file cut into 1024 byte chunks every 512 bytes, like chunkenize does
+def chunk_store(content):
+    count = (len(content) - STRIDE) // STRIDE
+    return {f"{DATE}#{i}": DATE + "\n" + content[i*STRIDE:i*STRIDE + 2*STRIDE] for i in range(count)}
+
+def test_bridging_hit_joins_spans():
+    # numbered lines so every slice of the file is unique
+    content = "".join(f"{n:07d}\n" for n in range(512))
+    store = chunk_store(content)
+    # 0 and 4 don't touch, 2 overlaps both
+    scores = [(f"{DATE}#0", 0.9), (f"{DATE}#4", 0.8), (f"{DATE}#2", 0.7)]
+    holder = RetrievalHandler("query", scores, store, stride=STRIDE)
+    prompt = holder.build_prompt()
+
+    assert holder.last_page == [f"{DATE}#0", f"{DATE}#2", f"{DATE}#4"]
+    # one span, the shared text only once
+    assert DATE + "\n" + content[:6*STRIDE] in prompt
+    assert prompt.count(content[STRIDE:2*STRIDE]) == 1
+    assert prompt.count(content[4*STRIDE:5*STRIDE]) == 1
+    assert "\n...\n" not in prompt
+    assert not holder.has_more()
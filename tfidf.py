@@ -1,125 +1,154 @@
 import collections
 import math
-import json
 
-from common import RetrievalHandler, TimerLogger, chunkenize, expand, llm, loadfiles, tokenize, chunk_size_bytes
+from common import LLM_MODEL, Prefetcher, RetrievalHandler, TimerLogger, chunks_for, expand, llm, loadfiles, parse_date_range, tokenize
+from store import CHUNKS_1024
+from tracing import span
 
 INVERSE_DOCUMENT_FREQUENCY = "INVERSE_DOCUMENT_FREQUENCY"
 TERM_FREQUENCY = "TERM_FREQUENCY"
 
-preprocessing_timer = TimerLogger("Preprocessing")
+def build_index(loaded_files):
+    corpus_size = 0
 
-corpus_size = 0
+    index = {}
+    chunk_store = {}
 
-index = {}
-chunk_store = {}
+    for info in loaded_files:
+        date = info["date"]
+        #print(date)
+        content = info["content"]
+        corpus_size += len(content)
 
-loaded_files = loadfiles()
+        chunks = chunks_for(info, CHUNKS_1024)
 
-for info in loaded_files:
-    date = info["date"]
-    #print(date)
-    content = info["content"]
-    corpus_size += len(content)
+        for i, chunk in enumerate(chunks):
+            id = f"{date}#{i}"
 
-    chunks = chunkenize(content)
+            # works a bit better with the date
+            chunk_store[id] = date + "\n" + chunk
 
-    for i, chunk in enumerate(chunks):
-        id = f"{date}#{i}"
+            tokens = tokenize(chunk)
+            document_len = len(tokens)
+            for token in tokens:
+                if token not in index:
+                    index[token] = {TERM_FREQUENCY: collections.Counter()}
+                index[token][TERM_FREQUENCY][id] += 1.0/document_len
 
-        # works a bit better with the date
-        chunk_store[id] = date + "\n" + chunk
+    chunk_count = len(chunk_store)
+    log_chunk_count = math.log(chunk_count)
 
-        tokens = tokenize(chunk)
-        document_len = len(tokens)
-        for token in tokens:
+    for k,v in index.items():
+        v[INVERSE_DOCUMENT_FREQUENCY] = log_chunk_count - math.log(len(v[TERM_FREQUENCY]))
+
+    # doesn't really matter unless you're looking for stopwords. slows down initialization a bit
+    #total_term_frequencies = collections.Counter()
+    #for token, data in index.items():
+        #total_term_frequencies[token] = sum(data[TERM_FREQUENCY].values())
+
+    # Find the most commonly used word
+    #print(total_term_frequencies.most_common()[:10])
+
+    return index, chunk_store, corpus_size
+
+# returns [(chunk_id, score)], best first
+def search(index, tokenized_query):
+    combined_scores = collections.Counter()
+
+    with span("score", terms=len(tokenized_query)) as score_span:
+        for token in tokenized_query:
             if token not in index:
-                index[token] = {TERM_FREQUENCY: collections.Counter()}
-            index[token][TERM_FREQUENCY][id] += 1.0/document_len
+                continue
 
-chunk_count = len(chunk_store)
-log_chunk_count = math.log(chunk_count)
+            index_entry = index[token]
 
-for k,v in index.items():
-    v[INVERSE_DOCUMENT_FREQUENCY] = log_chunk_count - math.log(len(v[TERM_FREQUENCY]))
+            inverse_document_frequency = index_entry[INVERSE_DOCUMENT_FREQUENCY]
+            term_frequency = index_entry[TERM_FREQUENCY]
 
-# doesn't really matter unless you're looking for stopwords. slows down initialization a bit
-#total_term_frequencies = collections.Counter()
-#for token, data in index.items():
-    #total_term_frequencies[token] = sum(data[TERM_FREQUENCY].values())
+            # Calculate score for each chunk_id
+            for chunk_id in term_frequency.keys():
+                combined_scores[chunk_id] += term_frequency[chunk_id] * inverse_document_frequency
 
-# Find the most commonly used word
-#print(total_term_frequencies.most_common()[:10])
+        score_span.set(chunks=len(combined_scores))
+        return combined_scores.most_common()
 
-preprocessing_timer.stop_and_log(corpus_size)
+def main(journal_dir=None):
+    preprocessing_timer = TimerLogger("Preprocessing")
 
-holder = False
+    from shards import load_tfidf_shards
+    from metadata import QueryFilters
 
-while True:
-    query = input("user>")
-    query_timer = TimerLogger("Query")
+    # one index per year, saved separately so only the current year gets rebuilt
+    index, chunk_store, corpus_size = load_tfidf_shards(loadfiles(journal_dir))
 
-    if query == 'more' and holder != False and holder.has_more():  
-        # special case
-        # get next 7 or so results
-        prompt = holder.build_prompt()
+    preprocessing_timer.stop_and_log(corpus_size)
 
-        out, stats = llm(prompt, log=True, user_log=False, format='json', response_stream=False)
+    # "location == nyc", "sentiment < 30", "year in 2016..2018" in a query
+    query_filters = QueryFilters(chunk_store.keys())
 
-        prompt_tokens = stats["prompt_eval_count"]
-        #print(f"{prompt_tokens} tokens in the prompt, {stats["eval_count"]} tokens in response, {prompt_tokens/chunks_per_query:.2f} tokens per chunk, {chunk_size_bytes/(prompt_tokens/chunks_per_query):.2f} estimated bytes per token, another estimate: {len(prompt)/prompt_tokens:.2f}")
-        obj = json.loads(out.strip())
-        #print(obj["response"])
+    holder = False
 
-    else:
+    # start generating the next page in the background after each answer, so `more` is instant
+    prefetch_next_page = True
+    prefetcher = Prefetcher(format='json')
 
-        expanded_query = query + expand(query, type='tfidf')
+    while True:
+        query = input("user>")
+        query_timer = TimerLogger("Query")
 
-        tokenized_query = tokenize(expanded_query)
+        if query == 'more' and holder != False and (holder.has_more() or prefetcher.pending(holder)):
+            # special case
+            # get next 7 or so results
+            prefetched = prefetcher.take(holder)
+            if prefetched and prefetched[1] is not None:
+                prompt, out, stats = prefetched
+                print(f"{LLM_MODEL}>{out}")
+            else:
+                prompt = prefetched[0] if prefetched else holder.build_prompt()
+                out, stats = llm(prompt, log=True, user_log=False, format='json', response_stream=False)
 
-        print(tokenized_query)
-    
-        combined_scores = collections.Counter()
-    
-        for token in tokenized_query:
-            if token not in index:
-                continue
-    
-            index_entry = index[token]
-            
-            inverse_document_frequency = index_entry[INVERSE_DOCUMENT_FREQUENCY]
-            term_frequency = index_entry[TERM_FREQUENCY]
-    
-            scores = []
-    
-            # Calculate score for each chunk_id and chunk_store it in the list
-            for chunk_id in term_frequency.keys():
-                score = term_frequency[chunk_id] * inverse_document_frequency
-    
-                combined_scores[chunk_id] += score
-    
-                scores.append((score, chunk_id))
-            
-            # Sort the scores in descending order
-        #sorted_scores = sorted(scores, key=lambda x: x[0], reverse=True)
-            
-            # Print the top 7 scores and chunk_ids
-
-        chunks_per_query = 10
-    
-        sorted_combined_scores = combined_scores.most_common()
-        #for chunk_id, score in sorted_combined_scores[:chunks_per_query]:
-            #print(score, chunk_id)
-            #print(score, chunk_store[chunk_id])
-
-        holder = RetrievalHandler(query, sorted_combined_scores, chunk_store, chunks_per_query)
-        prompt = holder.build_prompt()
-
-        out, stats = llm(prompt, log=True, user_log=False, format='json', response_stream=False)
-
-        prompt_tokens = stats["prompt_eval_count"]
-        print(f"{prompt_tokens} tokens in the prompt, {stats["eval_count"]} tokens in response, {prompt_tokens/chunks_per_query:.2f} tokens per chunk, {chunk_size_bytes/(prompt_tokens/chunks_per_query):.2f} estimated bytes per token, another estimate: {len(prompt)/prompt_tokens:.2f}")
-        #obj = json.loads(out.strip())
-        #print(obj["response"])
-    
-    query_timer.stop_and_log(corpus_size)
\ No newline at end of file
+            prompt_tokens = stats.get("prompt_eval_count", 0)
+            #print(f"{prompt_tokens} tokens in the prompt, {stats["eval_count"]} tokens in response, {len(holder.last_page)} chunks packed into {holder.last_page_tokens} context tokens, {len(prompt)/prompt_tokens:.2f} bytes per token")
+            #obj = json.loads(out.strip())
+            #print(obj["response"])
+
+        else:
+            # new question, the old page is useless now and we need the model
+            prefetcher.cancel()
+
+            query, allowed = query_filters.apply(query)
+            # "in march 2019" or "after:2018-06" only scores chunks from those dates
+            query, start, end = parse_date_range(query)
+            if start or end:
+                print(f"system>only searching {start or 'the start'} to {end or 'now'}")
+
+            expanded_query = query + expand(query, type='tfidf')
+
+            tokenized_query = tokenize(expanded_query)
+
+            print(tokenized_query)
+
+            chunks_per_query = 10
+
+            sorted_combined_scores = index.search(tokenized_query, start=start, end=end, allowed=allowed)
+            #for chunk_id, score in sorted_combined_scores[:chunks_per_query]:
+                #print(score, chunk_id)
+                #print(score, chunk_store[chunk_id])
+
+            holder = RetrievalHandler(query, sorted_combined_scores, chunk_store, chunks_per_query)
+            prompt = holder.build_prompt()
+
+            out, stats = llm(prompt, log=True, user_log=False, format='json', response_stream=False)
+
+            prompt_tokens = stats.get("prompt_eval_count", 0)
+            print(f"{prompt_tokens} tokens in the prompt, {stats["eval_count"]} tokens in response, {len(holder.last_page)} chunks packed into {holder.last_page_tokens} context tokens, {len(prompt)/prompt_tokens:.2f} bytes per token")
+            #obj = json.loads(out.strip())
+            #print(obj["response"])
+
+        if prefetch_next_page:
+            prefetcher.start(holder)
+
+        query_timer.stop_and_log(corpus_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+import atexit
+import json
+import os
+import threading
+import time
+
+# nested timing spans, for seeing where a query or the preprocessing actually spends its time.
+# off by default, turn it on with DOCUMENTATTENTION_TRACE=trace.json (or --trace on the cli).
+# when it's on, everything gets written as a chrome trace on exit (open it in chrome://tracing or ui.perfetto.dev)
+# and a summary table gets printed.
+# when it's off span() just hands back the same do-nothing object, so it's fine to leave spans in hot loops.
+
+TRACE_ENV = "DOCUMENTATTENTION_TRACE"
+
+class Span:
+    __slots__ = ("tracer", "name", "path", "args", "start", "end", "tid")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    # add things learned while the span was open, like token counts
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+        self.path = stack[-1].path + "/" + self.name if stack else self.name
+        stack.append(self)
+        self.tid = threading.get_ident()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.end = time.perf_counter_ns()
+        stack = self.tracer.stack()
+        # generators can close their span from somewhere else, so don't assume it's on top
+        if self in stack:
+            stack.remove(self)
+        self.tracer.add(self)
+        return False
+
+class NullSpan:
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.spans = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter_ns()
+
+    # path is where the chrome trace goes on exit, None just keeps the spans around for summary()
+    def enable(self, path=None):
+        if not self.enabled:
+            atexit.register(self.finish)
+        self.enabled = True
+        self.path = path
+
+    def stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    # for things that already happened, like the timings ollama reports back. nests under whatever span is open
+    def record(self, name, start_ns, end_ns, **args):
+        if not self.enabled:
+            return
+        span = Span(self, name, args)
+        stack = self.stack()
+        span.path = stack[-1].path + "/" + name if stack else name
+        span.tid = threading.get_ident()
+        span.start = start_ns
+        span.end = end_ns
+        self.add(span)
+
+    # ollama says how long loading, prefill (prompt_eval) and decode (eval) took, in ns.
+    # they happened back to back just before the response finished, so put them there
+    def llm_stats(self, stats, end_ns=None):
+        if not self.enabled or not stats:
+            return
+        end_ns = end_ns or time.perf_counter_ns()
+        prompt_tokens = stats.get("prompt_eval_count") or 0
+        response_tokens = stats.get("eval_count") or 0
+        decode_ns = stats.get("eval_duration") or 0
+        prefill_ns = stats.get("prompt_eval_duration") or 0
+        load_ns = stats.get("load_duration") or 0
+
+        decode_start = end_ns - decode_ns
+        prefill_start = decode_start - prefill_ns
+        if load_ns:
+            self.record("load model", prefill_start - load_ns, prefill_start)
+        if prefill_ns:
+            self.record("prefill", prefill_start, decode_start, tokens=prompt_tokens, tokens_per_second=round(prompt_tokens / (prefill_ns / 1e9), 1))
+        if decode_ns:
+            self.record("decode", decode_start, end_ns, tokens=response_tokens, tokens_per_second=round(response_tokens / (decode_ns / 1e9), 1))
+
+        stack = self.stack()
+        if stack:
+            stack[-1].set(prompt_tokens=prompt_tokens, response_tokens=response_tokens)
+
+    def chrome_trace(self):
+        pid = os.getpid()
+        with self.lock:
+            spans = list(self.spans)
+        events = []
+        for span in spans:
+            events.append({
+                "name": span.name,
+                "cat": span.path.split("/")[0],
+                "ph": "X",
+                "ts": (span.start - self.origin) / 1000,
+                "dur": (span.end - span.start) / 1000,
+                "pid": pid,
+                "tid": span.tid,
+                "args": span.args,
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export_chrome(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f, default=str)
+
+    # one row per span path: how many, total/mean/max ms, and the tokens if it had any
+    def summary(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        rows = {}
+        for span in spans:
+            row = rows.setdefault(span.path, {"path": span.path, "count": 0, "total_ms": 0.0, "max_ms": 0.0, "tokens": 0})
+            ms = (span.end - span.start) / 1e6
+            row["count"] += 1
+            row["total_ms"] += ms
+            row["max_ms"] = max(row["max_ms"], ms)
+            row["tokens"] += span.args.get("tokens", 0)
+        for row in rows.values():
+            row["mean_ms"] = row["total_ms"] / row["count"]
+        return sorted(rows.values(), key=lambda row: row["path"])
+
+    def print_summary(self):
+        rows = self.summary()
+        if not rows:
+            return
+        width = max(len(row["path"]) for row in rows)
+        print(f"{'span':<{width}} {'count':>7} {'total ms':>10} {'mean ms':>9} {'max ms':>9} {'tokens':>8}")
+        for row in rows:
+            tokens = row["tokens"] or ""
+            print(f"{row['path']:<{width}} {row['count']:>7} {row['total_ms']:>10.1f} {row['mean_ms']:>9.2f} {row['max_ms']:>9.1f} {tokens:>8}")
+
+    def finish(self):
+        if not self.spans:
+            return
+        self.print_summary()
+        if self.path:
+            self.export_chrome(self.path)
+            print(f"Wrote {len(self.spans)} spans to {self.path}")
+
+# the old one-shot timer the scripts print their ms/MB with. it's a span now too, so it lines up with everything else in the trace
+class TimerLogger:
+    def __init__(self, label):
+        self.label = label
+        self.start_ns = time.perf_counter_ns()
+
+    # starts over, for timers made before the thing they time
+    def start(self):
+        self.start_ns = time.perf_counter_ns()
+
+    def stop_and_log(self, corpus_size):
+        end_ns = time.perf_counter_ns()
+        tracer.record(self.label, self.start_ns, end_ns, bytes=corpus_size)
+        elapsed_time = (end_ns - self.start_ns) / 1e9
+        if corpus_size == 0:
+            print(f"{self.label} stats: {elapsed_time * 1000:.2f} milliseconds, no data")
+            return
+        print(f"{self.label} stats: {elapsed_time * 1000:.2f} milliseconds, {corpus_size} bytes, {(elapsed_time * 1000 / corpus_size) * 1024 * 1024:.2f} milliseconds/MB, {(elapsed_time / corpus_size) * 1024*1024:.4f} seconds/MB")
+
+tracer = Tracer()
+span = tracer.span
+
+if os.environ.get(TRACE_ENV):
+    tracer.enable(os.environ[TRACE_ENV])
@@ -1,147 +1,323 @@
 import collections
 import json
 import pickle
-import os
 import hashlib
-import tempfile
 
-from common import ChatHistory, RetrievalHandler, TimerLogger, chunkenize, cos_similarity, embed, expand, llm, loadfiles, chunk_size_bytes
+from common import LLM_MODEL, ChatHistory, JsonStreamer, Prefetcher, RetrievalHandler, TimerLogger, chunks_for, cos_similarity, embed, embed_batch, embed_fingerprint, expand, llm, loadfiles, parse_date_range, chunk_size_bytes
+from store import CHUNKS_1024, open_store, split_key
+from tracing import span
+
+# optional, without it searching falls back to the pure python loop
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 DOCUMENT_FREQUENCY = "DOCUMENT_FREQUENCY"
 INVERSE_DOCUMENT_FREQUENCY = "INVERSE_DOCUMENT_FREQUENCY"
 TERM_FREQUENCY = "TERM_FREQUENCY"
 
-preprocessing_timer = TimerLogger("Preprocessing")
-
-corpus_size = 0
-
-EMBED_MODEL = 'nomic-embed-text'
-
-EMBEDDINGS_FILE = "embeddings.pkl"
+STAGE = "embed"
 
-document_vectors = {}
-# starting to think it might not be a good idea to store chunks, as we basically duplicate everything
-# but then again, the vectors take up WAY more space
-chunk_store = {}
+# chunks per embed request, both backends are a lot faster per chunk in batches
+EMBED_BATCH_SIZE = 32
 
-loaded_files = loadfiles()
+# with at least this many chunks, search scans 1 bit per dimension first and only computes real cosines for the closest few
+# below it the full float scan is already fast enough that the prefilter only costs recall
+BINARY_PREFILTER_MIN_CHUNKS = 20000
+BINARY_RERANK = 2000
 
 # Compute a hash to verify the state of the input files
-hash_input = pickle.dumps([chunk_size_bytes, EMBED_MODEL])
-hash_value = hashlib.sha256(hash_input).hexdigest()
-
-save_file = f"{hash_value[:7]}-{EMBEDDINGS_FILE}"
-
-# Function to save progress using pickle
-def save_progress():
-    with tempfile.NamedTemporaryFile('wb', delete=False) as temp_file:
-        pickle.dump({"hash": hash_value, "document_vectors": document_vectors}, temp_file)
-        temp_file_path = temp_file.name
-    os.replace(temp_file_path, save_file)
-
-# Load embeddings from file if they exist and match the hash
-if os.path.exists(save_file):
-    with open(save_file, 'rb') as f:
-        try:
-            saved_data = pickle.load(f)
-            if saved_data.get("hash") == hash_value:
-                document_vectors = saved_data["document_vectors"]
-                print("Loaded existing embeddings from file.")
+# depends on which embedding backend/model is configured, and an onnx one has to be loaded to know, so it's not done at import
+def embed_version():
+    hash_input = pickle.dumps([chunk_size_bytes, embed_fingerprint()])
+    hash_value = hashlib.sha256(hash_input).hexdigest()
+    return hash_value[:7]
+
+# loads the saved embeddings and embeds whatever chunks are missing
+# returns the vectors, the chunk store and the corpus size. with load=False the vectors aren't read (None comes back),
+# just which chunks have one, shards.load_vector_shards reads the ones it needs itself
+def load_vectors(loaded_files, store=None, load=True):
+    corpus_size = 0
+
+    store = store or open_store()
+    version = embed_version()
+    document_vectors = store.get(STAGE, version, CHUNKS_1024) if load else None
+    embedded = document_vectors if load else store.done_keys(STAGE, version, CHUNKS_1024)
+    print(f"Loaded {len(embedded)} existing embeddings from the store.")
+    # starting to think it might not be a good idea to store chunks, as we basically duplicate everything
+    # but then again, the vectors take up WAY more space
+    chunk_store = {}
+
+    # Embed chunks and commit every so often
+    chunks_processed = 0
+    pending = []
+
+    def flush():
+        vectors = embed_batch([chunk for _, chunk in pending])
+        for (id, _), vector in zip(pending, vectors):
+            if document_vectors is not None:
+                document_vectors[id] = vector
+            store.put(STAGE, version, CHUNKS_1024, id, vector)
+        pending.clear()
+        # once per batch, so the write lock isn't held while the next batch gets embedded
+        store.commit()
+
+    for info in loaded_files:
+        date = info["date"]
+        content = info["content"]
+        corpus_size += len(content)
+
+        chunks = chunks_for(info, CHUNKS_1024)
+        # committed before the next embed call, the other pipeline stages write to the same file and wait on an open transaction
+        with store.db:
+            store.add_chunks(CHUNKS_1024, date, chunks)
+
+        for i, chunk in enumerate(chunks):
+            id = f"{date}#{i}"
+
+            chunk_store[id] = date + "\n" + chunk
+            # Skip if already embedded
+            if id in embedded:
+                continue
+
+            chunks_processed += 1
+            pending.append((id, chunk))
+            if len(pending) >= EMBED_BATCH_SIZE:
+                flush()
+        #print(date)
+
+    # one last time
+    if pending:
+        flush()
+    store.commit()
+
+    return document_vectors, chunk_store, corpus_size
+
+def chunk_date(chunk_id):
+    return chunk_id.rsplit('#', 1)[0]
+
+# returns [(chunk_id, score)], best first. start/end (YYYY-MM-DD) skip chunks outside those dates,
+# and with allowed (anything that can tell if a chunk id is in it, a metadata.Window from the filters) only those get scored
+def search(document_vectors, embedded_query, start=None, end=None, allowed=None):
+    combined_scores = collections.Counter()
+
+    with span("score", chunks=len(document_vectors)):
+        for k,v in document_vectors.items():
+            if (start and chunk_date(k) < start) or (end and chunk_date(k) > end):
+                continue
+            if allowed is not None and k not in allowed:
+                continue
+            score = cos_similarity(embedded_query, v)
+            combined_scores[k] = score
+
+        return combined_scores.most_common()
+
+# number of set bits in every byte value, for numpy without bitwise_count
+POPCOUNT = None if np is None else np.array([bin(x).count("1") for x in range(256)], dtype=np.uint8)
+
+# the vectors as one normalized float32 matrix, plus each vector's signs packed 64 to a uint64.
+# rows are sorted by date, so a date range is just a slice of the rows
+# signs are taken after subtracting the corpus mean, embeddings mostly aren't centered at zero
+# and otherwise lots of dimensions have the same sign for every chunk and say nothing
+class VectorIndex:
+    def __init__(self, document_vectors, binary_min_chunks=BINARY_PREFILTER_MIN_CHUNKS, rerank=BINARY_RERANK):
+        self.document_vectors = document_vectors
+        self.ids = sorted(document_vectors.keys(), key=split_key)
+        self.binary_min_chunks = binary_min_chunks
+        self.rerank = rerank
+        if np is None or not self.ids:
+            self.matrix = None
+            return
+        matrix = np.asarray([document_vectors[x] for x in self.ids], dtype=np.float32)
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        self.matrix = matrix
+        self.dates = np.array([chunk_date(x) for x in self.ids])
+        self.mean = matrix.mean(axis=0)
+        self.bits = self.pack_signs(matrix)
+
+    # pickled into the store per shard, the matrix is all it needs so leave the dict of lists out
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if self.matrix is not None:
+            state["document_vectors"] = None
+        state.pop("positions", None)
+        state.pop("positions_index", None)
+        return state
+
+    def pack_signs(self, vectors):
+        packed = np.packbits(vectors - self.mean > 0, axis=-1)
+        # pad to whole uint64 words
+        padding = (-packed.shape[-1]) % 8
+        if padding:
+            packed = np.pad(packed, [(0, 0)] * (packed.ndim - 1) + [(0, padding)])
+        return np.ascontiguousarray(packed).view(np.uint64)
+
+    def hamming(self, bits, query_bits):
+        xor = bits ^ query_bits
+        if hasattr(np, "bitwise_count"):
+            return np.bitwise_count(xor).sum(axis=1, dtype=np.int32)
+        return POPCOUNT[xor.view(np.uint8)].sum(axis=1, dtype=np.int32)
+
+    # row range [lo, hi) for chunks from start to end, inclusive
+    def date_slice(self, start=None, end=None):
+        lo = int(np.searchsorted(self.dates, start, side="left")) if start else 0
+        hi = int(np.searchsorted(self.dates, end, side="right")) if end else len(self.ids)
+        return lo, max(lo, hi)
+
+    # every row's position in the metadata filters' numbering (-1 if it isn't there), made the first time they're used
+    def filter_positions(self, metadata_index):
+        if getattr(self, "positions_index", None) is not metadata_index:
+            self.positions = np.array([metadata_index.position.get(x, -1) for x in self.ids], dtype=np.int64)
+            self.positions_index = metadata_index
+        return self.positions
+
+    # how many chunks a search from start to end scans
+    def row_count(self, start=None, end=None):
+        if self.matrix is None:
+            return len(self.ids)
+        lo, hi = self.date_slice(start, end)
+        return hi - lo
+
+    # returns [(chunk_id, score)], best first. with the binary prefilter only the reranked candidates come back.
+    # binary and rerank default to what the index was built with, shards.py passes its own for the shards together
+    def search(self, embedded_query, binary=None, start=None, end=None, allowed=None, rerank=None):
+        if self.matrix is None:
+            return search(self.document_vectors, embedded_query, start, end, allowed)
+        lo, hi = self.date_slice(start, end)
+        if allowed is not None:
+            return self.search_rows(embedded_query, lo, hi, allowed)
+        rows = hi - lo
+        if binary is None:
+            binary = rows >= self.binary_min_chunks
+        rerank = rerank or self.rerank
+        query = np.asarray(embedded_query, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+
+        # slices of numpy arrays are views, nothing outside the dates gets touched
+        matrix = self.matrix[lo:hi]
+        with span("score", chunks=rows, binary=binary) as score_span:
+            if binary and rows > rerank:
+                distances = self.hamming(self.bits[lo:hi], self.pack_signs(query[None, :]))
+                candidates = np.argpartition(distances, rerank)[:rerank]
+                scores = matrix[candidates] @ query
+                ranked = np.argsort(-scores)
+                order = candidates[ranked]
+                scores = scores[ranked]
+                score_span.set(bytes_scanned=self.bits[lo:hi].nbytes + len(candidates) * matrix.shape[1] * 4)
             else:
-                print("Embeddings file found but hash mismatch. Starting fresh.")
-        except pickle.PickleError:
-            print("Error decoding embeddings file. Starting fresh.")
-else:
-    print("No existing embeddings file found. Starting fresh.")
-
-# Embed chunks and save to file after each document is processed
-chunks_processed = 0
-for info in loaded_files:
-    date = info["date"]
-    content = info["content"]
-    corpus_size += len(content)
-
-    chunks = chunkenize(content)
-
-    for i, chunk in enumerate(chunks):
-        id = f"{date}#{i}"
-
-        chunk_store[id] = date + "\n" + chunk
-        # Skip if already embedded
-        if id in document_vectors:
-            # little trick so that it doesn't save repeatedly when we've already processed chunks in json, but haven't seen them here
-            if chunks_processed % 100 == 0:
-                chunks_processed += 1
+                scores = matrix @ query
+                order = np.argsort(-scores)
+                scores = scores[order]
+                score_span.set(bytes_scanned=matrix.nbytes)
+            return [(self.ids[lo + i], float(score)) for i, score in zip(order, scores)]
+
+    # exact scores for just the allowed chunks between rows lo and hi, the filters usually leave few enough that no prefilter is needed.
+    # allowed is the metadata.Window for this shard, its bits get checked against all the rows at once
+    def search_rows(self, embedded_query, lo, hi, allowed):
+        rows = lo + np.flatnonzero(allowed.mask(self.filter_positions(allowed.index)[lo:hi]))
+        query = np.asarray(embedded_query, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        with span("score", chunks=len(rows), filtered=True) as score_span:
+            scores = self.matrix[rows] @ query
+            order = np.argsort(-scores)
+            score_span.set(bytes_scanned=len(rows) * self.matrix.shape[1] * 4)
+            return [(self.ids[rows[i]], float(scores[i])) for i in order]
+
+    # how many of the exact top k the binary prefilter still finds, averaged over the queries
+    def recall(self, embedded_queries, k=10):
+        if self.matrix is None or not embedded_queries:
+            return None
+        found = 0
+        for query in embedded_queries:
+            exact = {x for x, _ in self.search(query, binary=False)[:k]}
+            approximate = {x for x, _ in self.search(query, binary=True)[:k]}
+            found += len(exact & approximate) / max(1, len(exact))
+        return found / len(embedded_queries)
+
+def main(journal_dir=None):
+    preprocessing_timer = TimerLogger("Preprocessing")
+
+    from shards import load_vector_shards
+    from metadata import QueryFilters
+
+    loaded_files = loadfiles(journal_dir)
+    _, chunk_store, corpus_size = load_vectors(loaded_files, load=False)
+    vector_index = load_vector_shards(loaded_files)
+
+    preprocessing_timer.stop_and_log(corpus_size)
+
+    # "location == nyc", "sentiment < 30", "year in 2016..2018" in a query
+    query_filters = QueryFilters(chunk_store.keys())
+
+    holder = False
+
+    chat_history = ChatHistory()
+
+    # start generating the next page in the background after each answer, so `more` is instant
+    prefetch_next_page = True
+    prefetcher = Prefetcher(format='json')
+
+    while True:
+        query = input("user>")
+
+        prefetched = None
+
+        if query == 'clear':
+            chat_history.clear()
+            print('system>cleared chat history')
             continue
 
-        chunks_processed += 1
-        vector = embed(chunk)
-
-        document_vectors[id] = vector
-
-        # Save progress to file using a temporary file to avoid corruption. But don't do it too much, it slows down pre-processing
-        if chunks_processed % 100 == 0:
-            save_progress()
-    #print(date)
-
-# one last time
-save_progress()
-
-preprocessing_timer.stop_and_log(corpus_size)
-
-holder = False
+        elif query == 'more':
+            if holder == False:
+                print('system>no question previously asked')
+                continue
+            elif not holder.has_more() and not prefetcher.pending(holder):
+                print('system>out of search results')
+                continue
+            else:
+                chat_history.log_user(query)
+                prefetched = prefetcher.take(holder)
+                prompt = prefetched[0] if prefetched else holder.build_prompt()
 
-chat_history = ChatHistory()
+        else:
+            # new question, the old page is useless now and we need the model
+            prefetcher.cancel()
+            chat_history.log_user(query)
+            query, allowed = query_filters.apply(query)
+            # "in march 2019" or "after:2018-06" only scores chunks from those dates
+            query, start, end = parse_date_range(query)
+            if start or end:
+                print(f"system>only searching {start or 'the start'} to {end or 'now'}")
+            expanded_query = query + expand(query, type='tfidf', history=chat_history)
+            #print(expanded_query)
 
-while True:
-    query = input("user>")
-    query_timer = TimerLogger("Query")
+            embedded_query = embed(expanded_query)
 
-    if query == 'clear':
-        chat_history.clear()
-        print('system>cleared chat history')
-        continue
+            chunks_per_query = 10
 
-    elif query == 'more':
-        if holder == False:
-            print('system>no question previously asked')
-            continue
-        elif not holder.has_more():
-            print('system>out of search results')
-            continue
-        else:
-            chat_history.log_user(query)
+            sorted_combined_scores = vector_index.search(embedded_query, start=start, end=end, allowed=allowed)
+            holder = RetrievalHandler(query, sorted_combined_scores, chunk_store, chunks_per_query, history=None)
             prompt = holder.build_prompt()
 
-    else:
-        chat_history.log_user(query)
-        expanded_query = query + expand(query, type='tfidf', history=chat_history)
-        #print(expanded_query)
-
-        embedded_query = embed(expanded_query)
-    
-        combined_scores = collections.Counter()
+        if prefetched and prefetched[1] is not None:
+            _, out, stats = prefetched
+            streamer = JsonStreamer()
+            print(f"{LLM_MODEL}>{streamer.feed(out)}")
+        else:
+            out,stats = llm(prompt, False, False, format='json', response_stream=True)
+        #prompt_tokens = stats.get("prompt_eval_count", 0)
+        #print(f"{prompt_tokens} tokens in the prompt, {stats["eval_count"]} tokens in response, {len(holder.last_page)} chunks packed into {holder.last_page_tokens} context tokens, {len(prompt)/prompt_tokens:.2f} bytes per token")
+        obj = json.loads(out.strip())
+        print(obj)
+
+        if "response" in obj:
+            chat_history.log_llm(obj["response"])
+        else:
+            chat_history.log_llm("")
 
-        chunks_per_query = 10
-    
-        for k,v in document_vectors.items():
-            score = cos_similarity(embedded_query, v)
-            combined_scores[k] = score
+        if prefetch_next_page:
+            prefetcher.start(holder)
 
-        sorted_combined_scores = combined_scores.most_common()
-        holder = RetrievalHandler(query, sorted_combined_scores, chunk_store, chunks_per_query, history=None)
-        prompt = holder.build_prompt()
-    
-    out,stats = llm(prompt, False, False, format='json', response_stream=True)
-    prompt_tokens = stats["prompt_eval_count"]
-    #print(f"{prompt_tokens} tokens in the prompt, {stats["eval_count"]} tokens in response, {prompt_tokens/chunks_per_query:.2f} tokens per chunk, {chunk_size_bytes/(prompt_tokens/chunks_per_query):.2f} estimated bytes per token, another estimate: {len(prompt)/prompt_tokens:.2f}")
-    obj = json.loads(out.strip())
-    print(obj)
-
-    if "response" in obj:
-        chat_history.log_llm(obj["response"])
-    else:
-        chat_history.log_llm("")
-
-    
-    #query_timer.stop_and_log(corpus_size)
+if __name__ == "__main__":
+    main()
@@ -1,132 +1,199 @@
-import collections
 import json
-import pickle
-import os
-import hashlib
-import tempfile
-import networkx as nx
-from pyvis.network import Network  # Import PyVis
-
-from common import ChatHistory, RetrievalHandler, TimerLogger, chunkenize, llm, loadfiles, chunk_size_bytes
-
-EMBED_MODEL = 'nomic-embed-text'
-
-preprocessing_timer = TimerLogger("Preprocessing")
-
-corpus_size = 0
-
-RELATIONSHIPS_FILE = "relationships.pkl"
-
-relationships_store = {}
-G = nx.DiGraph()  # Initialize a directed graph
-
-loaded_files = loadfiles()
-
-# Compute a hash to verify the state of the input files
-hash_input = pickle.dumps([chunk_size_bytes, EMBED_MODEL])
-hash_value = hashlib.sha256(hash_input).hexdigest()
-
-save_file = f"{hash_value[:7]}-{RELATIONSHIPS_FILE}"
-
-# Function to save progress using pickle
-def save_progress():
-    with tempfile.NamedTemporaryFile('wb', delete=False) as temp_file:
-        pickle.dump({
-            "hash": hash_value,
-            "relationships_store": relationships_store,
-        }, temp_file)
-        temp_file_path = temp_file.name
-    os.replace(temp_file_path, save_file)
-
-# Load relationships from file if they exist and match the hash
-relationships_loaded = False  # Flag to check if relationships were loaded from disk
-if os.path.exists(save_file):
-    with open(save_file, 'rb') as f:
-        try:
-            saved_data = pickle.load(f)
-            if saved_data.get("hash") == hash_value:
-                relationships_store = saved_data["relationships_store"]
-                print("Loaded existing relationships from file.")
-                relationships_loaded = True
-            else:
-                print("Relationships file found but hash mismatch. Starting fresh.")
-        except pickle.PickleError:
-            print("Error decoding relationships file. Starting fresh.")
-else:
-    print("No existing relationships file found. Starting fresh.")
-
-# Function to extract relationships in JSON format
-# Process chunks and extract relationships
-chunks_processed = 0
-# Build the graph from the loaded relationships_store
-for data in relationships_store.values():
-    relationships = data['relationships']
-    for rel in relationships:
-        subject = rel.get('subject', '').strip() if rel.get('subject','') else ''
-        predicate = rel.get('predicate', '').strip() if rel.get('predicate','') else ''
-        obj = rel.get('object', '').strip() if rel.get('object','') and not isinstance(rel.get('object',''), list) and not isinstance(rel.get('object',''),dict) else ''
-        if subject and predicate and obj:
-            if True:
-                subject = subject.lower()
-                obj = obj.lower()
-                ex = ['null', 'none', 'me', 'myself', 'user', 'i', 'author', 'narrator', 'the narrator', 'self', 'the author', 'the writer']
-                if subject not in ex and obj not in ex:
-                    if G.has_edge(subject, obj):
-                        G[subject][obj]['weight'] += 1
-                    else:
-                        G.add_edge(subject, obj, label=predicate, weight=1)
-
-#preprocessing_timer.stop_and_log(corpus_size)
-
-# Visualize the graph with physics using PyVis
-def visualize_graph_with_pyvis(G, min_degree=2):
-    if G.number_of_nodes() == 0:
+import time
+
+from store import open_store
+
+# the layout is worked out here once and saved, the browser just draws fixed positions with physics off
+LAYOUT_ITERATIONS = 100
+# nodes each node gets pushed away from per layout iteration, a random sample instead of all of them so it's not n squared
+LAYOUT_SAMPLES = 64
+# pixels per unit of layout, times sqrt(nodes) so bigger graphs get more room
+LAYOUT_SCALE = 60
+# after the graph got patched the old layout only needs settling, the new nodes in and the rest barely moving
+WARM_LAYOUT_ITERATIONS = 25
+WARM_LAYOUT_TEMPERATURE = 0.01
+
+# levels of detail, at most this many nodes each. graph.html gets the most connected ones and opens instantly,
+# graph-lod1.html, graph-lod2.html ... add the next most connected. all of them use the same positions
+LOD_TIERS = [300, 2000, 10000]
+# only the heaviest edges are drawn, this many per node in the tier
+LOD_EDGES_PER_NODE = 4
+
+# nodes with at least min_degree connections once the self references are left out.
+# returns their ids, which edges are left, and everyone's degree
+def visible_nodes(knowledge_graph, min_degree=2):
+    import numpy as np
+
+    edge_mask = knowledge_graph.without_self_references()
+    degree = knowledge_graph.degree(edge_mask)
+    return np.flatnonzero(degree >= min_degree), edge_mask, degree
+
+# fruchterman-reingold with every node moved at once. edges pull their ends together (heavier ones harder),
+# every node pushes away a random sample of the others, and the step size cools down to nothing.
+# sources/targets are positions 0..n-1, returns an (n, 2) array. starts from initial if given, random otherwise
+def force_layout(n, sources, targets, weights, iterations=LAYOUT_ITERATIONS, samples=LAYOUT_SAMPLES, seed=0, initial=None, temperature=0.2):
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform(-1, 1, (n, 2)) if initial is None else np.array(initial, dtype=np.float64)
+    if n < 2:
+        return positions
+    ideal = 2 / np.sqrt(n)
+    pull = np.log1p(weights)[:, None]
+
+    for i in range(iterations):
+        # repulsion, k^2/d along the difference
+        if n <= samples:
+            others = np.broadcast_to(np.arange(n), (n, n))
+            scale = 1.0
+        else:
+            others = rng.integers(0, n, (n, samples))
+            scale = n / samples
+        delta = positions[:, None, :] - positions[others]
+        distance2 = np.maximum((delta ** 2).sum(axis=-1), 1e-6)
+        displacement = (delta * (ideal ** 2 / distance2)[..., None]).sum(axis=1) * scale
+
+        # attraction, d^2/k along the edge
+        delta = positions[sources] - positions[targets]
+        force = delta * np.sqrt((delta ** 2).sum(axis=-1, keepdims=True)) / ideal * pull
+        for axis in range(2):
+            displacement[:, axis] -= np.bincount(sources, force[:, axis], minlength=n)
+            displacement[:, axis] += np.bincount(targets, force[:, axis], minlength=n)
+
+        length = np.maximum(np.sqrt((displacement ** 2).sum(axis=-1, keepdims=True)), 1e-9)
+        positions += displacement / length * np.minimum(length, temperature * (1 - i / iterations))
+    return positions
+
+# where the nodes of a patched graph were in its old layout, new nodes go next to the old ones they're connected to.
+# in the unscaled layout coordinates
+def warm_start(node_ids, sources, targets, saved_nodes, saved_positions, seed=0):
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    initial = rng.uniform(-1, 1, (len(node_ids), 2))
+    placed = np.isin(node_ids, saved_nodes)
+    initial[placed] = saved_positions[np.searchsorted(saved_nodes, node_ids[placed])] / (LAYOUT_SCALE * np.sqrt(len(saved_nodes)))
+    # the average of their placed neighbours, plus a little so they don't land on top of each other
+    ends = np.concatenate([sources, targets]), np.concatenate([targets, sources])
+    toward = placed[ends[1]] & ~placed[ends[0]]
+    count = np.bincount(ends[0][toward], minlength=len(node_ids))
+    near = count > 0
+    for axis in range(2):
+        total = np.bincount(ends[0][toward], initial[ends[1][toward], axis], minlength=len(node_ids))
+        initial[near, axis] = total[near] / count[near] + rng.normal(0, 0.01, int(near.sum()))
+    return initial
+
+# positions for node_ids, loaded from the graph's folder if they were worked out before.
+# the folder gets replaced when the graph is recompiled, so an old layout never outlives its graph. when it was only
+# patched the node ids stayed the same, and the new layout starts from the old one and only runs a few cooler iterations
+def load_or_layout(knowledge_graph, node_ids, edge_mask, path):
+    import numpy as np
+
+    saved = None
+    try:
+        saved = np.load(path)
+        if np.array_equal(saved["nodes"], node_ids):
+            print(f"Loaded layout for {len(node_ids)} nodes.")
+            return saved["positions"]
+    except (OSError, KeyError, ValueError):
+        saved = None
+
+    position = np.full(knowledge_graph.node_count, -1)
+    position[node_ids] = np.arange(len(node_ids))
+    sources = position[knowledge_graph.sources()]
+    targets = position[knowledge_graph.indices]
+    keep = edge_mask & (sources >= 0) & (targets >= 0)
+    start_time = time.perf_counter()
+    if saved is not None:
+        initial = warm_start(node_ids, sources[keep], targets[keep], saved["nodes"], saved["positions"])
+        positions = force_layout(len(node_ids), sources[keep], targets[keep], knowledge_graph.weights[keep], iterations=WARM_LAYOUT_ITERATIONS, initial=initial, temperature=WARM_LAYOUT_TEMPERATURE)
+    else:
+        positions = force_layout(len(node_ids), sources[keep], targets[keep], knowledge_graph.weights[keep])
+    positions *= LAYOUT_SCALE * np.sqrt(len(node_ids))
+    print(f"Laid out {len(node_ids)} nodes and {int(keep.sum())} edges in {time.perf_counter() - start_time:.1f}s.")
+    with open(path, "wb") as f:
+        np.savez(f, nodes=node_ids, positions=positions)
+    return positions
+
+# node ids per level of detail, most important first. by "degree" (connections) or "weight" (how often they were extracted)
+def lod_tiers(knowledge_graph, node_ids, edge_mask, degree, by="degree", tiers=LOD_TIERS):
+    import numpy as np
+
+    if by == "weight":
+        weights = np.where(edge_mask, knowledge_graph.weights, 0)
+        importance = np.bincount(knowledge_graph.sources(), weights, minlength=knowledge_graph.node_count) + np.bincount(knowledge_graph.indices, weights, minlength=knowledge_graph.node_count)
+    else:
+        importance = degree
+    ranked = node_ids[np.argsort(-importance[node_ids], kind="stable")]
+    result = []
+    for size in tiers:
+        result.append(ranked[:size])
+        if size >= len(ranked):
+            break
+    return result
+
+# the heaviest LOD_EDGES_PER_NODE * nodes edges among node_ids
+def tier_edges(knowledge_graph, node_ids, edge_mask):
+    import numpy as np
+
+    keep = np.zeros(knowledge_graph.node_count, dtype=bool)
+    keep[node_ids] = True
+    edges = np.flatnonzero(edge_mask & keep[knowledge_graph.sources()] & keep[knowledge_graph.indices])
+    limit = LOD_EDGES_PER_NODE * len(node_ids)
+    if len(edges) > limit:
+        edges = edges[np.argpartition(-knowledge_graph.weights[edges], limit)[:limit]]
+    return edges
+
+# Visualize the graph with PyVis, at fixed positions with physics off so the browser doesn't have to lay anything out
+def visualize_graph_with_pyvis(knowledge_graph, node_ids, edges, positions, path='graph.html', open_browser=True):
+    from pyvis.network import Network
+
+    net = Network(height='750px', width='100%', notebook=False, directed=True)
+    net.toggle_physics(False)
+
+    sources = knowledge_graph.sources()
+    for node, (x, y) in zip(node_ids.tolist(), positions.tolist()):
+        name = knowledge_graph.nodes[node]
+        net.add_node(name, label=name, title=name, x=x, y=y, physics=False)
+
+    for edge in edges.tolist():
+        predicate = knowledge_graph.predicates[knowledge_graph.predicate_ids[edge]]
+        weight = int(knowledge_graph.weights[edge])
+        # Set edge thickness based on weight
+        net.add_edge(knowledge_graph.nodes[sources[edge]], knowledge_graph.nodes[knowledge_graph.indices[edge]], label=predicate, title=predicate, width=min(weight, 10))
+
+    options = {"physics": {"enabled": False}, "edges": {"smooth": False}, "interaction": {"hideEdgesOnDrag": True}}
+    net.set_options("var options = %s" % json.dumps(options))
+
+    if open_browser:
+        net.show(path, notebook=False)  # Save and open the graph in a web browser
+    else:
+        net.write_html(path)
+
+def main(min_degree=10, lod_by="degree"):
+    import os
+    import kgraph
+
+    store = open_store()
+    # compiled by graph.py (or the pipeline), only rebuilt here if new relationships got extracted since
+    knowledge_graph = kgraph.open_graph(store)
+    if knowledge_graph.node_count == 0:
         print("Graph is empty. Nothing to visualize.")
         return
 
-    # Filter nodes with degree >= min_degree
-    nodes_with_min_degree = [node for node in G.nodes() if G.degree(node) >= min_degree]
-
-    # Create subgraph with nodes that have at least min_degree connections
-    subgraph = G.subgraph(nodes_with_min_degree).copy()
-
-    if subgraph.number_of_nodes() == 0:
+    node_ids, edge_mask, degree = visible_nodes(knowledge_graph, min_degree)
+    if len(node_ids) == 0:
         print(f"No nodes with at least {min_degree} connections.")
         return
 
-    net = Network(height='750px', width='100%', notebook=False, directed=True)
-    net.barnes_hut()  # Enable physics simulation
-
-    # Add nodes and edges to the PyVis network
-    for node in subgraph.nodes():
-        net.add_node(node, label=node, title=node)
-
-    for source, target, data in subgraph.edges(data=True):
-        predicate = data.get('label', '')
-        weight = data.get('weight', 1)
-        net.add_edge(source, target, label=predicate, title=predicate, width=weight)  # Set edge thickness based on weight
-
-    # Customize physics settings (optional)
-    physics_options = {
-        'enabled': True,
-        'barnesHut': {
-            'gravitationalConstant': -80000,
-            'centralGravity': 0.3,
-            'springLength': 95,
-            'springConstant': 0.04,
-            'damping': 0.09,
-            'avoidOverlap': 0
-        },
-        'minVelocity': 0.75
-    }
-    net.set_options("""
-    var options = {
-      "physics": %s
-    }
-    """ % json.dumps(physics_options))
-
-    #net.show_buttons(filter_=['physics'])  # Show physics configuration UI
-    net.show('graph.html', notebook=False)  # Save and open the graph in a web browser
-
-# Call the PyVis visualization function
-visualize_graph_with_pyvis(G, min_degree=10)
+    positions = load_or_layout(knowledge_graph, node_ids, edge_mask, os.path.join(kgraph.graph_dir(store), f"layout-{min_degree}.npz"))
+    position = dict(zip(node_ids.tolist(), range(len(node_ids))))
+
+    for level, tier in enumerate(lod_tiers(knowledge_graph, node_ids, edge_mask, degree, lod_by)):
+        path = 'graph.html' if level == 0 else f'graph-lod{level}.html'
+        edges = tier_edges(knowledge_graph, tier, edge_mask)
+        visualize_graph_with_pyvis(knowledge_graph, tier, edges, positions[[position[x] for x in tier.tolist()]], path, open_browser=level == 0)
+        print(f"Wrote {path} with {len(tier)} nodes and {len(edges)} edges.")
+
+if __name__ == "__main__":
+    main()